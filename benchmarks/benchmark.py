@@ -0,0 +1,383 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+#
+# debbindiff: highlight differences between two builds of Debian packages
+#
+# Copyright © 2015 Jérémy Bobbio <lunar@debian.org>
+#
+# debbindiff is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# debbindiff is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
+
+# Microbenchmarks for the functions debbindiff spends most of its time in.
+#
+# Inputs are generated from a fixed seed and no external tool is called,
+# so results can be compared from one run to another:
+#
+#   $ benchmarks/benchmark.py --save baseline.json
+#   (upgrade something)
+#   $ benchmarks/benchmark.py --baseline baseline.json
+#
+# For every benchmark, the best time of a few runs is reported, along with
+# how much the peak memory of the process grew while running it. Each
+# benchmark runs in its own process so memory is not shared between them.
+
+from __future__ import print_function
+
+import argparse
+import cPickle as pickle
+import difflib
+import gc
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from debbindiff.comparators.binary import are_same_binaries, \
+    hexdump_fallback, get_differing_regions
+from debbindiff.difference import Difference, DiffParser, diff, \
+    make_feeder_from_buffer, make_feeder_from_file
+from debbindiff.presenters.html import convert, linediff, output_unified_diff, \
+    output_html
+from debbindiff.presenters.text import output_text
+
+
+SEED = 20150101
+DEFAULT_THRESHOLD = 0.2  # 20 %
+
+BENCHMARKS = []
+
+
+def benchmark(repeat=5):
+    """Register a benchmark: the decorated function prepares the input in
+    `temp_dir` and returns the function to time"""
+    def register(setup):
+        BENCHMARKS.append((setup.__name__, setup, repeat))
+        return setup
+    return register
+
+
+def random_words(rng, count):
+    return ' '.join(rng.choice(WORDS) for _ in xrange(count))
+
+WORDS = ['debian', 'build', 'reproducible', 'package', 'timestamp', 'usr',
+         'lib', 'share', 'doc', '0x7f454c46', 'section', 'symbol', '=',
+         '{', '}', '-', '1.2.3', 'libc6', 'amd64', 'changelog']
+
+
+def random_text(rng, line_count):
+    return [random_words(rng, rng.randint(3, 15)) for _ in xrange(line_count)]
+
+
+def modify_lines(rng, lines, every):
+    lines = list(lines)
+    for i in xrange(0, len(lines), every):
+        lines[i] = random_words(rng, rng.randint(3, 15))
+    return lines
+
+
+def make_unified_diff(line_count, every):
+    rng = random.Random(SEED)
+    lines1 = random_text(rng, line_count)
+    lines2 = modify_lines(rng, lines1, every)
+    return ''.join('%s\n' % line for line in
+                   difflib.unified_diff(lines1, lines2, 'a', 'b', lineterm=''))
+
+
+def make_long_lines(count, length, changes):
+    rng = random.Random(SEED)
+    pairs = []
+    for _ in xrange(count):
+        s = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz0123456789 ')
+                    for _ in xrange(length))
+        t = list(s)
+        for _ in xrange(changes):
+            t[rng.randrange(length)] = rng.choice('XYZ')
+        pairs.append((s, ''.join(t)))
+    return pairs
+
+
+def write_blob(path, size, seed=SEED):
+    rng = random.Random(seed)
+    chunk = ''.join(chr(rng.randrange(256)) for _ in xrange(2 ** 16))
+    with open(path, 'wb') as f:
+        for offset in xrange(0, size, len(chunk)):
+            f.write(chunk[:size - offset])
+
+
+def make_tree(depth, fan_out, unified_diff):
+    def make_node(level, name):
+        difference = Difference(unified_diff, name, name, source=name)
+        if level < depth:
+            difference.add_details([make_node(level + 1, '%s/%d' % (name, i))
+                                    for i in xrange(fan_out)])
+        return difference
+    return [make_node(0, 'root')]
+
+
+@benchmark()
+def diffparser_parse_many_hunks(temp_dir):
+    unified_diff = make_unified_diff(10000, 20)
+    def run():
+        parser = DiffParser(StringIO(unified_diff), True, True)
+        parser.parse()
+    return run
+
+
+@benchmark()
+def linediff_long_lines(temp_dir):
+    pairs = make_long_lines(50, 2000, 10)
+    def run():
+        for s, t in pairs:
+            linediff(s, t)
+    return run
+
+
+@benchmark()
+def linediff_rewritten_lines(temp_dir):
+    rng = random.Random(SEED)
+    pairs = [(random_words(rng, 200), random_words(rng, 200)) for _ in xrange(50)]
+    def run():
+        for s, t in pairs:
+            linediff(s, t)
+    return run
+
+
+@benchmark()
+def convert_long_lines(temp_dir):
+    lines = []
+    for s, t in make_long_lines(50, 2000, 10):
+        lines.extend(linediff(s, t))
+    def run():
+        for line in lines:
+            convert(line, ponct=1)
+    return run
+
+
+@benchmark()
+def output_unified_diff_many_hunks(temp_dir):
+    difference = Difference(make_unified_diff(5000, 20), 'a', 'b')
+    def run():
+        output = []
+        output_unified_diff(lambda s, force=False: output.append(s),
+                            difference)
+    return run
+
+
+@benchmark(repeat=3)
+def are_same_binaries_identical_blobs(temp_dir):
+    path1 = os.path.join(temp_dir, 'blob1')
+    path2 = os.path.join(temp_dir, 'blob2')
+    write_blob(path1, 32 * 2 ** 20)
+    shutil.copyfile(path1, path2)
+    def run():
+        assert are_same_binaries(path1, path2)
+    return run
+
+
+@benchmark(repeat=3)
+def hexdump_fallback_blob(temp_dir):
+    path = os.path.join(temp_dir, 'blob')
+    # time grows faster than the size of the input
+    write_blob(path, 128 * 2 ** 10)
+    def run():
+        hexdump_fallback(path)
+    return run
+
+
+@benchmark(repeat=3)
+def get_differing_regions_moved_data(temp_dir):
+    rng = random.Random(SEED)
+    path = os.path.join(temp_dir, 'blob')
+    write_blob(path, 32 * 2 ** 20)
+    with open(path, 'rb') as f:
+        data1 = f.read()
+    data2 = bytearray(data1)
+    # data changed in place, inserted and removed
+    for _ in xrange(100):
+        offset = rng.randrange(len(data2))
+        action = rng.choice(['change', 'insert', 'remove'])
+        if action == 'change':
+            data2[offset:offset + 8] = 'XXXXXXXX'
+        elif action == 'insert':
+            data2[offset:offset] = 'inserted' * rng.randint(1, 100)
+        else:
+            del data2[offset:offset + rng.randint(1, 1000)]
+    data2 = str(data2)
+    def run():
+        get_differing_regions(data1, data2)
+    return run
+
+
+@benchmark()
+def make_feeder_from_file_large_text(temp_dir):
+    path = os.path.join(temp_dir, 'text')
+    with open(path, 'w') as f:
+        for line in random_text(random.Random(SEED), 200000):
+            f.write('%s\n' % line)
+    def run():
+        with open(path) as in_file:
+            with open(os.devnull, 'wb') as out_file:
+                make_feeder_from_file(in_file, lambda buf: buf)(out_file)
+    return run
+
+
+@benchmark(repeat=3)
+def difference_wide_tree(temp_dir):
+    unified_diff = make_unified_diff(20, 10)
+    # every node has its own diff, decoded as DiffParser would do
+    diffs = ['%s+%d\n' % (unified_diff, i) for i in xrange(50000)]
+    def run():
+        root = Difference(None, 'root', 'root')
+        root.add_details([Difference(diff.decode('utf-8'), 'file', 'file')
+                          for diff in diffs])
+    return run
+
+
+@benchmark(repeat=3)
+def diff_windowed_large_text(temp_dir):
+    rng = random.Random(SEED)
+    lines1 = random_text(rng, 300000)
+    lines2 = modify_lines(rng, lines1, 10000)
+    content1 = ''.join('%s\n' % line for line in lines1)
+    content2 = ''.join('%s\n' % line for line in lines2)
+    def run():
+        diff(make_feeder_from_buffer(content1, True),
+             make_feeder_from_buffer(content2, True))
+    return run
+
+
+@benchmark()
+def output_text_deep_tree(temp_dir):
+    differences = make_tree(4, 3, make_unified_diff(100, 10).decode('utf-8'))
+    def run():
+        output = []
+        output_text(differences, lambda *args: output.append(args))
+    return run
+
+
+@benchmark()
+def output_html_deep_tree(temp_dir):
+    differences = make_tree(4, 3, make_unified_diff(100, 10).decode('utf-8'))
+    def run():
+        output = []
+        output_html(differences, print_func=output.append,
+                    max_page_size=sys.maxint)
+    return run
+
+
+def measure(setup, repeat):
+    temp_dir = tempfile.mkdtemp(prefix='debbindiff-benchmark')
+    try:
+        run = setup(temp_dir)
+        gc.collect()
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        times = []
+        for _ in xrange(repeat):
+            start = time.time()
+            run()
+            times.append(time.time() - start)
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return {'time': min(times), 'memory': rss_after - rss_before}
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def measure_in_child(setup, repeat):
+    pipe_r, pipe_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(pipe_r)
+        try:
+            result = measure(setup, repeat)
+            with os.fdopen(pipe_w, 'wb') as f:
+                pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(0)
+    os.close(pipe_w)
+    with os.fdopen(pipe_r, 'rb') as f:
+        try:
+            result = pickle.load(f)
+        except EOFError:
+            result = None
+    os.waitpid(pid, 0)
+    return result
+
+
+def format_change(value, reference):
+    if not reference:
+        return ''
+    return '%+.1f%%' % ((value - reference) * 100.0 / reference)
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description='Run debbindiff microbenchmarks')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='compare results with the ones stored in FILE')
+    parser.add_argument('--save', metavar='FILE',
+                        help='store results in FILE to use them as baseline')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='report a regression when a benchmark is slower '
+                             'than its baseline by more than this ratio '
+                             '(default: %(default)s)')
+    parser.add_argument('names', nargs='*', metavar='NAME',
+                        help='only run benchmarks containing NAME')
+    return parser
+
+
+def main():
+    parsed_args = create_parser().parse_args()
+    baseline = {}
+    if parsed_args.baseline:
+        with open(parsed_args.baseline) as f:
+            baseline = json.load(f)
+    results = {}
+    regressions = []
+    print('%-40s %10s %10s %8s %12s' % ('benchmark', 'time (ms)', 'baseline', 'change', 'memory (kB)'))
+    for name, setup, repeat in BENCHMARKS:
+        if parsed_args.names and not any(n in name for n in parsed_args.names):
+            continue
+        result = measure_in_child(setup, repeat)
+        if result is None:
+            print('%-40s failed' % name)
+            regressions.append(name)
+            continue
+        results[name] = result
+        reference = baseline.get(name, {}).get('time')
+        print('%-40s %10.1f %10s %8s %12d' % (
+            name, result['time'] * 1000,
+            '%.1f' % (reference * 1000) if reference else '-',
+            format_change(result['time'], reference),
+            result['memory']))
+        if reference and result['time'] > reference * (1 + parsed_args.threshold):
+            regressions.append(name)
+    if parsed_args.save:
+        with open(parsed_args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if regressions:
+        print('\nregressions: %s' % ', '.join(regressions))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -28,9 +28,15 @@ import os
 import sys
 import traceback
 from debbindiff import logger, VERSION
+from debbindiff.budget import set_budget, cut_short_count
 import debbindiff.comparators
-from debbindiff.presenters.html import output_html
-from debbindiff.presenters.text import output_text
+from debbindiff.cache import set_cache, DEFAULT_CACHE_SIZE
+from debbindiff.difference import set_diff_backend, DIFF_BACKENDS
+from debbindiff.jobs import set_jobs, set_max_dumps, DEFAULT_MAX_DUMPS
+from debbindiff.profiling import set_profile, write_profile
+from debbindiff.streaming import set_presenters
+from debbindiff.presenters.html import HTMLPresenter
+from debbindiff.presenters.text import TextPresenter
 
 
 def create_parser():
@@ -52,6 +58,36 @@ def create_parser():
                         help='maximum bytes written in report')
     parser.add_argument('--css', metavar='url', dest='css_url',
                         help='link to an extra CSS for the HTML report')
+    parser.add_argument('--jobs', metavar='N', dest='jobs', type=int,
+                        default=1,
+                        help='compare up to N files at the same time')
+    parser.add_argument('--max-dumps', metavar='N', dest='max_dumps', type=int,
+                        default=DEFAULT_MAX_DUMPS,
+                        help='run external tools for up to N dumps at the '
+                             'same time (default: %(default)s)')
+    parser.add_argument('--cache-dir', metavar='DIR', dest='cache_dir',
+                        help='reuse comparison results stored in DIR')
+    parser.add_argument('--cache-size', metavar='BYTES', dest='cache_size',
+                        type=int, default=DEFAULT_CACHE_SIZE,
+                        help='maximum size of the cache directory '
+                             '(default: %(default)s)')
+    parser.add_argument('--diff-backend', dest='diff_backend',
+                        choices=DIFF_BACKENDS, default='auto',
+                        help='compute line differences with difflib '
+                             '(internal), GNU diff (external), or pick '
+                             'depending on the input size (auto, default)')
+    parser.add_argument('--max-runtime', metavar='SECONDS', dest='max_runtime',
+                        type=int,
+                        help='cut comparisons short and only summarize '
+                             'what is left once most of this time is spent')
+    parser.add_argument('--max-memory', metavar='BYTES', dest='max_memory',
+                        type=int,
+                        help='cut comparisons short and only summarize '
+                             'what is left once the process gets close to '
+                             'using this much memory')
+    parser.add_argument('--profile', metavar='output', dest='profile_output',
+                        help='write timings as a Chrome trace event file '
+                             'and print a summary on stderr')
     parser.add_argument('file1', help='first file to compare')
     parser.add_argument('file2', help='second file to compare')
     return parser
@@ -59,16 +95,22 @@ def create_parser():
 
 @contextmanager
 def make_printer(path):
-    if path == '-':
-        output = sys.stdout
-    else:
-        output = codecs.open(path, 'w', encoding='utf-8')
+    if not path:
+        yield None
+        return
+    # reports are only created once there is something to write in them
+    outputs = []
     def print_func(*args, **kwargs):
-        kwargs['file'] = output
+        if not outputs:
+            if path == '-':
+                outputs.append(sys.stdout)
+            else:
+                outputs.append(codecs.open(path, 'w', encoding='utf-8'))
+        kwargs['file'] = outputs[0]
         print(*args, **kwargs)
     yield print_func
-    if path != '-':
-        output.close()
+    if outputs and path != '-':
+        outputs[0].close()
 
 
 class ListToolsAction(argparse.Action):
@@ -102,16 +144,39 @@ def main():
     if parsed_args.debug:
         logger.setLevel(logging.DEBUG)
     set_locale()
-    differences = debbindiff.comparators.compare_files(
-        parsed_args.file1, parsed_args.file2)
+    set_jobs(parsed_args.jobs)
+    set_max_dumps(parsed_args.max_dumps)
+    set_cache(parsed_args.cache_dir, parsed_args.cache_size)
+    set_diff_backend(parsed_args.diff_backend)
+    set_budget(parsed_args.max_runtime, parsed_args.max_memory)
+    set_profile(parsed_args.profile_output)
+    try:
+        return run(parsed_args)
+    finally:
+        if parsed_args.profile_output:
+            write_profile(parsed_args.profile_output)
+
+
+def run(parsed_args):
+    with make_printer(parsed_args.html_output) as html_print_func, \
+            make_printer(parsed_args.text_output) as text_print_func:
+        # differences are written as soon as they are found
+        presenters = []
+        if html_print_func:
+            presenters.append(HTMLPresenter(html_print_func, css_url=parsed_args.css_url,
+                                            max_page_size=parsed_args.max_report_size))
+        if text_print_func:
+            presenters.append(TextPresenter(text_print_func))
+        stream = set_presenters(presenters)
+        differences = debbindiff.comparators.compare_files(
+            parsed_args.file1, parsed_args.file2)
+        if presenters:
+            stream.finish(differences)
+    if cut_short_count():
+        logger.warning('%d comparisons were cut short by the budget',
+                       cut_short_count())
+        return 3
     if len(differences) > 0:
-        if parsed_args.html_output:
-            with make_printer(parsed_args.html_output) as print_func:
-                output_html(differences, css_url=parsed_args.css_url, print_func=print_func,
-                            max_page_size=parsed_args.max_report_size)
-        if parsed_args.text_output:
-            with make_printer(parsed_args.text_output) as print_func:
-                output_text(differences, print_func=print_func)
         return 1
     return 0
 
@@ -19,6 +19,7 @@
 
 import logging
 from distutils.spawn import find_executable
+from functools import wraps
 
 VERSION = "16"
 
@@ -76,9 +77,11 @@ def tool_required(command):
     tool_required.all.add(command)
     def wrapper(original_function):
         if find_executable(command):
+            @wraps(original_function)
             def tool_check(*args, **kwargs):
                 return original_function(*args, **kwargs)
         else:
+            @wraps(original_function)
             def tool_check(*args, **kwargs):
                 raise RequiredToolNotFound(command)
         return tool_check
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+#
+# debbindiff: highlight differences between two builds of Debian packages
+#
+# Copyright © 2015 Jérémy Bobbio <lunar@debian.org>
+#
+# debbindiff is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# debbindiff is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
+
+import resource
+import time
+from debbindiff import logger
+
+
+# A comparison can be given a time and a memory budget. Once most of it
+# has been used, compare_files() stops looking inside the files it is
+# given and only reports cheap summaries, so the report can still be
+# written before the run gets killed. The rest of the budget is left for
+# these summaries and for writing the reports.
+#
+# The deadline is shared by forked jobs. Memory is the resident size of
+# the process doing the comparison.
+
+LOW_BUDGET_RATIO = 0.8
+
+_start = None
+_max_runtime = None
+_max_memory = None
+# once the budget runs low, it stays low
+_low_reason = None
+# number of comparisons cut short so far, see cut_short_count()
+_cut_short = 0
+
+
+def set_budget(max_runtime=None, max_memory=None):
+    global _start, _max_runtime, _max_memory, _low_reason, _cut_short
+    _start = time.time()
+    _max_runtime = max_runtime
+    _max_memory = max_memory
+    _low_reason = None
+    _cut_short = 0
+
+
+def is_set():
+    return _max_runtime is not None or _max_memory is not None
+
+
+def memory_usage():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, ValueError, IndexError):
+        # peak size, in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def low_reason():
+    """Return why the budget runs low, or None if there is enough left"""
+    global _low_reason
+    if _low_reason is None:
+        if _max_runtime is not None and \
+           time.time() - _start >= _max_runtime * LOW_BUDGET_RATIO:
+            _low_reason = 'time'
+        elif _max_memory is not None and \
+             memory_usage() >= _max_memory * LOW_BUDGET_RATIO:
+            _low_reason = 'memory'
+        if _low_reason:
+            logger.warning('%s budget running low: comparisons will be cut short',
+                           _low_reason)
+    return _low_reason
+
+
+def is_exhausted():
+    return _max_runtime is not None and time.time() - _start >= _max_runtime
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+def check():
+    """Raise BudgetExceeded once the time or memory budget is used up.
+    Long running loops call this every now and then."""
+    if is_exhausted():
+        raise BudgetExceeded('time')
+    if _max_memory is not None and memory_usage() >= _max_memory:
+        raise BudgetExceeded('memory')
+
+
+def cut_short_comment():
+    return 'Comparison cut short (%s budget exceeded)' % low_reason()
+
+
+# Results holding cut short comparisons must not be cached. Comparators
+# compare the count before and after their work to know about it; forked
+# jobs send what they have added back with their results.
+
+def record_cut_short():
+    global _cut_short
+    _cut_short += 1
+
+
+def cut_short_count():
+    return _cut_short
+
+
+def add_cut_short(count):
+    global _cut_short
+    _cut_short += count
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+#
+# debbindiff: highlight differences between two builds of Debian packages
+#
+# Copyright © 2015 Jérémy Bobbio <lunar@debian.org>
+#
+# debbindiff is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# debbindiff is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
+
+import cPickle as pickle
+import hashlib
+import os
+import os.path
+import tempfile
+from distutils.spawn import find_executable
+from debbindiff import budget, logger, tool_required, VERSION
+from debbindiff.difference import get_diff_backend, set_snapshots
+
+
+DEFAULT_CACHE_SIZE = 2 ** 30  # 1 GiB
+
+# increase whenever what comparators return changes, so results stored by
+# a previous version are not reused
+CACHE_VERSION = 2
+
+
+def hash_file(path):
+    BUF_SIZE = 2 ** 20  # 1 MiB
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for buf in iter(lambda: f.read(BUF_SIZE), b''):
+            h.update(buf)
+    return h.hexdigest()
+
+
+# Container comparators hash their members while reading them. The digests
+# of the members they write to disk are recorded here, so computing cache
+# keys does not read them once more. A digest is only used while the size
+# and modification time of the file are the ones it was recorded with.
+_digests = {}
+
+
+def is_enabled():
+    return _cache is not None
+
+
+def record_digest(path, digest):
+    if _cache is None:
+        return
+    size, hexdigest = digest
+    st = os.stat(path)
+    if st.st_size == size:
+        _digests[path] = (st.st_size, st.st_mtime, hexdigest)
+
+
+def forget_digest(path):
+    _digests.pop(path, None)
+
+
+def forget_directory(directory):
+    prefix = os.path.join(directory, '')
+    for path in [path for path in _digests if path.startswith(prefix)]:
+        del _digests[path]
+
+
+def get_file_digest(path):
+    recorded = _digests.get(path)
+    if recorded is not None:
+        st = os.stat(path)
+        if recorded[:2] == (st.st_size, st.st_mtime):
+            return recorded[2]
+    return hash_file(path)
+
+
+# comparators fall back on binary diffs when their tools are missing
+def get_available_tools():
+    return sorted(command for command in getattr(tool_required, 'all', ())
+                  if find_executable(command))
+
+
+class ResultCache(object):
+    """Store the differences found between two files on disk
+
+    Results are indexed by the content of both files, the comparator used,
+    how the files are labelled in the report, debbindiff version, the diff
+    backend and the external tools available.
+    Least recently used entries are removed once the cache grows bigger
+    than `max_size` bytes.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_CACHE_SIZE):
+        self._directory = directory
+        self._max_size = max_size
+        self._size = None
+        self._tools = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, comparator, path1, path2, source, kwargs):
+        if self._tools is None:
+            self._tools = ' '.join(get_available_tools())
+        h = hashlib.sha256()
+        h.update('%d\0%s' % (CACHE_VERSION, VERSION))
+        h.update('\0%s\0%s' % (get_diff_backend(), self._tools))
+        h.update('\0%s.%s' % (comparator.__module__, comparator.__name__))
+        h.update('\0%s' % get_file_digest(path1))
+        h.update('\0%s' % get_file_digest(path2))
+        # labels end up in the report so they are part of the result
+        if source is None:
+            source = [path1, path2]
+        h.update('\0%r\0%r' % (source, sorted(kwargs.items())))
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self._directory, key[:2], key[2:])
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                differences = pickle.load(f)
+        except IOError:
+            return None
+        except Exception as e:
+            logger.warning('removing unreadable cache entry %s: %s', path, e)
+            self._remove(path)
+            return None
+        # mark entry as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return differences
+
+    def put(self, key, differences):
+        path = self._path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                # created by a parallel job
+                pass
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(differences, f, pickle.HIGHEST_PROTOCOL)
+            size = os.path.getsize(temp_path)
+            os.rename(temp_path, path)
+        except Exception:
+            self._remove(temp_path)
+            raise
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._entries())
+        else:
+            self._size += size
+        if self._size > self._max_size:
+            self._evict()
+
+    def _entries(self):
+        for dirpath, dirnames, filenames in os.walk(self._directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield path, st.st_size, st.st_mtime
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self._size = sum(size for _, size, _ in entries)
+        # leave some room so we don't have to do this on every write
+        target = self._max_size * 9 / 10
+        for path, size, _ in entries:
+            if self._size <= target:
+                break
+            logger.debug('evicting cache entry %s', path)
+            self._remove(path)
+            self._size -= size
+
+
+_cache = None
+
+
+def set_cache(directory, max_size=DEFAULT_CACHE_SIZE):
+    global _cache
+    _digests.clear()
+    if directory:
+        _cache = ResultCache(directory, max_size)
+    else:
+        _cache = None
+    # keep what is written to the reports so it can still be cached
+    set_snapshots(_cache is not None)
+
+
+def call_comparator(comparator, path1, path2, source=None, **kwargs):
+    if _cache is None:
+        return comparator(path1, path2, source=source, **kwargs)
+    key = _cache.key(comparator, path1, path2, source, kwargs)
+    differences = _cache.get(key)
+    if differences is not None:
+        logger.debug('cache hit for %s and %s', path1, path2)
+        return differences
+    cut_short = budget.cut_short_count()
+    differences = comparator(path1, path2, source=source, **kwargs)
+    # the ones cut short by the budget are incomplete
+    if budget.cut_short_count() == cut_short:
+        _cache.put(key, differences)
+    return differences
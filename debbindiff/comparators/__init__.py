@@ -22,8 +22,11 @@ import magic
 import os.path
 import re
 import sys
-from debbindiff import logger
-from debbindiff.comparators.binary import compare_binary_files
+from debbindiff import budget, logger
+from debbindiff.cache import call_comparator
+from debbindiff.profiling import span
+from debbindiff.comparators.binary import compare_binary_files, \
+    are_same_binaries
 from debbindiff.comparators.bzip2 import compare_bzip2_files
 from debbindiff.comparators.changes import compare_changes_files
 from debbindiff.comparators.cpio import compare_cpio_files
@@ -40,6 +43,7 @@ from debbindiff.comparators.pdf import compare_pdf_files
 from debbindiff.comparators.png import compare_png_files
 from debbindiff.comparators.rpm import compare_rpm_files
 from debbindiff.comparators.squashfs import compare_squashfs_files
+from debbindiff.comparators.summary import compare_summaries
 from debbindiff.comparators.text import compare_text_files
 from debbindiff.comparators.tar import compare_tar_files
 from debbindiff.comparators.xz import compare_xz_files
@@ -53,14 +57,17 @@ def guess_mime_type(path):
     return guess_mime_type.mimedb.file(path)
 
 
+CHARSET_RE = re.compile(r'; charset=([^ ]+)')
+
+
 def compare_unknown(path1, path2, source=None):
     logger.debug("compare unknown path: %s and %s", path1, path2)
-    mime_type1 = guess_mime_type(path1)
-    mime_type2 = guess_mime_type(path2)
+    mime_type1 = dispatcher.mime_type(path1)
+    mime_type2 = dispatcher.mime_type(path2)
     logger.debug("mime_type1: %s | mime_type2: %s", mime_type1, mime_type2)
     if mime_type1.startswith('text/') and mime_type2.startswith('text/'):
-        encodings1 = re.findall(r'; charset=([^ ]+)', mime_type1)
-        encodings2 = re.findall(r'; charset=([^ ]+)', mime_type2)
+        encodings1 = CHARSET_RE.findall(mime_type1)
+        encodings2 = CHARSET_RE.findall(mime_type2)
         if len(encodings1) > 0 and encodings1 == encodings2:
             encoding = encodings1[0]
         else:
@@ -98,11 +105,80 @@ COMPARATORS = [
     (r'^application/x-iso9660-image(;|$)', None, compare_iso9660_files)
     ]
 
-SMALL_FILE_THRESHOLD = 65536 # 64 kiB
+class Dispatcher(object):
+    """Find the comparator for a pair of files
+
+    Rules are tried in order, like COMPARATORS was always read: the first
+    rule matching both filenames or both mime types wins. Mime types are
+    only computed once a rule needs them, and are remembered per file.
+    """
+
+    MAX_MIME_TYPES = 100000
+
+    def __init__(self, rules):
+        self._rules = []
+        for mime_type_regex, filename_regex, comparator in rules:
+            self._rules.append((
+                mime_type_regex and re.compile(mime_type_regex),
+                filename_regex and re.compile(filename_regex),
+                comparator))
+        self._mime_types = {}
+
+    def mime_type(self, path):
+        st = os.stat(path)
+        # extracted files come and go: make sure a new file using the
+        # same inode is not taken for the previous one
+        key = (st.st_dev, st.st_ino, st.st_mtime, st.st_ctime, st.st_size)
+        mime_type = self._mime_types.get(key)
+        if mime_type is None:
+            if len(self._mime_types) >= Dispatcher.MAX_MIME_TYPES:
+                self._mime_types.clear()
+            with span('libmagic', 'mime', path=path):
+                mime_type = guess_mime_type(path)
+            self._mime_types[key] = mime_type
+        return mime_type
+
+    def lookup(self, path1, path2):
+        """Return the comparator, its extra arguments and the index of the
+        matching rule (None when no rule matched)"""
+        mime_types = None
+        for index, (mime_type_re, filename_re, comparator) in enumerate(self._rules):
+            if filename_re and filename_re.search(path1) \
+               and filename_re.search(path2):
+                return comparator, {}, index
+            if mime_type_re:
+                if mime_types is None:
+                    mime_types = (self.mime_type(path1), self.mime_type(path2))
+                match1 = mime_type_re.search(mime_types[0])
+                match2 = mime_type_re.search(mime_types[1])
+                if match1 and match2 and match1.groupdict() == match2.groupdict():
+                    return comparator, match1.groupdict(), index
+        return compare_unknown, {}, None
+
+    def describe(self, index):
+        if index is None:
+            return 'no rule matched'
+        mime_type_re, filename_re, comparator = self._rules[index]
+        return 'rule %d (%s, %s)' % (
+            index,
+            mime_type_re and mime_type_re.pattern,
+            filename_re and filename_re.pattern)
+
+
+dispatcher = Dispatcher(COMPARATORS)
 
 
 def compare_files(path1, path2, source=None):
+    with span('compare_files', 'compare', path1=path1, path2=path2) as s:
+        return _compare_files(path1, path2, source, s)
+
+
+def _compare_files(path1, path2, source, s):
     if os.path.isdir(path1) and os.path.isdir(path2):
+        if budget.low_reason():
+            s.name = compare_summaries.__name__
+            return compare_summaries(path1, path2, source)
+        s.name = compare_directories.__name__
         return compare_directories(path1, path2, source)
     if not os.path.isfile(path1):
         logger.critical("%s is not a file", path1)
@@ -110,22 +186,14 @@ def compare_files(path1, path2, source=None):
     if not os.path.isfile(path2):
         logger.critical("%s is not a file", path2)
         sys.exit(2)
-    # try comparing small files directly first
-    size1 = os.path.getsize(path1)
-    size2 = os.path.getsize(path2)
-    if size1 == size2 and size1 <= SMALL_FILE_THRESHOLD:
-        if file(path1).read() == file(path2).read():
-            return []
+    if budget.low_reason():
+        s.name = compare_summaries.__name__
+        return compare_summaries(path1, path2, source)
+    if are_same_binaries(path1, path2):
+        return []
     # ok, let's do the full thing
-    mime_type1 = guess_mime_type(path1)
-    mime_type2 = guess_mime_type(path2)
-    for mime_type_regex, filename_regex, comparator in COMPARATORS:
-        if filename_regex and re.search(filename_regex, path1) \
-           and re.search(filename_regex, path2):
-            return comparator(path1, path2, source)
-        if mime_type_regex:
-            match1 = re.search(mime_type_regex, mime_type1)
-            match2 = re.search(mime_type_regex, mime_type2)
-            if match1 and match2 and match1.groupdict() == match2.groupdict():
-                return comparator(path1, path2, source=source, **match1.groupdict())
-    return compare_unknown(path1, path2, source)
+    comparator, kwargs, index = dispatcher.lookup(path1, path2)
+    logger.debug('%s for %s and %s: %s', comparator.__name__,
+                 path1, path2, dispatcher.describe(index))
+    s.name = comparator.__name__
+    return call_comparator(comparator, path1, path2, source=source, **kwargs)
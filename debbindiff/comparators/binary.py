@@ -18,16 +18,66 @@
 # along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
 
 from binascii import hexlify
+from bisect import bisect_left
 from contextlib import contextmanager
+import mmap
+import os.path
 import subprocess
-from debbindiff.difference import Difference
-from debbindiff import tool_required, RequiredToolNotFound
+import zlib
+from debbindiff.difference import Difference, MAX_DIFF_INPUT_LINES
+from debbindiff import logger, tool_required, RequiredToolNotFound
+
+
+def common_prefix_length(buf1, buf2):
+    low, high = 0, min(len(buf1), len(buf2))
+    # buf1[:low] == buf2[:low] and the first difference is before high
+    while low < high:
+        middle = (low + high + 1) / 2
+        if buf1[low:middle] == buf2[low:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def first_difference(path1, path2):
+    """Return the offset of the first byte that differs between the two
+    files, or None if they have the same content"""
+    BUF_SIZE = 2 ** 20  # 1 MiB
+    offset = 0
+    with open(path1, 'rb') as f1, open(path2, 'rb') as f2:
+        while True:
+            buf1 = f1.read(BUF_SIZE)
+            buf2 = f2.read(BUF_SIZE)
+            if buf1 != buf2:
+                return offset + common_prefix_length(buf1, buf2)
+            if not buf1:
+                return None
+            offset += len(buf1)
+
+
+def are_same_binaries(path1, path2):
+    if os.path.getsize(path1) != os.path.getsize(path2):
+        return False
+    return first_difference(path1, path2) is None
+
+
+# Hexdumps start a few lines before the first difference: identical data
+# before it would only be cut out by diff.
+HEXDUMP_CONTEXT_LINES = 7
+
+
+def hexdump_start(offset, line_size):
+    return max(0, (offset / line_size - HEXDUMP_CONTEXT_LINES) * line_size)
 
 
 @contextmanager
 @tool_required('xxd')
-def xxd(path):
-    p = subprocess.Popen(['xxd', path], shell=False, stdout=subprocess.PIPE,
+def xxd(path, start=0):
+    cmd = ['xxd', path]
+    if start:
+        cmd[1:1] = ['-s', str(start)]
+    p = subprocess.Popen(cmd, shell=False, stdout=subprocess.PIPE,
                          stderr=subprocess.PIPE, close_fds=True)
     yield p.stdout
     p.stdout.close()
@@ -37,23 +87,263 @@ def xxd(path):
     p.wait()
 
 
-def hexdump_fallback(path):
+def hexdump_fallback(path, start=0):
     hexdump = ''
     with open(path) as f:
+        f.seek(start)
         for buf in iter(lambda: f.read(32), b''):
             hexdump += u'%s\n' % hexlify(buf)
     return hexdump
 
 
+# Hexdumps of xxd have 16 bytes per line. Above MAX_DIFF_INPUT_LINES lines,
+# diffing them gets slow, and data that moved makes every line that follows
+# differ. When more data than that follows the first difference, the
+# differing regions are found by block matching instead and only a window
+# around each of them is dumped.
+BLOCK_DELTA_MIN_SIZE = MAX_DIFF_INPUT_LINES * 16
+DELTA_BLOCK_SIZE = 4096
+# the index of the blocks of the first file is kept under this many entries
+DELTA_MAX_BLOCKS = 2 ** 18
+# how many bytes can be searched byte by byte for moved data before the
+# rest of the files is reported as a single region
+DELTA_MAX_SCAN = 8 * 2 ** 20
+DELTA_CHUNK = 2 ** 20
+DELTA_HEXDUMP_CONTEXT = 32
+DELTA_HEXDUMP_MAX = 256
+MAX_DELTA_HEXDUMPS = 100
+MAX_LISTED_REGIONS = 1000
+# in blocks
+DELTA_IN_PLACE_DISTANCES = (1, 2, 4, 8, 16)
+ADLER_MOD = 65521
+
+
+def common_suffix_length(buf1, buf2):
+    return common_prefix_length(buf1[::-1], buf2[::-1])
+
+
+def matching_length(data1, offset1, data2, offset2):
+    """Return how many bytes are the same from offset1 and offset2"""
+    # start small as differences are often close to each other
+    size = DELTA_BLOCK_SIZE
+    length = 0
+    while True:
+        same = common_prefix_length(data1[offset1 + length:offset1 + length + size],
+                                    data2[offset2 + length:offset2 + length + size])
+        length += same
+        if same < size:
+            return length
+        size = min(size * 2, DELTA_CHUNK)
+
+
+@contextmanager
+def open_mmap(path):
+    with open(path, 'rb') as f:
+        # empty files can't be mapped
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b''
+            return
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield m
+        finally:
+            m.close()
+
+
+def adler32(data):
+    return zlib.adler32(data) & 0xffffffff
+
+
+# Find where the data of the second file is in the first one, in the style
+# of rsync: the first file is split into blocks, indexed by their Adler-32
+# checksum, and the checksum of a window sliding over the second file is
+# updated for every byte and looked up in the index.
+class BlockMatcher(object):
+    def __init__(self, data1, data2):
+        self._data1 = data1
+        self._data2 = data2
+        self._block_size = max(DELTA_BLOCK_SIZE, len(data1) / DELTA_MAX_BLOCKS)
+        self._index = None
+        self._scanned = 0
+
+    @property
+    def block_size(self):
+        return self._block_size
+
+    def _build_index(self):
+        self._index = {}
+        block_size = self._block_size
+        for offset in xrange(0, len(self._data1) - block_size + 1, block_size):
+            checksum = adler32(self._data1[offset:offset + block_size])
+            self._index.setdefault(checksum, []).append(offset)
+
+    def _lookup(self, checksum, offset1, offset2):
+        offsets = self._index.get(checksum)
+        if not offsets:
+            return None
+        block_size = self._block_size
+        block2 = self._data2[offset2:offset2 + block_size]
+        for offset in offsets[bisect_left(offsets, offset1):]:
+            if self._data1[offset:offset + block_size] == block2:
+                return offset
+        return None
+
+    def find(self, offset1, offset2):
+        """Return the offsets of the first block of the second file at or
+        after offset2 that is also in the first file at or after offset1,
+        or None"""
+        if self._index is None:
+            self._build_index()
+        index = self._index
+        block_size = self._block_size
+        data2 = self._data2
+        start = offset2
+        # moved data is usually found quickly: start with a small window
+        size = 4 * block_size
+        while start + block_size <= len(data2):
+            if self._scanned >= DELTA_MAX_SCAN:
+                logger.debug('giving up block matching at offset %d', start)
+                return None
+            window = bytearray(data2[start:start + size + block_size])
+            checksum = adler32(bytes(window[:block_size]))
+            a, b = checksum & 0xffff, checksum >> 16
+            end = len(window) - block_size
+            for i in xrange(end + 1):
+                checksum = (b << 16) | a
+                if checksum in index:
+                    found = self._lookup(checksum, offset1, start + i)
+                    if found is not None:
+                        self._scanned += i
+                        return found, start + i
+                if i == end:
+                    break
+                out, new = window[i], window[i + block_size]
+                a = (a - out + new) % ADLER_MOD
+                b = (b - block_size * out + a - 1) % ADLER_MOD
+            self._scanned += end + 1
+            start += end + 1
+            size = min(size * 2, DELTA_CHUNK)
+        return None
+
+    def in_place(self, offset1, offset2):
+        """Return how far the data is the same again at the same distance
+        in both files, or None"""
+        block_size = self._block_size
+        for distance in DELTA_IN_PLACE_DISTANCES:
+            distance *= block_size
+            block1 = self._data1[offset1 + distance:offset1 + distance + block_size]
+            if len(block1) < block_size:
+                return None
+            if block1 == self._data2[offset2 + distance:offset2 + distance + block_size]:
+                return distance
+        return None
+
+
+def get_differing_regions(data1, data2, start=0):
+    """Return the (offset1, length1, offset2, length2) of all the regions
+    that differ between the two buffers. Data before `start` is known to
+    be identical."""
+    matcher = BlockMatcher(data1, data2)
+    block_size = matcher.block_size
+    regions = []
+    offset1 = offset2 = start
+    while offset1 < len(data1) and offset2 < len(data2):
+        same = matching_length(data1, offset1, data2, offset2)
+        if same:
+            offset1 += same
+            offset2 += same
+            continue
+        region1, region2 = offset1, offset2
+        # changed in place: most differences in builds are timestamps,
+        # paths, or build ids which do not move the data that follows
+        distance = matcher.in_place(offset1, offset2)
+        if distance:
+            end1, end2 = offset1 + distance, offset2 + distance
+        else:
+            found = matcher.find(offset1, offset2)
+            if found is None:
+                break
+            end1, end2 = found
+        # identical data found just before the block that matches
+        back = common_suffix_length(data1[max(region1, end1 - block_size):end1],
+                                    data2[max(region2, end2 - block_size):end2])
+        offset1, offset2 = end1 - back, end2 - back
+        regions.append((region1, offset1 - region1, region2, offset2 - region2))
+    if offset1 < len(data1) or offset2 < len(data2):
+        back = common_suffix_length(data1[max(offset1, len(data1) - block_size):],
+                                    data2[max(offset2, len(data2) - block_size):])
+        regions.append((offset1, len(data1) - back - offset1,
+                        offset2, len(data2) - back - offset2))
+    return regions
+
+
+# same format as xxd
+def format_hexdump(data, offset):
+    lines = []
+    for start in xrange(0, len(data), 16):
+        buf = data[start:start + 16]
+        hexa = hexlify(buf)
+        groups = ' '.join(hexa[i:i + 4] for i in xrange(0, len(hexa), 4))
+        text = ''.join(c if 32 <= ord(c) < 127 else '.' for c in buf)
+        lines.append(u'%08x: %-39s  %s\n' % (offset + start, groups, text))
+    return u''.join(lines)
+
+
+def get_region_hexdump(data, offset, length):
+    start = max(0, offset - DELTA_HEXDUMP_CONTEXT) / 16 * 16
+    end = (offset + min(length, DELTA_HEXDUMP_MAX) + DELTA_HEXDUMP_CONTEXT + 15) / 16 * 16
+    end = min(len(data), end)
+    hexdump = format_hexdump(data[start:end], start)
+    if length > DELTA_HEXDUMP_MAX:
+        hexdump += u'[ %d bytes not shown ]\n' % (length - DELTA_HEXDUMP_MAX)
+    return hexdump
+
+
+def compare_binary_deltas(path1, path2, source, start):
+    with open_mmap(path1) as data1:
+        with open_mmap(path2) as data2:
+            regions = get_differing_regions(data1, data2, start)
+            hexdump1 = []
+            hexdump2 = []
+            for offset1, length1, offset2, length2 in regions[:MAX_DELTA_HEXDUMPS]:
+                hexdump1.append(u'[ region at offset %d, %d bytes ]\n' % (offset1, length1))
+                hexdump1.append(get_region_hexdump(data1, offset1, length1))
+                hexdump2.append(u'[ region at offset %d, %d bytes ]\n' % (offset2, length2))
+                hexdump2.append(get_region_hexdump(data2, offset2, length2))
+    comment = '%d differing regions found by block matching ' \
+              '(offset, length):\n' % len(regions)
+    for offset1, length1, offset2, length2 in regions[:MAX_LISTED_REGIONS]:
+        comment += '  %d, %d vs. %d, %d\n' % (offset1, length1, offset2, length2)
+    if len(regions) > MAX_LISTED_REGIONS:
+        comment += '  [ %d more regions ]\n' % (len(regions) - MAX_LISTED_REGIONS)
+    if len(regions) > MAX_DELTA_HEXDUMPS:
+        comment += 'Only the first %d regions are shown.' % MAX_DELTA_HEXDUMPS
+    return Difference.from_unicode(u''.join(hexdump1), u''.join(hexdump2),
+                                   path1, path2, source, comment.rstrip('\n'))
+
+
 def compare_binary_files(path1, path2, source=None):
+    offset = first_difference(path1, path2)
+    if offset is None:
+        return []
+    size = max(os.path.getsize(path1), os.path.getsize(path2))
+    if size - hexdump_start(offset, 16) > BLOCK_DELTA_MIN_SIZE:
+        difference = compare_binary_deltas(path1, path2, source, offset)
+        if not difference:
+            return []
+        return [difference]
     try:
-        with xxd(path1) as xxd1:
-            with xxd(path2) as xxd2:
+        start = hexdump_start(offset, 16)
+        with xxd(path1, start) as xxd1:
+            with xxd(path2, start) as xxd2:
                 difference = Difference.from_file(xxd1, xxd2, path1, path2, source)
     except RequiredToolNotFound:
-        hexdump1 = hexdump_fallback(path1)
-        hexdump2 = hexdump_fallback(path2)
+        start = hexdump_start(offset, 32)
+        hexdump1 = hexdump_fallback(path1, start)
+        hexdump2 = hexdump_fallback(path2, start)
         comment = 'xxd not available in path. Falling back to Python hexlify.\n'
+        if start:
+            comment += 'Hexdump starts at offset %d, data before is identical.\n' % start
         difference = Difference.from_unicode(hexdump1, hexdump2, path1, path2, source, comment)
     if not difference:
         return []
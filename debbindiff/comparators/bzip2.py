@@ -17,34 +17,72 @@
 # You should have received a copy of the GNU General Public License
 # along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
 
+import bz2
 from contextlib import contextmanager
-import os.path
-import subprocess
-import debbindiff.comparators
-from debbindiff.comparators.utils import binary_fallback, make_temp_directory
-from debbindiff.difference import get_source
-from debbindiff import tool_required
+from debbindiff.comparators.utils import binary_fallback, \
+    compare_decompressed_files, DecompressionError
 
 
-@contextmanager
-@tool_required('bzip2')
-def decompress_bzip2(path):
-    with make_temp_directory() as temp_dir:
-        if path.endswith('.bz2'):
-            temp_path = os.path.join(temp_dir, os.path.basename(path[:-4]))
+# bz2.BZ2File stops after the first stream but parallel compressors like
+# pbzip2 write several of them one after the other
+class BZ2Reader(object):
+    BUF_SIZE = 2 ** 16  # 64 kiB of compressed data at a time
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._decompressor = bz2.BZ2Decompressor()
+        self._buffer = b''
+        self._offset = 0
+        self._eof = False
+
+    def _stream_ended(self):
+        # a decompressor refuses any input once its stream has ended
+        try:
+            self._decompressor.decompress(b'')
+        except EOFError:
+            return True
+        return False
+
+    def _fill(self):
+        data = self._decompressor.unused_data or \
+            self._fileobj.read(BZ2Reader.BUF_SIZE)
+        if self._stream_ended():
+            if not data:
+                self._eof = True
+                return
+            self._decompressor = bz2.BZ2Decompressor()
+        elif not data:
+            raise EOFError('compressed file ended before the end-of-stream marker was reached')
+        self._buffer = self._buffer[self._offset:] + self._decompressor.decompress(data)
+        self._offset = 0
+
+    def read(self, size=-1):
+        while not self._eof and \
+                (size < 0 or len(self._buffer) - self._offset < size):
+            self._fill()
+        if size < 0:
+            end = len(self._buffer)
         else:
-            temp_path = os.path.join(temp_dir, "%s-content" % path)
-        with open(temp_path, 'wb') as temp_file:
-            subprocess.check_call(
-                ["bzip2", "--decompress", "--stdout", path],
-                shell=False, stdout=temp_file, stderr=None)
-            yield temp_path
+            end = self._offset + size
+        data = self._buffer[self._offset:end]
+        self._offset += len(data)
+        return data
+
+
+@contextmanager
+def open_bzip2(path):
+    try:
+        with open(path, 'rb') as fileobj:
+            yield BZ2Reader(fileobj)
+    except IOError as e:
+        # errors from the bz2 module have no errno
+        if e.errno is not None:
+            raise
+        raise DecompressionError(path, e)
+    except EOFError as e:
+        raise DecompressionError(path, e)
 
 
 @binary_fallback
 def compare_bzip2_files(path1, path2, source=None):
-    with decompress_bzip2(path1) as new_path1:
-        with decompress_bzip2(path2) as new_path2:
-            return debbindiff.comparators.compare_files(
-                new_path1, new_path2,
-                source=[os.path.basename(new_path1), os.path.basename(new_path2)])
+    return compare_decompressed_files(path1, path2, open_bzip2, '.bz2')
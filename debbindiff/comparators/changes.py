@@ -20,8 +20,9 @@
 import sys
 from debbindiff import logger
 from debbindiff.changes import Changes
-import debbindiff.comparators
+from debbindiff.comparators.utils import MemberQueue
 from debbindiff.difference import Difference, get_source
+from debbindiff.streaming import get_stream
 
 
 DOT_CHANGES_FIELDS = [
@@ -75,18 +76,25 @@ def compare_changes_files(path1, path2, source=None):
     files1 = dict([(d['name'], d) for d in files1])
     files2 = dict([(d['name'], d) for d in files2])
 
-    for filename in sorted(set(files1.keys()).intersection(files2.keys())):
-        d1 = files1[filename]
-        d2 = files2[filename]
-        if d1['md5sum'] != d2['md5sum']:
-            logger.debug("%s mentioned in .changes have "
-                         "differences", filename)
-            files_difference.add_details(
-                debbindiff.comparators.compare_files(
-                    dot_changes1.get_path(filename),
-                    dot_changes2.get_path(filename),
-                    source=get_source(dot_changes1.get_path(filename),
-                                      dot_changes2.get_path(filename))))
+    # the fields come first in the report, then the files
+    stream = get_stream()
+    stream.set_pending(differences)
+    entry = stream.open(files_difference)
+    try:
+        queue = MemberQueue()
+        for filename in sorted(set(files1.keys()).intersection(files2.keys())):
+            d1 = files1[filename]
+            d2 = files2[filename]
+            if d1['md5sum'] != d2['md5sum']:
+                logger.debug("%s mentioned in .changes have "
+                             "differences", filename)
+                queue.compare(dot_changes1.get_path(filename),
+                              dot_changes2.get_path(filename),
+                              get_source(dot_changes1.get_path(filename),
+                                         dot_changes2.get_path(filename)))
+        files_difference.add_details(queue.differences())
+    finally:
+        stream.close(entry, files_difference)
 
     differences.append(files_difference)
     return differences
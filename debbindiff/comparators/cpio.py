@@ -17,61 +17,329 @@
 # You should have received a copy of the GNU General Public License
 # along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
 
-import subprocess
+from contextlib import contextmanager
+import hashlib
+import os
 import os.path
-import debbindiff.comparators
+import stat
+import subprocess
+import time
 from debbindiff import logger, tool_required
-from debbindiff.comparators.utils import binary_fallback, make_temp_directory, Command
+from debbindiff.comparators.binary import are_same_binaries, \
+    compare_binary_files
+from debbindiff.comparators.bzip2 import open_bzip2
+from debbindiff.comparators.directory import format_mode, get_user_name, \
+    get_group_name
+from debbindiff.comparators.gzip import open_gzip
+from debbindiff.comparators.utils import \
+    binary_fallback, make_temp_directory, MemberQueue, extract_fileobj, \
+    ExtentReader, Command, decompress_file
+from debbindiff.comparators.xz import open_xz
 from debbindiff.difference import Difference
 
+
+# Archives are read in-process, in a single pass. Only the "new" (newc and
+# crc) and the portable ASCII (odc) formats are understood: they are the
+# ones written by the kernel build, rpm and GNU cpio by default. Archives
+# in the old binary format are handed to GNU cpio. Compressed archives, as
+# initrds often are, are decompressed first.
+
+class CpioError(Exception):
+    pass
+
+
+class UnsupportedCpioFormat(CpioError):
+    pass
+
+
+NEWC_MAGICS = ('070701', '070702')
+ODC_MAGIC = '070707'
+# the old binary format, in either byte order
+BINARY_MAGICS = ('\xc7\x71', '\x71\xc7')
+TRAILER = 'TRAILER!!!'
+
+COMPRESSIONS = [
+    ('\x1f\x8b', open_gzip, '.gz'),
+    ('BZh', open_bzip2, '.bz2'),
+    ('\xfd7zXZ\x00', open_xz, '.xz'),
+    ]
+
+
+class CpioMember(object):
+    def __init__(self, name, mode, uid, gid, nlink, mtime, size, rdev, ino):
+        self.name = name
+        self.mode = mode
+        self.uid = uid
+        self.gid = gid
+        self.nlink = nlink
+        self.mtime = mtime
+        self.size = size
+        self.rdev = rdev
+        # identifies hard links
+        self.ino = ino
+        # where the content is: hard links can share it with another member
+        self.offset = None
+        self.data_size = size
+        self.digest = None
+        self.link_name = None
+
+
+def read_name(f, namesize):
+    name = f.read(namesize)
+    if len(name) != namesize:
+        raise CpioError('truncated header')
+    # without the terminating NUL
+    return name[:-1]
+
+
+def read_newc_header(f):
+    header = f.read(104)
+    if len(header) != 104:
+        raise CpioError('truncated header')
+    try:
+        (ino, mode, uid, gid, nlink, mtime, size, devmajor, devminor,
+         rdevmajor, rdevminor, namesize, _) = \
+            [int(header[i:i + 8], 16) for i in xrange(0, 104, 8)]
+    except ValueError:
+        raise CpioError('invalid header')
+    name = read_name(f, namesize)
+    # header and name are padded to a multiple of 4 bytes
+    f.read((4 - (110 + namesize) % 4) % 4)
+    member = CpioMember(name, mode, uid, gid, nlink, mtime, size,
+                        (rdevmajor, rdevminor), (devmajor, devminor, ino))
+    return member, (4 - size % 4) % 4
+
+
+def read_odc_header(f):
+    header = f.read(70)
+    if len(header) != 70:
+        raise CpioError('truncated header')
+    try:
+        dev, ino, mode, uid, gid, nlink, rdev = \
+            [int(header[i:i + 6], 8) for i in xrange(0, 42, 6)]
+        mtime = int(header[42:53], 8)
+        namesize = int(header[53:59], 8)
+        size = int(header[59:70], 8)
+    except ValueError:
+        raise CpioError('invalid header')
+    name = read_name(f, namesize)
+    member = CpioMember(name, mode, uid, gid, nlink, mtime, size,
+                        (os.major(rdev), os.minor(rdev)), (dev, ino))
+    return member, 0
+
+
+def read_cpio_members(f):
+    BUF_SIZE = 2 ** 20  # 1 MiB
+    members = []
+    while True:
+        magic = f.read(6)
+        if magic in NEWC_MAGICS:
+            member, padding = read_newc_header(f)
+        elif magic == ODC_MAGIC:
+            member, padding = read_odc_header(f)
+        elif not members and magic[:2] in BINARY_MAGICS:
+            raise UnsupportedCpioFormat('old binary format')
+        elif len(magic) < 6:
+            raise CpioError('truncated archive')
+        else:
+            raise CpioError('invalid header')
+        if member.name == TRAILER:
+            break
+        member.offset = f.tell()
+        if stat.S_ISREG(member.mode):
+            h = hashlib.sha256()
+            left = member.size
+            while left > 0:
+                buf = f.read(min(left, BUF_SIZE))
+                if not buf:
+                    raise CpioError('truncated member')
+                h.update(buf)
+                left -= len(buf)
+            member.digest = h.hexdigest()
+        elif stat.S_ISLNK(member.mode):
+            member.link_name = f.read(member.size)
+            if len(member.link_name) != member.size:
+                raise CpioError('truncated member')
+        else:
+            f.seek(member.size, os.SEEK_CUR)
+        f.seek(padding, os.SEEK_CUR)
+        members.append(member)
+    # newc archives store the content of hard links with the last of them
+    links = {}
+    for member in members:
+        if stat.S_ISREG(member.mode) and member.nlink > 1 and member.size > 0:
+            links[member.ino] = member
+    for member in members:
+        if stat.S_ISREG(member.mode) and member.nlink > 1 and member.size == 0 \
+           and member.ino in links:
+            target = links[member.ino]
+            member.offset, member.data_size, member.digest = \
+                target.offset, target.size, target.digest
+    return members
+
+
+SIX_MONTHS = 6 * 30 * 24 * 60 * 60
+
+
+# same as `cpio -tv`
+def get_cpio_listing(members):
+    now = time.time()
+    lines = []
+    for member in members:
+        line = '%s %3d %-8.8s %-8.8s ' % (
+            format_mode(member.mode), member.nlink,
+            get_user_name(member.uid) or member.uid,
+            get_group_name(member.gid) or member.gid)
+        if stat.S_ISCHR(member.mode) or stat.S_ISBLK(member.mode):
+            line += '%3d, %3d ' % member.rdev
+        else:
+            line += '%8d ' % member.size
+        when = time.ctime(member.mtime)
+        if not 0 <= now - member.mtime <= SIX_MONTHS:
+            # show the year instead of the time of day
+            when = when[:11] + when[19:]
+        line += '%s %s' % (when[4:16], member.name)
+        if member.link_name is not None:
+            line += ' -> %s' % member.link_name
+        lines.append(line)
+    return ''.join('%s\n' % line for line in lines).decode('utf-8', 'replace')
+
+
 class CpioContent(Command):
     @tool_required('cpio')
     def cmdline(self):
-        return ['cpio', '-tvF', self.path]
+        return ['cpio', '--quiet', '-tvF', self.path]
 
 
 @tool_required('cpio')
 def get_cpio_names(path):
     cmd = ['cpio', '--quiet', '-tF', path]
-    return subprocess.check_output(cmd, stderr=subprocess.PIPE, shell=False)
+    return subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=False)
 
 
 @tool_required('cpio')
 def extract_cpio_archive(path, destdir):
     cmd = ['cpio', '--no-absolute-filenames', '--quiet', '-idF',
-            os.path.abspath(path.encode('utf-8'))]
-    logger.debug("extracting %s into %s", path.encode('utf-8'), destdir)
-    p = subprocess.Popen(cmd, shell=False, cwd=destdir)
-    p.communicate()
-    p.wait()
+           os.path.abspath(path)]
+    logger.debug("extracting %s into %s", path, destdir)
+    p = subprocess.Popen(cmd, shell=False, cwd=destdir,
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = p.communicate()[0]
     if p.returncode != 0:
-        logger.error('cpio exited with error code %d', p.returncode)
+        raise subprocess.CalledProcessError(p.returncode, cmd, output=output)
 
 
-@binary_fallback
-def compare_cpio_files(path1, path2, source=None):
+def compare_cpio_archives_with_tool(archive1, archive2, path1, path2):
     differences = []
-
     difference = Difference.from_command(
-                     CpioContent, path1, path2, source="file list")
+                     CpioContent, archive1, archive2, source="file list")
     if difference:
         differences.append(difference)
-
-    # compare files contained in archive
-    content1 = get_cpio_names(path1)
-    content2 = get_cpio_names(path2)
+    names1 = get_cpio_names(archive1).splitlines()
+    names2 = get_cpio_names(archive2).splitlines()
     with make_temp_directory() as temp_dir1:
         with make_temp_directory() as temp_dir2:
-            extract_cpio_archive(path1, temp_dir1)
-            extract_cpio_archive(path2, temp_dir2)
-            files1 = content1.splitlines(1)
-            files2 = content2.splitlines(1)
-            for member in sorted(set(files1).intersection(set(files2))):
-                in_path1 = os.path.join(temp_dir1, member)
-                in_path2 = os.path.join(temp_dir2, member)
-                if not os.path.isfile(in_path1) or not os.path.isfile(in_path2):
+            extract_cpio_archive(archive1, temp_dir1)
+            extract_cpio_archive(archive2, temp_dir2)
+            queue = MemberQueue(differences)
+            for name in sorted(set(names1).intersection(names2)):
+                in_path1 = os.path.join(temp_dir1, name)
+                in_path2 = os.path.join(temp_dir2, name)
+                if not os.path.isfile(in_path1) or os.path.islink(in_path1) or \
+                   not os.path.isfile(in_path2) or os.path.islink(in_path2):
                     continue
-                differences.extend(debbindiff.comparators.compare_files(
-                    in_path1, in_path2, source=member))
+                if are_same_binaries(in_path1, in_path2):
+                    continue
+                queue.compare(in_path1, in_path2, name)
+            differences.extend(queue.differences())
+    return differences
+
+
+def read_cpio_archive(archive, path):
+    try:
+        return read_cpio_members(archive)
+    except UnsupportedCpioFormat:
+        raise
+    except CpioError as e:
+        raise CpioError('unable to read %s: %s' % (path, e))
+
+
+def compare_cpio_archives(archive_path1, archive_path2, path1, path2, source):
+    differences = []
+    with open(archive_path1, 'rb') as archive1:
+        with open(archive_path2, 'rb') as archive2:
+            try:
+                members1 = read_cpio_archive(archive1, path1)
+                members2 = read_cpio_archive(archive2, path2)
+            except UnsupportedCpioFormat as e:
+                logger.debug('%s: using cpio to read %s and %s', e, path1, path2)
+                return compare_cpio_archives_with_tool(
+                    archive_path1, archive_path2, path1, path2)
+            except CpioError as e:
+                difference = compare_binary_files(path1, path2, source=source)[0]
+                difference.comment = (difference.comment or '') + \
+                    'Unable to read the content of the archives: %s' % e
+                return [difference]
+
+            listing1 = get_cpio_listing(members1)
+            listing2 = get_cpio_listing(members2)
+            if listing1 != listing2:
+                difference = Difference.from_unicode(
+                                 listing1, listing2, path1, path2, source="file list")
+                if difference:
+                    differences.append(difference)
+
+            # compare files contained in archive
+            files1 = dict((m.name, m) for m in members1 if stat.S_ISREG(m.mode))
+            files2 = dict((m.name, m) for m in members2 if stat.S_ISREG(m.mode))
+            with make_temp_directory() as temp_dir1:
+                with make_temp_directory() as temp_dir2:
+                    queue = MemberQueue(differences)
+                    for name in sorted(set(files1).intersection(files2)):
+                        member1 = files1[name]
+                        member2 = files2[name]
+                        # only members that differ are written to disk
+                        if (member1.data_size, member1.digest) == \
+                           (member2.data_size, member2.digest):
+                            continue
+                        if queue.cut_short(name):
+                            continue
+                        logger.debug('extract member %s', name)
+                        in_path1 = extract_fileobj(
+                            ExtentReader(archive1, [(member1.offset, member1.data_size)]),
+                            temp_dir1, name)
+                        in_path2 = extract_fileobj(
+                            ExtentReader(archive2, [(member2.offset, member2.data_size)]),
+                            temp_dir2, name)
+                        queue.compare(in_path1, in_path2, name, cleanup=True)
+                    differences.extend(queue.differences())
 
     return differences
+
+
+def get_compression(path):
+    with open(path, 'rb') as f:
+        head = f.read(6)
+    for magic, open_func, extension in COMPRESSIONS:
+        if head.startswith(magic):
+            return open_func, extension
+    return None
+
+
+@contextmanager
+def open_archive(path):
+    """Give the path of the archive, decompressed if needed"""
+    compression = get_compression(path)
+    if compression is None:
+        yield path
+        return
+    with decompress_file(compression[0], path, compression[1]) as archive_path:
+        yield archive_path
+
+
+@binary_fallback
+def compare_cpio_files(path1, path2, source=None):
+    with open_archive(path1) as archive_path1:
+        with open_archive(path2) as archive_path2:
+            return compare_cpio_archives(archive_path1, archive_path2,
+                                         path1, path2, source)
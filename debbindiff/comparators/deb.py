@@ -17,13 +17,13 @@
 # You should have received a copy of the GNU General Public License
 # along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
 
-import os.path
 from debian.arfile import ArFile
 from debbindiff import logger
 from debbindiff.difference import Difference, get_source
-import debbindiff.comparators
+from debbindiff.comparators.binary import are_same_binaries
 from debbindiff.comparators.utils import \
-    binary_fallback, make_temp_directory, are_same_binaries, get_ar_content
+    binary_fallback, make_temp_directory, get_ar_content, \
+    get_fileobj_digest, extract_fileobj, MemberQueue
 
 
 @binary_fallback
@@ -36,22 +36,32 @@ def compare_deb_files(path1, path2, source=None):
         with make_temp_directory() as temp_dir2:
             logger.debug('content1 %s', ar1.getnames())
             logger.debug('content2 %s', ar2.getnames())
+            queue = MemberQueue()
             for name in sorted(set(ar1.getnames())
                                .intersection(ar2.getnames())):
-                logger.debug('extract member %s', name)
                 member1 = ar1.getmember(name)
                 member2 = ar2.getmember(name)
-                in_path1 = os.path.join(temp_dir1, name)
-                in_path2 = os.path.join(temp_dir2, name)
-                with open(in_path1, 'w') as f1:
-                    f1.write(member1.read())
-                with open(in_path2, 'w') as f2:
-                    f2.write(member2.read())
-                differences.extend(
-                    debbindiff.comparators.compare_files(
-                        in_path1, in_path2, source=name))
-                os.unlink(in_path1)
-                os.unlink(in_path2)
+                digest1 = digest2 = None
+                try:
+                    if member1.size == member2.size:
+                        digest1 = get_fileobj_digest(member1)
+                        digest2 = get_fileobj_digest(member2)
+                        if digest1 == digest2:
+                            continue
+                    if queue.cut_short(name):
+                        continue
+                    # members are copied with a fixed size buffer: data.tar
+                    # can be much bigger than what we want to keep in memory
+                    logger.debug('extract member %s', name)
+                    member1.seek(0)
+                    member2.seek(0)
+                    in_path1 = extract_fileobj(member1, temp_dir1, name, digest1)
+                    in_path2 = extract_fileobj(member2, temp_dir2, name, digest2)
+                finally:
+                    member1.close()
+                    member2.close()
+                queue.compare(in_path1, in_path2, name, cleanup=True)
+            differences.extend(queue.differences())
     # look up differences in file list and file metadata
     content1 = get_ar_content(path1)
     content2 = get_ar_content(path2)
@@ -17,80 +17,329 @@
 # You should have received a copy of the GNU General Public License
 # along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
 
+import array
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import grp
+import os
 import os.path
-import re
+import pwd
+import stat
+import struct
 import subprocess
-from debbindiff import logger, tool_required, RequiredToolNotFound
+import time
+from debbindiff import logger, tool_required
 from debbindiff.difference import Difference
 import debbindiff.comparators
-from debbindiff.comparators.utils import Command
+from debbindiff.comparators.utils import MemberQueue
+from debbindiff.streaming import get_stream
 
 
 def ls(path):
     return '\n'.join(sorted(subprocess.check_output(['ls', path], shell=False).decode('utf-8').splitlines()))
 
 
-class Stat(Command):
-    @tool_required('stat')
-    def cmdline(self):
-        return ['stat', self.path]
+# Metadata is collected in-process and written the way `stat`, `lsattr -d`
+# and `getfacl -p -c` would, without the file name, device and inode that
+# always differ.
 
-    FILE_RE = re.compile(r'^\s*File:.*$')
-    DEVICE_RE = re.compile(r'Device: [0-9a-f]+h/[0-9]+d')
-    INODE_RE = re.compile(r'Inode: [0-9]+')
+_names = {}
 
-    def filter(self, line):
-        line = Stat.FILE_RE.sub('', line)
-        line = Stat.DEVICE_RE.sub('', line)
-        line = Stat.INODE_RE.sub('', line)
-        return line
+
+def get_name(database, id):
+    key = (database, id)
+    if key not in _names:
+        try:
+            _names[key] = database(id)[0]
+        except KeyError:
+            _names[key] = None
+    return _names[key]
+
+
+def get_user_name(uid):
+    return get_name(pwd.getpwuid, uid)
+
+
+def get_group_name(gid):
+    return get_name(grp.getgrgid, gid)
+
+
+FILE_TYPES = [ (stat.S_ISREG, 'regular file', '-')
+             , (stat.S_ISDIR, 'directory', 'd')
+             , (stat.S_ISLNK, 'symbolic link', 'l')
+             , (stat.S_ISFIFO, 'fifo', 'p')
+             , (stat.S_ISSOCK, 'socket', 's')
+             , (stat.S_ISCHR, 'character special file', 'c')
+             , (stat.S_ISBLK, 'block special file', 'b')
+             ]
+
+
+def get_file_type(mode):
+    for test, name, char in FILE_TYPES:
+        if test(mode):
+            return name, char
+    return 'weird file', '?'
+
+
+def format_mode(mode):
+    chars = [get_file_type(mode)[1]]
+    for who, special, special_char in ((6, stat.S_ISUID, 's'),
+                                       (3, stat.S_ISGID, 's'),
+                                       (0, stat.S_ISVTX, 't')):
+        bits = (mode >> who) & 7
+        chars.append('r' if bits & 4 else '-')
+        chars.append('w' if bits & 2 else '-')
+        if mode & special:
+            chars.append(special_char if bits & 1 else special_char.upper())
+        else:
+            chars.append('x' if bits & 1 else '-')
+    return ''.join(chars)
+
+
+_libc = None
+
+
+def get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _libc.lgetxattr.argtypes = [ctypes.c_char_p, ctypes.c_char_p,
+                                    ctypes.c_void_p, ctypes.c_size_t]
+        _libc.lgetxattr.restype = ctypes.c_ssize_t
+    return _libc
+
+
+# os.stat() gives times as floats, which hold them to about a microsecond,
+# and knows nothing of birth times: they are read with statx(2) when the C
+# library has it. struct statx has the same layout on every architecture.
+STATX_SIZE = 256
+STATX_TIMES = [('atime', 0x20, 64), ('btime', 0x800, 80),
+               ('ctime', 0x80, 96), ('mtime', 0x40, 112)]
+STATX_BASIC_STATS = 0x7ff
+STATX_BTIME = 0x800
+AT_FDCWD = -100
+AT_SYMLINK_NOFOLLOW = 0x100
+
+
+def get_times(path, st):
+    """Return the (seconds, nanoseconds) of the times of path, by name.
+    The birth time is only there if the filesystem records it."""
+    libc = get_libc()
+    if hasattr(libc, 'statx'):
+        buf = ctypes.create_string_buffer(STATX_SIZE)
+        if libc.statx(AT_FDCWD, path, AT_SYMLINK_NOFOLLOW,
+                      STATX_BASIC_STATS | STATX_BTIME, buf) == 0:
+            mask = struct.unpack_from('=I', buf.raw)[0]
+            return dict((name, struct.unpack_from('=qI', buf.raw, offset))
+                        for name, flag, offset in STATX_TIMES if mask & flag)
+    times = {}
+    for name in ('atime', 'mtime', 'ctime'):
+        us = int(round(getattr(st, 'st_%s' % name) * 1e6))
+        seconds, us = divmod(us, 10 ** 6)
+        times[name] = (seconds, us * 1000)
+    return times
+
+
+# same as stat(1)
+def format_time(times, name):
+    if name not in times:
+        return '-'
+    seconds, ns = times[name]
+    local = time.localtime(seconds)
+    return '%s.%09d %s' % (time.strftime('%Y-%m-%d %H:%M:%S', local), ns,
+                           time.strftime('%z', local))
+
+
+def get_stat(path):
+    st = os.lstat(path)
+    file_type = get_file_type(st.st_mode)[0]
+    if file_type == 'regular file' and st.st_size == 0:
+        file_type = 'regular empty file'
+    lines = ['']
+    lines.append('  Size: %-10d\tBlocks: %-10d IO Block: %-6d %s' %
+                 (st.st_size, st.st_blocks, st.st_blksize, file_type))
+    if stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+        lines.append('Links: %-5d Device type: %d,%d' % (
+                     st.st_nlink, os.major(st.st_rdev), os.minor(st.st_rdev)))
+    else:
+        lines.append('Links: %d' % st.st_nlink)
+    lines.append('Access: (%04o/%s)  Uid: (%5d/%8s)   Gid: (%5d/%8s)' % (
+                 stat.S_IMODE(st.st_mode), format_mode(st.st_mode),
+                 st.st_uid, get_user_name(st.st_uid) or 'UNKNOWN',
+                 st.st_gid, get_group_name(st.st_gid) or 'UNKNOWN'))
+    times = get_times(path, st)
+    lines.append('Access: %s' % format_time(times, 'atime'))
+    lines.append('Modify: %s' % format_time(times, 'mtime'))
+    lines.append('Change: %s' % format_time(times, 'ctime'))
+    lines.append(' Birth: %s' % format_time(times, 'btime'))
+    return ''.join('%s\n' % line for line in lines).decode('utf-8')
+
+
+# in the order used by lsattr
+FS_FLAGS = [ (0x00000001, 's'), (0x00000002, 'u'), (0x00000008, 'S')
+           , (0x00010000, 'D'), (0x00000010, 'i'), (0x00000020, 'a')
+           , (0x00000040, 'd'), (0x00000080, 'A'), (0x00000004, 'c')
+           , (0x00000800, 'E'), (0x00004000, 'j'), (0x00001000, 'I')
+           , (0x00008000, 't'), (0x00020000, 'T'), (0x00080000, 'e')
+           , (0x00800000, 'C'), (0x02000000, 'x'), (0x40000000, 'F')
+           , (0x10000000, 'N'), (0x20000000, 'P'), (0x00100000, 'V')
+           , (0x00000400, 'm')
+           ]
+
+# _IOR('f', 1, long)
+FS_IOC_GETFLAGS = (2 << 30) | (struct.calcsize('l') << 16) | (ord('f') << 8) | 1
 
 
-@tool_required('lsattr')
 def lsattr(path):
+    if not (os.path.isfile(path) or os.path.isdir(path)) or os.path.islink(path):
+        return ''
     try:
-        output = subprocess.check_output(['lsattr', '-d', path], shell=False, stderr=subprocess.STDOUT).decode('utf-8')
-        return output.split()[0]
-    except subprocess.CalledProcessError as e:
-        if e.returncode == 1:
-            # filesystem doesn't support xattrs
-            return ''
+        fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK | os.O_NOFOLLOW)
+    except OSError:
+        return ''
+    try:
+        flags = array.array('l', [0])
+        fcntl.ioctl(fd, FS_IOC_GETFLAGS, flags, True)
+    except IOError:
+        # filesystem doesn't support attributes
+        return ''
+    finally:
+        os.close(fd)
+    return ''.join(char if flags[0] & flag else '-' for flag, char in FS_FLAGS)
+
+
+def lgetxattr(path, name):
+    libc = get_libc()
+    while True:
+        size = libc.lgetxattr(path, name, None, 0)
+        if size >= 0:
+            buf = ctypes.create_string_buffer(size)
+            size = libc.lgetxattr(path, name, buf, size)
+            if size >= 0:
+                return buf.raw[:size]
+        err = ctypes.get_errno()
+        if err in (errno.ENODATA, errno.ENOTSUP, errno.ENOSYS):
+            return None
+        # ERANGE: the attribute has grown between the two calls
+        if err != errno.ERANGE:
+            raise OSError(err, os.strerror(err), path)
 
 
-class Getfacl(Command):
-    @tool_required('getfacl')
-    def cmdline(self):
-        return ['getfacl', '-p', '-c', self.path]
+ACL_USER_OBJ, ACL_USER, ACL_GROUP_OBJ, ACL_GROUP, ACL_MASK, ACL_OTHER = \
+    0x01, 0x02, 0x04, 0x08, 0x10, 0x20
+
+
+def format_perm(perm):
+    return ''.join(char if perm & bit else '-'
+                   for bit, char in ((4, 'r'), (2, 'w'), (1, 'x')))
+
+
+def parse_acl(value):
+    # version, then (tag, perm, id) entries
+    return [struct.unpack('<HHI', value[offset:offset + 8])
+            for offset in xrange(4, len(value) - 7, 8)]
+
+
+def format_acl(entries, prefix=''):
+    lines = []
+    mask = None
+    for tag, perm, id in entries:
+        if tag == ACL_MASK:
+            mask = perm
+    for tag, perm, id in entries:
+        if tag == ACL_USER_OBJ:
+            line = 'user::'
+        elif tag == ACL_USER:
+            line = 'user:%s:' % (get_user_name(id) or id)
+        elif tag == ACL_GROUP_OBJ:
+            line = 'group::'
+        elif tag == ACL_GROUP:
+            line = 'group:%s:' % (get_group_name(id) or id)
+        elif tag == ACL_MASK:
+            line = 'mask::'
+        elif tag == ACL_OTHER:
+            line = 'other::'
+        else:
+            continue
+        line = '%s%s%s' % (prefix, line, format_perm(perm))
+        if mask is not None and tag in (ACL_USER, ACL_GROUP_OBJ, ACL_GROUP) \
+                and perm & ~mask:
+            line += '\t#effective:%s' % format_perm(perm & mask)
+        lines.append(line)
+    return lines
+
+
+def getfacl(path):
+    if os.path.islink(path):
+        return ''
+    access = lgetxattr(path, 'system.posix_acl_access')
+    if access is None:
+        # the minimal ACL comes from the permission bits
+        mode = os.lstat(path).st_mode
+        entries = [(ACL_USER_OBJ, (mode >> 6) & 7, 0),
+                   (ACL_GROUP_OBJ, (mode >> 3) & 7, 0),
+                   (ACL_OTHER, mode & 7, 0)]
+    else:
+        entries = parse_acl(access)
+    lines = format_acl(entries)
+    if os.path.isdir(path):
+        default = lgetxattr(path, 'system.posix_acl_default')
+        if default is not None:
+            lines.extend(format_acl(parse_acl(default), prefix='default:'))
+    return ''.join('%s\n' % line for line in lines + ['']).decode('utf-8')
 
 
 def compare_meta(path1, path2):
     logger.debug('compare_meta(%s, %s)' % (path1, path2))
     differences = []
+    for get_metadata, source in ((get_stat, 'stat {}'),
+                                 (lsattr, 'lattr'),
+                                 (getfacl, 'getfacl -p -c {}')):
+        try:
+            metadata1 = get_metadata(path1)
+            metadata2 = get_metadata(path2)
+        except OSError as e:
+            logger.info('Unable to read metadata with %s: %s', source, e)
+            continue
+        # only run a diff when there is something to show
+        if metadata1 != metadata2:
+            difference = Difference.from_unicode(
+                             metadata1, metadata2, path1, path2, source=source)
+            if difference:
+                differences.append(difference)
+    return differences
 
-    try:
-        difference = Difference.from_command(Stat, path1, path2)
-        if difference:
-            differences.append(difference)
-    except RequiredToolNotFound:
-        logger.warn("'stat' not found! Is PATH wrong?")
 
-    try:
-        lsattr1 = lsattr(path1)
-        lsattr2 = lsattr(path2)
-        difference = Difference.from_unicode(
-                         lsattr1, lsattr2, path1, path2, source="lattr")
-        if difference:
-            differences.append(difference)
-    except RequiredToolNotFound:
-        logger.info("Unable to find 'lsattr'.")
-
-    try:
-        difference = Difference.from_command(Getfacl, path1, path2)
-        if difference:
-            differences.append(difference)
-    except RequiredToolNotFound:
-        logger.info("Unable to find 'getfacl'.")
-    return differences
+def compare_directory_member(path1, path2, name):
+    logger.debug('compare %s' % name)
+    in_path1 = os.path.join(path1, name)
+    in_path2 = os.path.join(path2, name)
+    if os.path.isdir(in_path1):
+        return debbindiff.comparators.compare_files(
+                   in_path1, in_path2, source=name)
+    # when the member has been written while it was compared, its metadata
+    # is written with it
+    written_meta = []
+    def get_meta():
+        written_meta.append(compare_meta(in_path1, in_path2))
+        return written_meta[0]
+    with get_stream().closing_details(get_meta):
+        in_differences = debbindiff.comparators.compare_files(
+                             in_path1, in_path2, source=name)
+    if written_meta:
+        return in_differences
+    meta_differences = compare_meta(in_path1, in_path2)
+    if in_differences and not in_differences[0].streamed:
+        in_differences[0].add_details(meta_differences)
+    elif meta_differences:
+        # comparators not opening a node for the files can still have
+        # written what they found
+        d = Difference(None, path1, path2, source=name)
+        d.add_details(meta_differences)
+        in_differences = in_differences + [d]
+    return in_differences
 
 
 @tool_required('ls')
@@ -98,28 +347,25 @@ def compare_directories(path1, path2, source=None):
     differences = []
     logger.debug('path1 files: %s' % sorted(set(os.listdir(path1))))
     logger.debug('path2 files: %s' % sorted(set(os.listdir(path2))))
-    for name in sorted(set(os.listdir(path1)).intersection(set(os.listdir(path2)))):
-        logger.debug('compare %s' % name)
-        in_path1 = os.path.join(path1, name)
-        in_path2 = os.path.join(path2, name)
-        in_differences = debbindiff.comparators.compare_files(
-                             in_path1, in_path2, source=name)
-        if not os.path.isdir(in_path1):
-            if in_differences:
-                in_differences[0].add_details(compare_meta(in_path1, in_path2))
-            else:
-                d = Difference(None, path1, path2, source=name)
-                d.add_details(compare_meta(in_path1, in_path2))
-                in_differences = [d]
-        differences.extend(in_differences)
-    ls1 = ls(path1)
-    ls2 = ls(path2)
-    difference = Difference.from_unicode(ls1, ls2, path1, path2, source="ls")
-    if difference:
-        differences.append(difference)
-    differences.extend(compare_meta(path1, path2))
-    if differences:
-        d = Difference(None, path1, path2, source=source)
+    d = Difference(None, path1, path2, source=source)
+    stream = get_stream()
+    entry = stream.open(d)
+    try:
+        queue = MemberQueue()
+        for name in sorted(set(os.listdir(path1)).intersection(set(os.listdir(path2)))):
+            queue.submit_pair(os.path.join(path1, name),
+                              os.path.join(path2, name),
+                              compare_directory_member, path1, path2, name)
+        differences.extend(queue.differences())
+        ls1 = ls(path1)
+        ls2 = ls(path2)
+        difference = Difference.from_unicode(ls1, ls2, path1, path2, source="ls")
+        if difference:
+            differences.append(difference)
+        differences.extend(compare_meta(path1, path2))
         d.add_details(differences)
+    finally:
+        stream.close(entry, d)
+    if differences:
         return [d]
     return []
@@ -17,10 +17,12 @@
 # You should have received a copy of the GNU General Public License
 # along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import os.path
 import re
+import struct
 import subprocess
-from debbindiff import tool_required
+from debbindiff import logger, tool_required
 from debbindiff.comparators.utils import binary_fallback, get_ar_content, Command
 from debbindiff.difference import Difference
 
@@ -36,9 +38,17 @@ class ReadelfAll(Command):
 
 
 class ReadelfDebugDump(Command):
+    def __init__(self, path, kinds=None, *args, **kwargs):
+        self._kinds = kinds
+        super(ReadelfDebugDump, self).__init__(path, *args, **kwargs)
+
     @tool_required('readelf')
     def cmdline(self):
-        return ['readelf', '--debug-dump', self.path]
+        if self._kinds is None:
+            return ['readelf', '--debug-dump', self.path]
+        return ['readelf'] + \
+               ['--debug-dump=%s' % kind for kind in self._kinds] + \
+               [self.path]
 
     def filter(self, line):
         # the full path can appear in the output, we need to remove it
@@ -46,28 +56,160 @@ class ReadelfDebugDump(Command):
 
 
 class ObjdumpDisassemble(Command):
+    def __init__(self, path, sections=None, *args, **kwargs):
+        self._sections = sections
+        super(ObjdumpDisassemble, self).__init__(path, *args, **kwargs)
+
     @tool_required('objdump')
     def cmdline(self):
-        return ['objdump', '--disassemble', '--full-contents', self.path]
+        cmd = ['objdump', '--disassemble', '--full-contents']
+        for section in self._sections or []:
+            cmd.extend(['-j', section])
+        cmd.append(self.path)
+        return cmd
 
     def filter(self, line):
         # the full path can appear in the output, we need to remove it
         return line.replace(self.path, os.path.basename(self.path))
 
+
+ELF_MAGIC = b'\x7fELF'
+ELFCLASS32, ELFCLASS64 = 1, 2
+ELFDATA2LSB, ELFDATA2MSB = 1, 2
+SHT_NOBITS = 8
+SHN_XINDEX = 0xffff
+
+# already shown by `readelf --all` and not seen by objdump as sections
+READELF_ALL_SECTIONS = set(['.symtab', '.strtab', '.shstrtab'])
+
+# fields after e_ident, up to e_shstrndx
+ELF_HEADER = { ELFCLASS32: 'HHIIIIIHHHHHH', ELFCLASS64: 'HHIQQQIHHHHHH' }
+# sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size, sh_link, ...
+ELF_SECTION_HEADER = { ELFCLASS32: 'IIIIIIIIII', ELFCLASS64: 'IIQQQQIIQQ' }
+
+# sections shown by `readelf --debug-dump=<kind>`. The strings of
+# .debug_line_str only appear in the raw line tables. Sections missing
+# here (like .debug_str_offsets, that not every readelf can show) get
+# the full dump.
+DEBUG_DUMP_KINDS = { '.debug_abbrev': 'abbrev'
+                   , '.debug_addr': 'addr'
+                   , '.debug_aranges': 'aranges'
+                   , '.debug_cu_index': 'cu_index'
+                   , '.debug_frame': 'frames'
+                   , '.debug_info': 'info'
+                   , '.debug_line': 'rawline'
+                   , '.debug_line_str': 'rawline'
+                   , '.debug_loc': 'loc'
+                   , '.debug_loclists': 'loc'
+                   , '.debug_macinfo': 'macro'
+                   , '.debug_macro': 'macro'
+                   , '.debug_pubnames': 'pubnames'
+                   , '.debug_pubtypes': 'pubtypes'
+                   , '.debug_ranges': 'Ranges'
+                   , '.debug_rnglists': 'Ranges'
+                   , '.debug_str': 'str'
+                   , '.debug_tu_index': 'cu_index'
+                   , '.debug_types': 'info'
+                   , '.eh_frame': 'frames'
+                   , '.gdb_index': 'gdb_index'
+                   }
+
+
+def get_section_digest(f, offset, size):
+    BUF_SIZE = 2 ** 20  # 1 MiB
+    h = hashlib.sha256()
+    f.seek(offset)
+    while size > 0:
+        buf = f.read(min(size, BUF_SIZE))
+        if not buf:
+            raise ValueError('section goes past the end of the file')
+        h.update(buf)
+        size -= len(buf)
+    return h.hexdigest()
+
+
+# Return the digests of the content of each section, by name, or None when
+# the file is not an ELF object we can read.
+def get_elf_sections(path):
+    with open(path, 'rb') as f:
+        ident = f.read(16)
+        if len(ident) < 16 or ident[:4] != ELF_MAGIC:
+            return None
+        elf_class, data = ord(ident[4]), ord(ident[5])
+        if elf_class not in ELF_HEADER or data not in (ELFDATA2LSB, ELFDATA2MSB):
+            return None
+        endian = '<' if data == ELFDATA2LSB else '>'
+        header_format = endian + ELF_HEADER[elf_class]
+        section_format = endian + ELF_SECTION_HEADER[elf_class]
+        try:
+            header = struct.unpack(header_format, f.read(struct.calcsize(header_format)))
+            shoff, shentsize, shnum, shstrndx = header[5], header[10], header[11], header[12]
+            if shoff == 0 or shentsize < struct.calcsize(section_format):
+                return None
+
+            def read_section_header(index):
+                f.seek(shoff + index * shentsize)
+                return struct.unpack(section_format, f.read(struct.calcsize(section_format)))
+            # large section numbers are stored in the first section header
+            if shnum == 0:
+                shnum = read_section_header(0)[5]
+            if shstrndx == SHN_XINDEX:
+                shstrndx = read_section_header(0)[6]
+            headers = [read_section_header(index) for index in xrange(shnum)]
+            strtab_offset, strtab_size = headers[shstrndx][4], headers[shstrndx][5]
+            f.seek(strtab_offset)
+            strtab = f.read(strtab_size)
+            sections = {}
+            for sh_name, sh_type, _, _, sh_offset, sh_size, _, _, _, _ in headers[1:]:
+                name = strtab[sh_name:strtab.find(b'\0', sh_name)]
+                if sh_type == SHT_NOBITS:
+                    digest = 'nobits %d' % sh_size
+                else:
+                    digest = get_section_digest(f, sh_offset, sh_size)
+                # several sections can have the same name
+                sections.setdefault(name, []).append(digest)
+            return sections
+        except (struct.error, IndexError, ValueError):
+            return None
+
+
+def get_debug_dump_kind(name):
+    if name.startswith('.zdebug_'):
+        name = '.debug_%s' % name[len('.zdebug_'):]
+    return DEBUG_DUMP_KINDS.get(name)
+
+
 # this one is not wrapped with binary_fallback and is used
 # by both compare_elf_files and compare_static_lib_files
 def _compare_elf_data(path1, path2, source=None):
-    differences = []
-    difference = Difference.from_command(ReadelfAll, path1, path2)
-    if difference:
-        differences.append(difference)
-    difference = Difference.from_command(ReadelfDebugDump, path1, path2)
-    if difference:
-        differences.append(difference)
-    difference = Difference.from_command(ObjdumpDisassemble, path1, path2)
-    if difference:
-        differences.append(difference)
-    return differences
+    sections1 = get_elf_sections(path1)
+    sections2 = get_elf_sections(path2)
+    if sections1 is None or sections2 is None:
+        # static libraries or unreadable objects: dump everything
+        kinds = None
+        names = None
+    else:
+        # only dump the sections with a different content
+        names = sorted(name for name in set(sections1).union(sections2)
+                       if sections1.get(name) != sections2.get(name))
+        logger.debug('identical sections: %s', ' '.join(sorted(
+            name for name in sections1 if sections1[name] == sections2.get(name))))
+        debug_names = [name for name in names
+                       if name.startswith(('.debug_', '.zdebug_', '.gdb_index'))]
+        kinds = set(get_debug_dump_kind(name) for name in names) - set([None])
+        if any(get_debug_dump_kind(name) is None for name in debug_names):
+            # unknown debug section: dump them all
+            kinds = None
+        else:
+            kinds = sorted(kinds)
+        names = [name for name in names
+                 if name not in READELF_ALL_SECTIONS and name not in debug_names]
+    commands = [(ReadelfAll, ())]
+    if kinds is None or kinds:
+        commands.append((ReadelfDebugDump, (kinds,)))
+    if names is None or names:
+        commands.append((ObjdumpDisassemble, (names,)))
+    return Difference.from_commands(path1, path2, commands)
 
 
 @binary_fallback
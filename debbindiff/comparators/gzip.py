@@ -17,33 +17,77 @@
 # You should have received a copy of the GNU General Public License
 # along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
 
+from __future__ import absolute_import
+
+from binascii import hexlify
 from contextlib import contextmanager
-import subprocess
-import os.path
-import debbindiff.comparators
-from debbindiff import tool_required
-from debbindiff.comparators.utils import binary_fallback, make_temp_directory
-from debbindiff.difference import Difference, get_source
+import gzip
+import struct
+import time
+import zlib
+from debbindiff.comparators.utils import binary_fallback, \
+    compare_decompressed_files, DecompressionError
+from debbindiff.difference import Difference
 
 
 @contextmanager
-@tool_required('gzip')
-def decompress_gzip(path):
-    with make_temp_directory() as temp_dir:
-        if path.endswith('.gz'):
-            temp_path = os.path.join(temp_dir, os.path.basename(path[:-3]))
-        else:
-            temp_path = os.path.join(temp_dir, "%s-content" % path)
-        with open(temp_path, 'wb') as temp_file:
-            subprocess.check_call(
-                ["gzip", "--decompress", "--stdout", path],
-                shell=False, stdout=temp_file, stderr=None)
-            yield temp_path
+def open_gzip(path):
+    try:
+        with gzip.GzipFile(path, 'rb') as fileobj:
+            yield fileobj
+    except IOError as e:
+        # errors from the gzip module have no errno
+        if e.errno is not None:
+            raise
+        raise DecompressionError(path, e)
+    except (EOFError, zlib.error) as e:
+        raise DecompressionError(path, e)
+
+
+# see RFC 1952
+FTEXT, FHCRC, FEXTRA, FNAME, FCOMMENT = 1, 2, 4, 8, 16
+
+GZIP_EXTRA_FLAGS = { 2: 'maximum compression', 4: 'fastest algorithm' }
+
+GZIP_OS = { 0: 'FAT', 1: 'Amiga', 2: 'VMS', 3: 'Unix', 4: 'VM/CMS',
+            5: 'Atari TOS', 6: 'HPFS', 7: 'Macintosh', 8: 'Z-System',
+            9: 'CP/M', 10: 'TOPS-20', 11: 'NTFS', 12: 'QDOS',
+            13: 'Acorn RISCOS', 255: 'unknown' }
+
+
+def read_zero_terminated(f):
+    return b''.join(iter(lambda: f.read(1), b'\0'))
 
 
-@tool_required('file')
+# the header is read directly instead of asking file(1) to describe it
 def get_gzip_metadata(path):
-    return subprocess.check_output(['file', '--brief', path]).decode('utf-8')
+    with open(path, 'rb') as f:
+        header = f.read(10)
+        if len(header) < 10 or header[:2] != b'\x1f\x8b':
+            raise DecompressionError(path, 'not in gzip format')
+        method, flags, mtime, extra_flags, os_type = \
+            struct.unpack('<BBIBB', header[2:])
+        metadata = []
+        metadata.append('compression method: %s' %
+                        ('deflate' if method == 8 else method))
+        if flags & FTEXT:
+            metadata.append('probably text')
+        if flags & FEXTRA:
+            length, = struct.unpack('<H', f.read(2))
+            metadata.append('extra field: %s' % hexlify(f.read(length)))
+        if flags & FNAME:
+            metadata.append('original name: %s' % read_zero_terminated(f))
+        if flags & FCOMMENT:
+            metadata.append('comment: %s' % read_zero_terminated(f))
+        if flags & FHCRC:
+            metadata.append('header checksum')
+    if mtime:
+        metadata.append('last modified: %s' %
+                        time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(mtime)))
+    metadata.append('extra flags: %s' % GZIP_EXTRA_FLAGS.get(extra_flags, extra_flags))
+    metadata.append('operating system: %s' % GZIP_OS.get(os_type, os_type))
+    # names and comments are ISO 8859-1
+    return ''.join('%s\n' % line for line in metadata).decode('iso-8859-1')
 
 
 @binary_fallback
@@ -57,9 +101,6 @@ def compare_gzip_files(path1, path2, source=None):
     if difference:
         differences.append(difference)
     # check content
-    with decompress_gzip(path1) as new_path1:
-        with decompress_gzip(path2) as new_path2:
-            differences.extend(debbindiff.comparators.compare_files(
-                new_path1, new_path2,
-                source=[os.path.basename(new_path1), os.path.basename(new_path2)]))
+    differences.extend(compare_decompressed_files(
+        path1, path2, open_gzip, '.gz', differences))
     return differences
@@ -17,22 +17,17 @@
 # You should have received a copy of the GNU General Public License
 # along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
 
-import os.path
+import os
+import re
+import struct
 import subprocess
-import debbindiff.comparators
 from debbindiff import logger, tool_required
-from debbindiff.comparators.utils import binary_fallback, make_temp_directory, Command
+from debbindiff.comparators.utils import \
+    binary_fallback, make_temp_directory, Command, MemberQueue, \
+    DigestReader, extract_fileobj, ExtentReader
 from debbindiff.difference import Difference
 
 
-@tool_required('isoinfo')
-def get_iso9660_names(path):
-    # We always use RockRidge for names. Let's see if this proves
-    # problematic later
-    cmd = ['isoinfo', '-R', '-f', '-i', path]
-    return subprocess.check_output(cmd, shell=False).strip().split('\n')
-
-
 class ISO9660PVD(Command):
     @tool_required('isoinfo')
     def cmdline(self):
@@ -59,40 +54,190 @@ class ISO9660Listing(Command):
         else:
             return line
 
-@tool_required('isoinfo')
-def extract_from_iso9660(image_path, in_path, dest):
-    # Use RockRidge, same as get_iso9660_names
-    cmd = ['isoinfo', '-i', image_path, '-R', '-x', in_path]
-    return subprocess.check_call(cmd, shell=False, stdout=dest)
+# The directory hierarchy is read in-process (ECMA-119 with the Rock Ridge
+# names of IEEE P1282) to know where the content of each file lies in the
+# image. Files can then be hashed and extracted without running isoinfo.
+
+SECTOR_SIZE = 2048
+FLAG_DIRECTORY = 0x02
+FLAG_MULTI_EXTENT = 0x80
+NM_CONTINUE = 0x01
+# without Rock Ridge, names end with a version number, and with a dot when
+# they have no extension
+VERSION_RE = re.compile(r'\.?;\d+$')
+
+
+class ISO9660Error(Exception):
+    pass
+
+
+def both_endian32(data, offset):
+    return struct.unpack_from('<I', data, offset)[0]
+
+
+class ISO9660Reader(object):
+    def __init__(self, f):
+        self._f = f
+        # offset of SUSP entries in system use areas, set by an SP entry
+        self._susp_skip = None
+        self._block_size = SECTOR_SIZE
+        for sector in xrange(16, 32):
+            descriptor = self.read(sector * SECTOR_SIZE, SECTOR_SIZE)
+            if descriptor[1:6] != 'CD001':
+                break
+            if ord(descriptor[0]) == 1:
+                self._block_size = struct.unpack_from('<H', descriptor, 128)[0]
+                self._root = descriptor[156:156 + 34]
+                return
+            if ord(descriptor[0]) == 255:
+                break
+        raise ISO9660Error('no primary volume descriptor')
+
+    def read(self, offset, length):
+        self._f.seek(offset)
+        data = self._f.read(length)
+        if len(data) != length:
+            raise ISO9660Error('truncated image')
+        return data
+
+    def get_susp_entries(self, system_use):
+        if self._susp_skip is None:
+            return
+        area = system_use[self._susp_skip:]
+        while area:
+            offset = 0
+            continuation = None
+            while offset + 4 <= len(area):
+                signature, length = area[offset:offset + 2], ord(area[offset + 2])
+                if length < 4:
+                    break
+                entry = area[offset:offset + length]
+                if signature == 'CE':
+                    continuation = (both_endian32(entry, 4) * self._block_size +
+                                    both_endian32(entry, 12),
+                                    both_endian32(entry, 20))
+                elif signature == 'ST':
+                    break
+                else:
+                    yield signature, entry
+                offset += length
+            if continuation is None:
+                return
+            area = self.read(*continuation)
+
+    def get_records(self, extent, size):
+        data = self.read(extent * self._block_size, size)
+        offset = 0
+        while offset < len(data):
+            length = ord(data[offset])
+            if length == 0:
+                # records do not cross sector boundaries
+                offset = (offset // SECTOR_SIZE + 1) * SECTOR_SIZE
+                continue
+            yield data[offset:offset + length]
+            offset += length
+
+    def parse_record(self, record):
+        extent = both_endian32(record, 2)
+        size = both_endian32(record, 10)
+        flags = ord(record[25])
+        identifier_length = ord(record[32])
+        identifier = record[33:33 + identifier_length]
+        system_use = record[33 + identifier_length + (1 - identifier_length % 2):]
+        name = None
+        child = None
+        relocated = False
+        for signature, entry in self.get_susp_entries(system_use):
+            if signature == 'NM':
+                name = (name or '') + entry[5:]
+            elif signature == 'CL':
+                child = both_endian32(entry, 4)
+            elif signature == 'RE':
+                relocated = True
+        if name is None:
+            name = VERSION_RE.sub('', identifier)
+        return name, extent, size, flags, child, relocated
+
+    def get_files(self):
+        """Return the extents (offset, length) of each file, by name"""
+        root_extent = both_endian32(self._root, 2)
+        root_size = both_endian32(self._root, 10)
+        # the SP entry in the first record of the root tells if there are
+        # System Use Sharing Protocol entries
+        first = next(self.get_records(root_extent, root_size))
+        system_use = first[34:]
+        if system_use[:2] == 'SP' and system_use[4:6] == '\xbe\xef':
+            self._susp_skip = ord(system_use[6])
+        files = {}
+        directories = [('', root_extent, root_size)]
+        while directories:
+            parent, extent, size = directories.pop()
+            for record in self.get_records(extent, size):
+                if record[33] in ('\0', '\1') and ord(record[32]) == 1:
+                    continue  # '.' and '..'
+                name, extent, size, flags, child, relocated = self.parse_record(record)
+                path = '%s/%s' % (parent, name)
+                if relocated:
+                    continue  # listed where its CL entry is
+                if child is not None:
+                    first = next(self.get_records(child, self._block_size))
+                    directories.append((path, child, both_endian32(first, 10)))
+                elif flags & FLAG_DIRECTORY:
+                    directories.append((path, extent, size))
+                else:
+                    # large files are split in several records
+                    files.setdefault(path, []).append(
+                        (extent * self._block_size, size))
+        return files
+
+
+def read_iso9660_files(image, path):
+    try:
+        return ISO9660Reader(image).get_files()
+    except (ISO9660Error, struct.error, IndexError, StopIteration) as e:
+        raise ISO9660Error('unable to read the files of %s: %s' % (path, e or 'invalid image'))
 
 
 @binary_fallback
 def compare_iso9660_files(path1, path2, source=None):
-    differences = []
-
     # compare metadata
-    difference = Difference.from_command(ISO9660PVD, path1, path2)
-    if difference:
-        differences.append(difference)
-    for extension in (None, 'joliet', 'rockridge'):
-        difference = Difference.from_command(ISO9660Listing, path1, path2, command_args=(extension,))
-        if difference:
-            differences.append(difference)
-
-    # compare files contained in image
-    files1 = get_iso9660_names(path1)
-    files2 = get_iso9660_names(path2)
-    with make_temp_directory() as temp_dir1:
-        with make_temp_directory() as temp_dir2:
-            for name in sorted(set(files1).intersection(files2)):
-                logger.debug('extract file %s' % name)
-                in_path1 = os.path.join(temp_dir1, os.path.basename(name))
-                in_path2 = os.path.join(temp_dir2, os.path.basename(name))
-                with open(in_path1, 'w') as dest:
-                    extract_from_iso9660(path1, name, dest)
-                with open(in_path2, 'w') as dest:
-                    extract_from_iso9660(path2, name, dest)
-                differences.extend(debbindiff.comparators.compare_files(
-                    in_path1, in_path2, source=name))
+    differences = Difference.from_commands(path1, path2,
+        [(ISO9660PVD, ())] +
+        [(ISO9660Listing, (extension,)) for extension in (None, 'joliet', 'rockridge')])
+    return compare_iso9660_contents(path1, path2, differences)
+
+
+# compare files contained in images
+def compare_iso9660_contents(path1, path2, differences):
+    with open(path1, 'rb') as image1:
+        with open(path2, 'rb') as image2:
+            try:
+                files1 = read_iso9660_files(image1, path1)
+                files2 = read_iso9660_files(image2, path2)
+            except ISO9660Error as e:
+                logger.debug('%s', e)
+                differences.append(Difference(
+                    None, path1, path2, source='files',
+                    comment='Files in the images have not been compared: %s' % e))
+                return differences
+            with make_temp_directory() as temp_dir1:
+                with make_temp_directory() as temp_dir2:
+                    queue = MemberQueue(differences)
+                    for name in sorted(set(files1).intersection(files2)):
+                        if queue.cut_short(name):
+                            continue
+                        # files are hashed while they are written: the
+                        # identical ones are removed right away
+                        logger.debug('extract file %s' % name)
+                        reader1 = DigestReader(ExtentReader(image1, files1[name]))
+                        reader2 = DigestReader(ExtentReader(image2, files2[name]))
+                        in_path1 = extract_fileobj(reader1, temp_dir1, name)
+                        in_path2 = extract_fileobj(reader2, temp_dir2, name)
+                        if reader1.digest() == reader2.digest():
+                            os.unlink(in_path1)
+                            os.unlink(in_path2)
+                            continue
+                        queue.compare(in_path1, in_path2, name, cleanup=True)
+                    differences.extend(queue.differences())
 
     return differences
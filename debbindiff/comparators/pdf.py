@@ -40,11 +40,5 @@ class Pdftk(Command):
 
 @binary_fallback
 def compare_pdf_files(path1, path2, source=None):
-    differences = []
-    difference = Difference.from_command(Pdftotext, path1, path2)
-    if difference:
-        differences.append(difference)
-    difference = Difference.from_command(Pdftk, path1, path2)
-    if difference:
-        differences.append(difference)
-    return differences
+    return Difference.from_commands(path1, path2, [(Pdftotext, ()),
+                                                   (Pdftk, ())])
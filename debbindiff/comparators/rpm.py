@@ -21,9 +21,9 @@ from __future__ import absolute_import
 import os.path
 import subprocess
 from contextlib import contextmanager
-import debbindiff.comparators
 from debbindiff import logger, tool_required
-from debbindiff.comparators.utils import binary_fallback, make_temp_directory
+from debbindiff.comparators.utils import binary_fallback, make_temp_directory, \
+    MemberQueue
 from debbindiff.difference import Difference, get_source
 
 def get_rpm_header(path, ts):
@@ -88,7 +88,8 @@ def compare_rpm_files(path1, path2, source=None):
     # extract cpio archive
     with extract_rpm_payload(path1) as archive1:
         with extract_rpm_payload(path2) as archive2:
-            differences.extend(debbindiff.comparators.compare_files(
-                archive1, archive2, source=get_source(archive1, archive2)))
+            queue = MemberQueue(differences)
+            queue.compare(archive1, archive2, get_source(archive1, archive2))
+            differences.extend(queue.differences())
 
     return differences
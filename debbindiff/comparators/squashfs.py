@@ -17,19 +17,38 @@
 # You should have received a copy of the GNU General Public License
 # along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
+import re
+import struct
 import subprocess
+import os
 import os.path
-import debbindiff.comparators
+import tempfile
+import zlib
 from debbindiff import logger, tool_required
-from debbindiff.comparators.utils import binary_fallback, make_temp_directory, Command
+from debbindiff.comparators.binary import are_same_binaries
+from debbindiff.comparators.utils import \
+    binary_fallback, make_temp_directory, Command, MemberQueue
 from debbindiff.difference import Difference
+from debbindiff.profiling import span
 
 
+# regular files, with a '-' mode, in the output of `unsquashfs -d '' -lls`
+LISTING_FILE_RE = re.compile(
+    r'^-\S{9} \S+ +(?P<size>\d+) \d{4}-\d\d-\d\d \d\d:\d\d /(?P<name>.*)$')
+
+
+# return the size of every regular file, by name
 @tool_required('unsquashfs')
-def get_squashfs_names(path):
-    cmd = ['unsquashfs', '-d', '', '-ls', path]
+def get_squashfs_files(path):
+    cmd = ['unsquashfs', '-d', '', '-lls', path]
     output = subprocess.check_output(cmd, shell=False)
-    return [ f.lstrip('/') for f in output.split('\n') ]
+    files = {}
+    for line in output.split('\n'):
+        m = LISTING_FILE_RE.match(line)
+        if m:
+            files[m.group('name')] = int(m.group('size'))
+    return files
 
 
 class SquashfsSuperblock(Command):
@@ -44,42 +63,288 @@ class SquashfsListing(Command):
         return ['unsquashfs', '-d', '', '-lls', self.path]
 
 
+# unsquashfs matches the names to extract as wildcards
+GLOB_CHARS_RE = re.compile(r'([\\*?\[])')
+
+
+# The inode and directory tables are read in-process to know where the data
+# of each file is stored in the image. Data blocks are hashed as they are
+# stored, compressed, and the end of the file from its fragment: files with
+# the same digest need not be extracted. Files with the same content might
+# still be stored differently, for example with other compression options.
+# They are then extracted and found identical afterwards.
+
+SQUASHFS_MAGIC = 0x73717368
+SUPERBLOCK_FORMAT = '<IIIIIHHHHHHQQQQQQQQ'
+COMPRESSION_GZIP = 1
+METADATA_UNCOMPRESSED = 0x8000
+BLOCK_UNCOMPRESSED = 1 << 24
+NO_FRAGMENT = 0xffffffff
+FRAGMENT_ENTRIES_PER_BLOCK = 8192 // 16
+INODE_BASIC_DIRECTORY = 1
+INODE_BASIC_FILE = 2
+INODE_EXTENDED_DIRECTORY = 8
+INODE_EXTENDED_FILE = 9
+
+
+class SquashfsError(Exception):
+    pass
+
+
+class SquashfsReader(object):
+    def __init__(self, f):
+        self._f = f
+        (magic, _, _, self._block_size, _, self._compression, _, _, _,
+         major, _, self._root, _, _, _, self._inode_table, self._directory_table,
+         self._fragment_table, _) = struct.unpack(
+             SUPERBLOCK_FORMAT, self.read(0, struct.calcsize(SUPERBLOCK_FORMAT)))
+        if magic != SQUASHFS_MAGIC or major != 4:
+            raise SquashfsError('not a squashfs 4.0 image')
+        # uncompressed metadata blocks, by position
+        self._metadata = {}
+        # the last fragment block read, files next to each other share them
+        self._fragment = (None, None)
+
+    def read(self, offset, length):
+        self._f.seek(offset)
+        data = self._f.read(length)
+        if len(data) != length:
+            raise SquashfsError('truncated image')
+        return data
+
+    def read_metadata_block(self, position):
+        """Return the content of the metadata block at position and the
+        position of the next one"""
+        if position not in self._metadata:
+            header = struct.unpack('<H', self.read(position, 2))[0]
+            length = header & ~METADATA_UNCOMPRESSED
+            data = self.read(position + 2, length)
+            if not header & METADATA_UNCOMPRESSED:
+                data = self.decompress(data)
+            self._metadata[position] = (data, position + 2 + length)
+        return self._metadata[position]
+
+    def decompress(self, data):
+        if self._compression != COMPRESSION_GZIP:
+            raise SquashfsError('unsupported compression %d' % self._compression)
+        return zlib.decompress(data)
+
+    def read_metadata(self, position, offset, length):
+        """Read length bytes from offset in the metadata blocks starting at
+        position. Return them with where the next bytes are."""
+        chunks = []
+        while length > 0:
+            data, next_position = self.read_metadata_block(position)
+            chunk = data[offset:offset + length]
+            chunks.append(chunk)
+            length -= len(chunk)
+            offset += len(chunk)
+            if offset >= len(data):
+                position, offset = next_position, 0
+        return ''.join(chunks), position, offset
+
+    def read_inode(self, reference):
+        position = self._inode_table + (reference >> 16)
+        offset = reference & 0xffff
+        header, position, offset = self.read_metadata(position, offset, 16)
+        inode_type = struct.unpack_from('<H', header)[0]
+        if inode_type == INODE_BASIC_DIRECTORY:
+            data = self.read_metadata(position, offset, 16)[0]
+            block, _, size, block_offset, _ = struct.unpack('<IIHHI', data)
+            return inode_type, (block, block_offset, size)
+        if inode_type == INODE_EXTENDED_DIRECTORY:
+            data = self.read_metadata(position, offset, 24)[0]
+            _, size, block, _, _, block_offset, _ = struct.unpack('<IIIIHHI', data)
+            return inode_type, (block, block_offset, size)
+        if inode_type == INODE_BASIC_FILE:
+            data, position, offset = self.read_metadata(position, offset, 16)
+            start, fragment, fragment_offset, size = struct.unpack('<IIII', data)
+        elif inode_type == INODE_EXTENDED_FILE:
+            data, position, offset = self.read_metadata(position, offset, 40)
+            start, size, _, _, fragment, fragment_offset, _ = \
+                struct.unpack('<QQQIIII', data)
+        else:
+            return inode_type, None
+        # the end of the file is in a fragment, or in one more block
+        count = size // self._block_size
+        if fragment == NO_FRAGMENT and size % self._block_size:
+            count += 1
+        data = self.read_metadata(position, offset, 4 * count)[0]
+        blocks = struct.unpack('<%dI' % count, data)
+        return inode_type, (start, size, blocks, fragment, fragment_offset)
+
+    def get_directory_entries(self, block, block_offset, size):
+        # the size counts '.' and '..', which are not stored
+        data = self.read_metadata(self._directory_table + block,
+                                  block_offset, max(size - 3, 0))[0]
+        offset = 0
+        while offset < len(data):
+            count, start, _ = struct.unpack_from('<III', data, offset)
+            offset += 12
+            for _ in xrange(count + 1):
+                inode_offset, _, _, name_size = struct.unpack_from('<HhHH', data, offset)
+                name = data[offset + 8:offset + 9 + name_size]
+                offset += 9 + name_size
+                yield name, (start << 16) | inode_offset
+
+    def get_files(self):
+        """Return where the data of each regular file is stored, by name"""
+        files = {}
+        directories = [('', self.read_inode(self._root)[1])]
+        while directories:
+            parent, directory = directories.pop()
+            for name, reference in self.get_directory_entries(*directory):
+                path = '%s%s' % (parent, name)
+                inode_type, location = self.read_inode(reference)
+                if inode_type in (INODE_BASIC_DIRECTORY, INODE_EXTENDED_DIRECTORY):
+                    directories.append(('%s/' % path, location))
+                elif inode_type in (INODE_BASIC_FILE, INODE_EXTENDED_FILE):
+                    files[path] = location
+        return files
+
+    def get_fragment(self, index):
+        """Return the content of a fragment block"""
+        if self._fragment[0] != index:
+            pointer = self._fragment_table + 8 * (index // FRAGMENT_ENTRIES_PER_BLOCK)
+            position = struct.unpack('<Q', self.read(pointer, 8))[0]
+            offset = 16 * (index % FRAGMENT_ENTRIES_PER_BLOCK)
+            start, size, _ = struct.unpack('<QII', self.read_metadata(position, offset, 16)[0])
+            data = self.read(start, size & ~BLOCK_UNCOMPRESSED)
+            if not size & BLOCK_UNCOMPRESSED:
+                data = self.decompress(data)
+            self._fragment = (index, data)
+        return self._fragment[1]
+
+    def get_digest(self, location):
+        """Hash the data of a file, as it is stored"""
+        start, size, blocks, fragment, fragment_offset = location
+        h = hashlib.sha256()
+        h.update(struct.pack('<HQ', self._compression, size))
+        for block in blocks:
+            length = block & ~BLOCK_UNCOMPRESSED
+            h.update(struct.pack('<I', block))
+            h.update(self.read(start, length))
+            start += length
+        if fragment != NO_FRAGMENT:
+            tail = size % self._block_size
+            h.update(self.get_fragment(fragment)[fragment_offset:fragment_offset + tail])
+        return h.digest()
+
+
+def get_unchanged_files(path1, path2, names):
+    """Return the names of the files stored with the same data in both
+    images"""
+    if not names:
+        return set()
+    try:
+        with open(path1, 'rb') as image1:
+            with open(path2, 'rb') as image2:
+                reader1 = SquashfsReader(image1)
+                reader2 = SquashfsReader(image2)
+                files1 = reader1.get_files()
+                files2 = reader2.get_files()
+                return set(name for name in names
+                           if name in files1 and name in files2 and
+                           reader1.get_digest(files1[name]) ==
+                           reader2.get_digest(files2[name]))
+    except (SquashfsError, struct.error, zlib.error) as e:
+        logger.debug('unable to read files of %s or %s, all will be extracted: %s',
+                     path1, path2, e)
+        return set()
+
+
 @tool_required('unsquashfs')
-def extract_squashfs(path, destdir):
-    cmd = ['unsquashfs', '-n', '-f', '-d', destdir, path]
-    logger.debug("extracting %s into %s", path, destdir)
-    p = subprocess.Popen(cmd, shell=False, stdout=subprocess.PIPE)
-    p.communicate()
-    p.wait()
+def extract_squashfs(path, destdir, names):
+    with tempfile.NamedTemporaryFile(suffix='debbindiff') as extract_file:
+        for name in names:
+            extract_file.write('%s\n' % GLOB_CHARS_RE.sub(r'\\\1', name))
+        extract_file.flush()
+        cmd = ['unsquashfs', '-n', '-f', '-d', destdir,
+               '-ef', extract_file.name, path]
+        logger.debug("extracting %d files from %s into %s", len(names), path, destdir)
+        with span('unsquashfs', 'subprocess', path=path):
+            p = subprocess.Popen(cmd, shell=False, stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+            _, stderr = p.communicate()
     if p.returncode != 0:
-        logger.error('unsquashfs exited with error code %d', p.returncode)
+        raise subprocess.CalledProcessError(p.returncode, cmd, output=stderr)
+
+
+def report_not_extracted(source, comment):
+    return [Difference(None, source, source, comment=comment)]
+
+
+# Members are extracted a batch at a time. Identical ones are removed right
+# away, so the disk space used depends on the number of files that differ
+# and not on the size of the images.
+SQUASHFS_BATCH_SIZE = 256 * 2 ** 20  # 256 MiB
+SQUASHFS_BATCH_FILES = 10000
+
+
+def get_batches(names, sizes):
+    batch = []
+    batch_size = 0
+    for name in names:
+        if batch and (batch_size + sizes[name] > SQUASHFS_BATCH_SIZE or
+                      len(batch) >= SQUASHFS_BATCH_FILES):
+            yield batch
+            batch = []
+            batch_size = 0
+        batch.append(name)
+        batch_size += sizes[name]
+    if batch:
+        yield batch
 
 
 @binary_fallback
 def compare_squashfs_files(path1, path2, source=None):
-    differences = []
-
     # compare metadata
-    difference = Difference.from_command(SquashfsSuperblock, path1, path2)
-    if difference:
-        differences.append(difference)
-    difference = Difference.from_command(SquashfsListing, path1, path2)
-    if difference:
-        differences.append(difference)
+    differences = Difference.from_commands(path1, path2, [
+                      (SquashfsSuperblock, ()),
+                      (SquashfsListing, ())])
 
     # compare files contained in archive
-    files1 = get_squashfs_names(path1)
-    files2 = get_squashfs_names(path2)
+    files1 = get_squashfs_files(path1)
+    files2 = get_squashfs_files(path2)
+    names = sorted(set(files1).intersection(files2))
+    # files of different sizes differ, the others are looked up in the images
+    unchanged = get_unchanged_files(path1, path2,
+                                    [name for name in names if files1[name] == files2[name]])
+    names = [name for name in names if name not in unchanged]
+    sizes = dict((name, max(files1[name], files2[name])) for name in names)
     with make_temp_directory() as temp_dir1:
         with make_temp_directory() as temp_dir2:
-            extract_squashfs(path1, temp_dir1)
-            extract_squashfs(path2, temp_dir2)
-            for member in sorted(set(files1).intersection(set(files2))):
-                in_path1 = os.path.join(temp_dir1, member)
-                in_path2 = os.path.join(temp_dir2, member)
-                if not os.path.isfile(in_path1) or not os.path.isfile(in_path2):
+            queue = MemberQueue(differences)
+            for batch in get_batches(names, sizes):
+                batch = [member for member in batch if not queue.cut_short(member)]
+                if not batch:
                     continue
-                differences.extend(debbindiff.comparators.compare_files(
-                    in_path1, in_path2, source=member))
+                for path, temp_dir in ((path1, temp_dir1), (path2, temp_dir2)):
+                    try:
+                        extract_squashfs(path, temp_dir, batch)
+                    except subprocess.CalledProcessError as e:
+                        # what could be extracted is still compared
+                        queue.submit(report_not_extracted, path,
+                                     'unsquashfs exited with error code %d:\n%s'
+                                     % (e.returncode, e.output.decode('utf-8', 'replace')))
+                for member in batch:
+                    in_path1 = os.path.join(temp_dir1, member)
+                    in_path2 = os.path.join(temp_dir2, member)
+                    missing = [path for path, in_path in ((path1, in_path1), (path2, in_path2))
+                               if not os.path.isfile(in_path)]
+                    if missing:
+                        queue.submit(report_not_extracted, member,
+                                     'Unable to extract from %s' % ' and '.join(missing))
+                        for in_path in (in_path1, in_path2):
+                            if os.path.isfile(in_path):
+                                os.unlink(in_path)
+                        continue
+                    # skip identical members before any mime sniffing
+                    if are_same_binaries(in_path1, in_path2):
+                        os.unlink(in_path1)
+                        os.unlink(in_path2)
+                        continue
+                    queue.compare(in_path1, in_path2, member, cleanup=True)
+            differences.extend(queue.differences())
 
     return differences
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+#
+# debbindiff: highlight differences between two builds of Debian packages
+#
+# Copyright © 2015 Jérémy Bobbio <lunar@debian.org>
+#
+# debbindiff is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# debbindiff is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import os.path
+from debbindiff import budget, logger
+from debbindiff.cache import get_file_digest
+from debbindiff.difference import Difference
+
+
+# What is shown instead of a comparison when the budget runs low. Files
+# are summarized by their size and checksum, directories by the list of
+# their members. Nothing is extracted or run.
+
+def get_file_summary(path, with_checksum):
+    summary = u'size: %d\n' % os.path.getsize(path)
+    if with_checksum:
+        summary += u'sha256: %s\n' % get_file_digest(path)
+    return summary
+
+
+def get_directory_summary(path):
+    lines = []
+    for name in sorted(os.listdir(path)):
+        member_path = os.path.join(path, name)
+        if os.path.isdir(member_path) and not os.path.islink(member_path):
+            lines.append(u'%s/\n' % name.decode('utf-8', 'replace'))
+        else:
+            lines.append(u'%12d %s\n' % (os.lstat(member_path).st_size,
+                                         name.decode('utf-8', 'replace')))
+    return u''.join(lines)
+
+
+# Pairs are always reported, even when their summaries are the same: they
+# might still differ.
+def compare_summaries(path1, path2, source=None):
+    if os.path.isdir(path1) and os.path.isdir(path2):
+        content1 = get_directory_summary(path1)
+        content2 = get_directory_summary(path2)
+        shown = 'member lists'
+    else:
+        # sizes first: reading the files is only needed when they match,
+        # and past the deadline even that is too much
+        with_checksum = not budget.is_exhausted() and \
+            os.path.getsize(path1) == os.path.getsize(path2)
+        content1 = get_file_summary(path1, with_checksum)
+        content2 = get_file_summary(path2, with_checksum)
+        if with_checksum and content1 == content2:
+            return []
+        shown = with_checksum and 'sizes and checksums' or 'sizes'
+    budget.record_cut_short()
+    logger.debug('comparison of %s and %s cut short', path1, path2)
+    comment = budget.cut_short_comment()
+    if content1 == content2:
+        comment += ': %s are the same' % shown
+        return [Difference(None, path1, path2, source=source, comment=comment)]
+    comment += ': only %s are shown' % shown
+    return [Difference.from_unicode(content1, content2, path1, path2,
+                                    source=source, comment=comment)]
@@ -17,14 +17,16 @@
 # You should have received a copy of the GNU General Public License
 # along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
 
-import os.path
+from contextlib import contextmanager
 from StringIO import StringIO
 import sys
 import tarfile
 from debbindiff import logger
 from debbindiff.difference import Difference
-import debbindiff.comparators
-from debbindiff.comparators.utils import binary_fallback, make_temp_directory
+from debbindiff.streaming import get_stream
+from debbindiff.comparators.utils import \
+    binary_fallback, make_temp_directory, MemberQueue, get_fileobj_digest, \
+    extract_fileobj
 
 
 def get_tar_content(tar):
@@ -38,38 +40,103 @@ def get_tar_content(tar):
         sys.stdout = orig_stdout
 
 
-@binary_fallback
-def compare_tar_files(path1, path2, source=None):
+def get_tar_manifest(tar, names=None):
+    manifest = {}
+    # a single pass in archive order: this also works on streams
+    for member in tar:
+        if member.isfile() and (names is None or member.name in names):
+            manifest[member.name] = get_fileobj_digest(tar.extractfile(member))
+    return manifest
+
+
+# `manifest` gives the digests of the members to extract
+def extract_tar_members(tar, manifest, temp_dir):
+    paths = {}
+    for member in tar:
+        if member.isfile() and member.name in manifest:
+            logger.debug('extract member %s', member.name)
+            paths[member.name] = extract_fileobj(
+                tar.extractfile(member), temp_dir, member.name,
+                manifest[member.name])
+    return paths
+
+
+# open_tar1() and open_tar2() are called once to look for differences and
+# once more if some members have to be written to disk
+def compare_tar_archives(open_tar1, open_tar2, path1, path2):
     differences = []
-    with tarfile.open(path1, 'r') as tar1:
-        with tarfile.open(path2, 'r') as tar2:
-            # look up differences in content
-            with make_temp_directory() as temp_dir1:
-                with make_temp_directory() as temp_dir2:
-                    logger.debug('content1 %s', tar1.getnames())
-                    logger.debug('content2 %s', tar2.getnames())
-                    for name in sorted(set(tar1.getnames())
-                                       .intersection(tar2.getnames())):
-                        member1 = tar1.getmember(name)
-                        member2 = tar2.getmember(name)
-                        if not member1.isfile() or not member2.isfile():
-                            continue
-                        logger.debug('extract member %s', name)
-                        tar1.extract(name, temp_dir1)
-                        tar2.extract(name, temp_dir2)
-                        in_path1 = os.path.join(temp_dir1, name)
-                        in_path2 = os.path.join(temp_dir2, name)
-                        differences.extend(
-                            debbindiff.comparators.compare_files(
-                                in_path1, in_path2,
-                                source=name))
-                        os.unlink(in_path1)
-                        os.unlink(in_path2)
-            # look up differences in file list and file metadata
-            content1 = get_tar_content(tar1).decode('utf-8')
-            content2 = get_tar_content(tar2).decode('utf-8')
-            difference = Difference.from_unicode(
-                             content1, content2, path1, path2, source="metadata")
-            if difference:
-                differences.append(difference)
+    with open_tar1() as tar1:
+        manifest1 = get_tar_manifest(tar1)
+        content1 = get_tar_content(tar1).decode('utf-8')
+    with open_tar2() as tar2:
+        manifest2 = get_tar_manifest(tar2, manifest1)
+        content2 = get_tar_content(tar2).decode('utf-8')
+    # look up differences in content
+    names = set(name for name in manifest2 if manifest1[name] != manifest2[name])
+    if names:
+        queue = MemberQueue()
+        names = [name for name in sorted(names) if not queue.cut_short(name)]
+        with make_temp_directory() as temp_dir1:
+            with make_temp_directory() as temp_dir2:
+                if names:
+                    # only members that differ are written to disk
+                    with open_tar1() as tar1:
+                        paths1 = extract_tar_members(
+                            tar1, dict((name, manifest1[name]) for name in names),
+                            temp_dir1)
+                    with open_tar2() as tar2:
+                        paths2 = extract_tar_members(
+                            tar2, dict((name, manifest2[name]) for name in names),
+                            temp_dir2)
+                for name in names:
+                    queue.compare(paths1[name], paths2[name], name, cleanup=True)
+                differences.extend(queue.differences())
+    # look up differences in file list and file metadata
+    difference = Difference.from_unicode(
+                     content1, content2, path1, path2, source="metadata")
+    if difference:
+        differences.append(difference)
     return differences
+
+
+@binary_fallback
+def compare_tar_files(path1, path2, source=None):
+    return compare_tar_archives(lambda: tarfile.open(path1, 'r'),
+                                lambda: tarfile.open(path2, 'r'),
+                                path1, path2)
+
+
+def is_tar_stream(open_func, path):
+    with open_func(path) as fileobj:
+        buf = fileobj.read(tarfile.BLOCKSIZE)
+    try:
+        tarfile.TarInfo.frombuf(buf)
+    except tarfile.HeaderError:
+        return False
+    return True
+
+
+# read a compressed tar archive without writing it to disk
+#
+# Unlike compare_tar_files(), there is no fallback on a binary comparison:
+# path1 and path2 are the compressed files and their comparator reports
+# its own differences. Identical archives give no differences.
+def compare_tar_streams(path1, path2, source, open_func):
+    @contextmanager
+    def open_tar(path):
+        with open_func(path) as fileobj:
+            with tarfile.open(fileobj=fileobj, mode='r|') as tar:
+                yield tar
+    difference = Difference(None, path1, path2, source=source)
+    stream = get_stream()
+    entry = stream.open(difference)
+    try:
+        differences = compare_tar_archives(lambda: open_tar(path1),
+                                           lambda: open_tar(path2),
+                                           path1, path2)
+        difference.add_details(differences)
+    finally:
+        stream.close(entry, difference)
+    if differences:
+        return [difference]
+    return []
@@ -19,67 +19,110 @@
 
 from abc import ABCMeta, abstractmethod
 from contextlib import contextmanager
+from functools import wraps
 # The following would be shutil.which in Python 3.3
 import hashlib
 import re
 import os
 import shutil
+import stat
 import subprocess
 import tempfile
 from threading import Thread
+import debbindiff.comparators
 from debbindiff.comparators.binary import compare_binary_files
 from debbindiff.difference import Difference
+from debbindiff.jobs import JobQueue
+from debbindiff.streaming import get_stream
+from debbindiff import budget, cache, profiling
 from debbindiff import logger, RequiredToolNotFound
 
 
-def are_same_binaries(path1, path2):
-    BUF_SIZE = 20 * 2 ** 10  # 20 kB
-    h1 = hashlib.md5()
-    f1 = open(path1, 'rb')
-    h2 = hashlib.md5()
-    f2 = open(path2, 'rb')
-    while True:
-        buf1 = f1.read(BUF_SIZE)
-        buf2 = f2.read(BUF_SIZE)
-        if not buf1 or not buf2:
-            return not buf1 and not buf2
-        h1.update(buf1)
-        h2.update(buf2)
-        if h1.digest() != h2.digest():
-            return False
-    return True
+# Container comparators record the size and digest of their members in a
+# first pass so identical members can be skipped without being extracted.
+def get_fileobj_digest(fileobj):
+    BUF_SIZE = 2 ** 20  # 1 MiB
+    h = hashlib.sha256()
+    size = 0
+    for buf in iter(lambda: fileobj.read(BUF_SIZE), b''):
+        size += len(buf)
+        h.update(buf)
+    return size, h.hexdigest()
+
+
+# Same digest, computed while the data is read for something else.
+class DigestReader(object):
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._hash = hashlib.sha256()
+        self._size = 0
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self._size += len(data)
+        self._hash.update(data)
+        return data
+
+    def digest(self):
+        return self._size, self._hash.hexdigest()
+
+
+# raised when compressed data read in-process turns out to be invalid
+class DecompressionError(Exception):
+    def __init__(self, path, error):
+        Exception.__init__(self, path, error)
+        self.path = path
+        self.error = error
+
+    def __str__(self):
+        return "%s: %s" % (self.path, self.error)
 
 
 # decorator that will create a fallback on binary diff if no differences
 # are detected or if an external tool fails
 def binary_fallback(original_function):
-    def with_fallback(path1, path2, source=None):
-        if are_same_binaries(path1, path2):
-            return []
+    @wraps(original_function)
+    def with_fallback(path1, path2, source=None, *args):
+        # compare_files() has already made sure that the content differs
+        # open the container now so its members can be streamed
+        difference = Difference(None, path1, path2, source=source)
+        stream = get_stream()
+        entry = stream.open(difference, for_files=True)
         try:
-            inside_differences = original_function(path1, path2, source)
-            # no differences detected inside? let's at least do a binary diff
-            if len(inside_differences) == 0:
-                difference = compare_binary_files(path1, path2, source=source)[0]
-                difference.comment = (difference.comment or '') + \
-                    "No differences found inside, yet data differs"
-            else:
-                difference = Difference(None, path1, path2, source=source)
-                difference.add_details(inside_differences)
-        except subprocess.CalledProcessError as e:
-            difference = compare_binary_files(path1, path2, source=source)[0]
-            output = re.sub(r'^', '    ', e.output, flags=re.MULTILINE)
-            cmd = ' '.join(e.cmd)
-            difference.comment = (difference.comment or '') + \
-                "Command `%s` exited with %d. Output:\n%s" \
-                % (cmd, e.returncode, output)
-        except RequiredToolNotFound as e:
-            difference = compare_binary_files(path1, path2, source=source)[0]
-            difference.comment = (difference.comment or '') + \
-                "'%s' not available in path. Falling back to binary comparison." % e.command
-            package = e.get_package()
-            if package:
-                difference.comment += "\nInstall '%s' to get a better output." % package
+            try:
+                inside_differences = original_function(path1, path2, source, *args)
+                # no differences detected inside? let's at least do a binary diff
+                if len(inside_differences) == 0:
+                    fallback = "No differences found inside, yet data differs"
+                else:
+                    difference.add_details(inside_differences)
+                    fallback = None
+            except subprocess.CalledProcessError as e:
+                output = re.sub(r'^', '    ', e.output, flags=re.MULTILINE)
+                cmd = ' '.join(e.cmd)
+                fallback = "Command `%s` exited with %d. Output:\n%s" \
+                    % (cmd, e.returncode, output)
+            except DecompressionError as e:
+                fallback = "Unable to decompress %s" % e
+            except RequiredToolNotFound as e:
+                fallback = "'%s' not available in path. Falling back to binary comparison." % e.command
+                package = e.get_package()
+                if package:
+                    fallback += "\nInstall '%s' to get a better output." % package
+            if fallback is not None:
+                binary_difference = compare_binary_files(path1, path2, source=source)[0]
+                binary_difference.comment = (binary_difference.comment or '') + fallback
+                if entry is not None and entry.written:
+                    # some members have already been written inside the
+                    # container: the binary diff comes after them
+                    binary_difference.comment = \
+                        "Comparison of the content stopped early\n" + \
+                        binary_difference.comment
+                    difference.add_details([binary_difference])
+                else:
+                    difference = binary_difference
+        finally:
+            stream.close(entry, difference)
         return [difference]
     return with_fallback
 
@@ -91,6 +134,216 @@ def make_temp_directory():
         yield temp_dir
     finally:
         shutil.rmtree(temp_dir)
+        cache.forget_directory(temp_dir)
+
+
+# Copy fileobj to path. When results are cached, the digest of what has
+# been written is recorded for the cache key: it is given by the caller
+# when it already knows it, otherwise computed while writing.
+def write_fileobj(fileobj, path, digest=None):
+    if digest is None and cache.is_enabled() and \
+       not isinstance(fileobj, DigestReader):
+        fileobj = DigestReader(fileobj)
+    with open(path, 'wb') as f:
+        shutil.copyfileobj(fileobj, f, 2 ** 20)
+    if digest is None and isinstance(fileobj, DigestReader):
+        digest = fileobj.digest()
+    if digest is not None:
+        cache.record_digest(path, digest)
+
+
+# Write the content of an archive member below temp_dir. The member name is
+# kept as comparators are selected using it.
+def extract_fileobj(fileobj, temp_dir, name, digest=None):
+    # do not let '../' or absolute names escape from temp_dir
+    path = os.path.join(temp_dir, os.path.normpath(os.path.join('/', name)).lstrip('/'))
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    write_fileobj(fileobj, path, digest)
+    return path
+
+
+# Compressed files are decompressed in-process. Their comparators give an
+# `open_func` returning a context manager for the decompressed stream. Tar
+# archives are then read straight from it; any other content is written to
+# a temporary file to be compared like a regular file.
+
+def decompressed_name(path, extension):
+    if path.endswith(extension):
+        return os.path.basename(path[:-len(extension)])
+    return "%s-content" % os.path.basename(path)
+
+
+@contextmanager
+def decompress_file(open_func, path, extension):
+    with make_temp_directory() as temp_dir:
+        temp_path = os.path.join(temp_dir, decompressed_name(path, extension))
+        with open_func(path) as fileobj:
+            write_fileobj(fileobj, temp_path)
+        try:
+            yield temp_path
+        finally:
+            cache.forget_digest(temp_path)
+
+
+def compare_decompressed_files(path1, path2, open_func, extension, differences=None):
+    source = [decompressed_name(path1, extension),
+              decompressed_name(path2, extension)]
+    queue = MemberQueue(differences)
+    tar = debbindiff.comparators.tar
+    if tar.is_tar_stream(open_func, path1) and tar.is_tar_stream(open_func, path2):
+        queue.submit(tar.compare_tar_streams, path1, path2, source, open_func)
+        return queue.differences()
+    with decompress_file(open_func, path1, extension) as new_path1:
+        with decompress_file(open_func, path2, extension) as new_path2:
+            queue.compare(new_path1, new_path2, source)
+            return queue.differences()
+
+
+# Read the content of an archive member straight from the archive, given
+# the (offset, length) of the extents where it is stored.
+class ExtentReader(object):
+    def __init__(self, f, extents):
+        self._f = f
+        self._extents = list(extents)
+        self._left = 0
+
+    def read(self, size=-1):
+        while self._left == 0 and self._extents:
+            offset, self._left = self._extents.pop(0)
+            self._f.seek(offset)
+        if size < 0 or size > self._left:
+            size = self._left
+        data = self._f.read(size)
+        self._left -= len(data)
+        if size and not data:
+            raise EOFError('%s is truncated' % self._f.name)
+        return data
+
+
+def compare_cut_short(source):
+    budget.record_cut_short()
+    return [Difference(None, source, source, comment=budget.cut_short_comment())]
+
+
+def compare_member(path1, path2, source, cleanup=False):
+    try:
+        return debbindiff.comparators.compare_files(path1, path2, source=source)
+    finally:
+        if cleanup:
+            for path in (path1, path2):
+                os.unlink(path)
+                cache.forget_digest(path)
+
+
+# Container comparators queue their members here so they can be compared
+# by parallel jobs. Files given with cleanup=True are removed as soon as
+# their comparison is done.
+#
+# When reports are streamed, the differences found in members are written
+# as soon as they are known and in order. `differences` is the list that
+# the container has built so far: it comes before the members.
+#
+# When the comparison has a budget, pairs of members given to compare() or
+# submit_pair() are compared once the container asks for its differences,
+# in the order of member_priority(), so what is left of the budget goes to
+# the pairs most likely to matter. They are still written in the order
+# they were given: the ones found early wait in memory for the others.
+# Members extracted with cleanup=True are compared right away: containers
+# extract them in bounded batches and deferring them would keep them all
+# on disk.
+#
+# Containers ask cut_short() before extracting a pair of members: once the
+# budget runs low, the pair is reported as cut short instead.
+class MemberQueue(JobQueue):
+    def __init__(self, differences=None):
+        JobQueue.__init__(self)
+        self._emitted = []
+        self._deferred = []
+        if differences is not None:
+            get_stream().set_pending(differences)
+
+    def compare(self, path1, path2, source, cleanup=False):
+        if cleanup:
+            return self.submit(compare_member, path1, path2, source, cleanup)
+        self.submit_pair(path1, path2, compare_member, path1, path2, source)
+
+    def cut_short(self, source):
+        if not budget.low_reason():
+            return False
+        self.submit(compare_cut_short, source)
+        return True
+
+    def submit_pair(self, path1, path2, func, *args):
+        if not budget.is_set():
+            return self.submit(func, *args)
+        self._deferred.append((member_priority(path1, path2),
+                               len(self._deferred), func, args))
+
+    def submit(self, func, *args):
+        stream = get_stream()
+        if not stream.active():
+            return JobQueue.submit(self, func, *args)
+        self._emit_done()
+        if self._jobs:
+            # a previous member is still running in another process: what
+            # this one finds can only be written after it
+            with stream.suspended():
+                return JobQueue.submit(self, func, *args)
+        JobQueue.submit(self, func, *args)
+        self._emit_done()
+
+    def _emit_done(self):
+        while self._jobs and self._jobs[0].done():
+            self._emitted.extend(self._emit(self._jobs.pop(0).result()))
+
+    def _emit(self, differences):
+        stream = get_stream()
+        for difference in differences:
+            stream.emit(difference)
+        return differences
+
+    def _run_deferred(self):
+        deferred, self._deferred = sorted(self._deferred), []
+        results = [None] * len(deferred)
+        next_index = 0
+        with get_stream().suspended():
+            for _, index, func, args in deferred:
+                JobQueue.submit(self, func, *args)
+        for (_, index, _, _), member_differences in zip(deferred, self.results()):
+            results[index] = member_differences
+            while next_index < len(results) and results[next_index] is not None:
+                for difference in self._emit(results[next_index]):
+                    yield difference
+                results[next_index] = None
+                next_index += 1
+
+    def differences(self):
+        differences, self._emitted = self._emitted, []
+        for member_differences in self.results():
+            differences.extend(self._emit(member_differences))
+        differences.extend(self._run_deferred())
+        return differences
+
+
+# Members that are small and look like text (control files, scripts,
+# documentation) come first, big binaries last.
+PRIORITY_SAMPLE_SIZE = 4096
+
+
+def member_priority(path1, path2):
+    try:
+        st1 = os.lstat(path1)
+        st2 = os.lstat(path2)
+    except OSError:
+        return (1, 0)
+    # directories, links and special files are not read here
+    if not (stat.S_ISREG(st1.st_mode) and stat.S_ISREG(st2.st_mode)):
+        return (1, 0)
+    size = max(st1.st_size, st2.st_size)
+    with open(path1, 'rb') as f:
+        looks_binary = '\0' in f.read(PRIORITY_SAMPLE_SIZE)
+    return (int(looks_binary), size)
 
 
 def get_ar_content(path):
@@ -103,6 +356,7 @@ class Command(object):
 
     def __init__(self, path):
         self._path = path
+        self._start = profiling.now()
         self._process = subprocess.Popen(self.cmdline(),
                                          shell=False, close_fds=True,
                                          stdin=subprocess.PIPE,
@@ -115,6 +369,10 @@ class Command(object):
         else:
             self._stdin_feeder = None
             self._process.stdin.close()
+        if profiling.is_enabled():
+            self._stdout = CountingReader(self._process.stdout)
+        else:
+            self._stdout = self._process.stdout
         self._stderr = ''
         self._stderr_line_count = 0
         self._stderr_reader = Thread(target=self._read_stderr)
@@ -147,6 +405,13 @@ class Command(object):
             self._stdin_feeder.join()
         self._stderr_reader.join()
         self._process.wait()
+        if profiling.is_enabled():
+            span = profiling.Span(self.__class__.__name__, 'subprocess',
+                                  {'cmdline': ' '.join(self.cmdline()),
+                                   'returncode': self._process.returncode,
+                                   'stdout_bytes': self._stdout.count})
+            span.tid = self._process.pid
+            profiling.add_span(span, self._start, profiling.now())
 
     MAX_STDERR_LINES = 50
 
@@ -165,4 +430,26 @@ class Command(object):
 
     @property
     def stdout(self):
-        return self._process.stdout
+        return self._stdout
+
+
+class CountingReader(object):
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.count = 0
+
+    def read(self, *args):
+        buf = self._fileobj.read(*args)
+        self.count += len(buf)
+        return buf
+
+    def readline(self, *args):
+        line = self._fileobj.readline(*args)
+        self.count += len(line)
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def close(self):
+        self._fileobj.close()
@@ -17,34 +17,58 @@
 # You should have received a copy of the GNU General Public License
 # along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
 
-from contextlib import contextmanager
-import os.path
+from contextlib import closing, contextmanager
+import signal
 import subprocess
-import debbindiff.comparators
 from debbindiff import tool_required
-from debbindiff.comparators.utils import binary_fallback, make_temp_directory
-from debbindiff.difference import get_source
+from debbindiff.comparators.utils import binary_fallback, \
+    compare_decompressed_files, DecompressionError
+from debbindiff.profiling import span
+
+# Python 2 has no lzma module in its standard library
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+# pyliblzma is also named lzma but has a different interface
+if not hasattr(lzma, 'LZMAError'):
+    lzma = None
 
 
 @contextmanager
 @tool_required('xz')
-def decompress_xz(path):
-    with make_temp_directory() as temp_dir:
-        if path.endswith('.xz'):
-            temp_path = os.path.join(temp_dir, os.path.basename(path[:-3]))
-        else:
-            temp_path = os.path.join(temp_dir, "%s-content" % path)
-        with open(temp_path, 'wb') as temp_file:
-            subprocess.check_call(
-                ["xz", "--decompress", "--stdout", path],
-                shell=False, stdout=temp_file, stderr=None)
-            yield temp_path
+def open_xz_with_tool(path):
+    cmd = ['xz', '--decompress', '--stdout', path]
+    with span('xz', 'subprocess', path=path):
+        p = subprocess.Popen(
+            cmd, shell=False, stdout=subprocess.PIPE, stderr=None,
+            # let xz be stopped by SIGPIPE if we stop reading early
+            preexec_fn=lambda: signal.signal(signal.SIGPIPE, signal.SIG_DFL))
+        try:
+            yield p.stdout
+        finally:
+            p.stdout.close()
+            returncode = p.wait()
+    if returncode not in (0, -signal.SIGPIPE):
+        raise subprocess.CalledProcessError(returncode, cmd, '')
+
+
+@contextmanager
+def open_xz(path):
+    if lzma is None:
+        with open_xz_with_tool(path) as fileobj:
+            yield fileobj
+        return
+    try:
+        with closing(lzma.LZMAFile(path)) as fileobj:
+            yield fileobj
+    except (lzma.LZMAError, EOFError) as e:
+        raise DecompressionError(path, e)
 
 
 @binary_fallback
 def compare_xz_files(path1, path2, source=None):
-    with decompress_xz(path1) as new_path1:
-        with decompress_xz(path2) as new_path2:
-            return debbindiff.comparators.compare_files(
-                new_path1, new_path2,
-                source=[os.path.basename(new_path1), os.path.basename(new_path2)])
+    return compare_decompressed_files(path1, path2, open_xz, '.xz')
@@ -23,9 +23,10 @@ import subprocess
 from zipfile import ZipFile, BadZipfile
 from debbindiff import logger
 from debbindiff.difference import Difference
-import debbindiff.comparators
 from debbindiff import tool_required
-from debbindiff.comparators.utils import binary_fallback, make_temp_directory, Command
+from debbindiff.comparators.utils import \
+    binary_fallback, make_temp_directory, Command, MemberQueue, \
+    extract_fileobj
 
 
 class Zipinfo(Command):
@@ -44,6 +45,12 @@ class ZipinfoVerbose(Zipinfo):
         return ['zipinfo', '-v', self.path]
 
 
+# The central directory records the CRC32 and size of every entry: identical
+# entries are skipped without being decompressed.
+def same_zip_entries(info1, info2):
+    return info1.CRC == info2.CRC and info1.file_size == info2.file_size
+
+
 @binary_fallback
 def compare_zip_files(path1, path2, source=None):
     differences = []
@@ -53,20 +60,23 @@ def compare_zip_files(path1, path2, source=None):
                 # look up differences in content
                 with make_temp_directory() as temp_dir1:
                     with make_temp_directory() as temp_dir2:
-                        for name in sorted(set(zip1.namelist())
-                                           .intersection(zip2.namelist())):
-                            # skip directories
-                            if name.endswith('/'):
+                        # skip directories
+                        names = [name for name in set(zip1.namelist())
+                                                  .intersection(zip2.namelist())
+                                 if not name.endswith('/')]
+                        queue = MemberQueue()
+                        for name in sorted(names):
+                            if same_zip_entries(zip1.getinfo(name), zip2.getinfo(name)):
+                                continue
+                            if queue.cut_short(name):
                                 continue
                             logger.debug('extract member %s', name)
-                            in_path1 = zip1.extract(name, temp_dir1)
-                            in_path2 = zip2.extract(name, temp_dir2)
-                            differences.extend(
-                                debbindiff.comparators.compare_files(
-                                    in_path1, in_path2,
-                                    source=name))
-                            os.unlink(in_path1)
-                            os.unlink(in_path2)
+                            with zip1.open(name) as f1:
+                                in_path1 = extract_fileobj(f1, temp_dir1, name)
+                            with zip2.open(name) as f2:
+                                in_path2 = extract_fileobj(f2, temp_dir2, name)
+                            queue.compare(in_path1, in_path2, name, cleanup=True)
+                        differences.extend(queue.differences())
                 # look up differences in metadata
                 difference = Difference.from_command(Zipinfo, path1, path2)
                 if not difference:
@@ -17,59 +17,141 @@
 # You should have received a copy of the GNU General Public License
 # along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
 
+from array import array
+from bisect import bisect_right
 from contextlib import contextmanager
+import difflib
+import hashlib
+from itertools import islice
 import os
 import os.path
 from functools import partial
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, TemporaryFile
 import re
+from StringIO import StringIO
+import cPickle as pickle
+import cStringIO
 import subprocess
-import sys
-import traceback
-from threading import Thread
-from multiprocessing import Queue
-from debbindiff import logger, tool_required, RequiredToolNotFound
+from debbindiff import budget, logger, tool_required, RequiredToolNotFound
+from debbindiff.jobs import run_dumps
+from debbindiff.profiling import span
 
 
 MAX_DIFF_BLOCK_LINES = 50
 MAX_DIFF_LINES = 10000
 MAX_DIFF_INPUT_LINES = 100000 # GNU diff cannot process arbitrary large files :(
+# Above MAX_DIFF_INPUT_LINES, inputs are cut into windows of lines. A window
+# ends after a line whose hash is a multiple of DIFF_WINDOW_LINES, so lines
+# that are added or removed do not move the windows that follow. Only the
+# windows that differ are compared.
+DIFF_WINDOW_LINES = 64
+MAX_DIFF_WINDOW_LINES = 4 * DIFF_WINDOW_LINES
+# feeder outputs are written to disk above this size
+DIFF_SPOOL_SIZE = 2 ** 24
+# feeders reading files or command outputs stop after every this number of
+# lines to see if the budget has been exceeded
+BUDGET_CHECK_LINES = 10000
+# Above this number of lines (once the common head and tail have been put
+# aside), inputs are handed to GNU diff instead of difflib
+MAX_INTERNAL_DIFF_LINES = 2000
+DIFF_CONTEXT = 7
+DIFF_BACKENDS = ('auto', 'internal', 'external')
+NEWLINE_RE = re.compile(b'\n')
+SKIPPED_RE = re.compile(r'^[-+]\[ (\d+) lines removed \]$')
+
+
+class Hunk(object):
+    """A hunk of a unified diff: the ranges from its "@@" line, and where its
+    lines are in the diff. `first` is the index of the "@@" line, `end` the
+    index of the line that follows the hunk. `skipped` maps the index of the
+    "[ N lines removed ]" lines to N."""
+
+    __slots__ = ('start1', 'len1', 'start2', 'len2', 'first', 'end', 'skipped')
+
+    def __init__(self, start1, len1, start2, len2, first):
+        self.start1 = start1
+        self.len1 = len1
+        self.start2 = start2
+        self.len2 = len2
+        self.first = first
+        self.end = None
+        self.skipped = None
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in Hunk.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(Hunk.__slots__, state):
+            setattr(self, name, value)
+
+    @staticmethod
+    def from_range(found, first):
+        return Hunk(int(found.group('start1')), int(found.group('len1') or 1),
+                    int(found.group('start2')), int(found.group('len2') or 1),
+                    first)
+
+    def add_skipped(self, index, count):
+        if self.skipped is None:
+            self.skipped = {}
+        self.skipped[index] = count
 
 
 class DiffParser(object):
     RANGE_RE = re.compile(r'^@@\s+-(?P<start1>\d+)(,(?P<len1>\d+))?\s+\+(?P<start2>\d+)(,(?P<len2>\d+))?\s+@@$')
 
-    def __init__(self, output, end_nl_q1, end_nl_q2):
+    def __init__(self, output, end_nl1, end_nl2):
         self._output = output
-        self._end_nl_q1 = end_nl_q1
-        self._end_nl_q2 = end_nl_q2
+        # work-around unified diff limitation: if there's no newlines in
+        # both don't make it a difference
+        self._end_nl = end_nl1 and end_nl2
         self._action = self.read_headers
-        self._diff = ''
+        # lines are kept as they are read, encoded in UTF-8, and joined
+        # once parsing is done
+        self._lines = []
+        self._hunks = []
         self._success = False
         self._line_count = 0
         self._remaining_hunk_lines = None
         self._block_len = None
         self._direction = None
-        self._end_nl = None
 
     @property
     def diff(self):
-        return self._diff
+        return ''.join(self._lines)
+
+    @property
+    def hunks(self):
+        return self._hunks
 
     @property
     def success(self):
         return self._success
 
     def parse(self):
-        for line in iter(self._output.readline, b''):
-            self._line_count += 1
-            if self._line_count >= MAX_DIFF_LINES:
-                self._diff += '\n[ Processing stopped after %d lines. ]' % self._line_count
-                break
-            self._action = self._action(line.decode('utf-8'))
+        try:
+            for line in iter(self._output.readline, b''):
+                self._line_count += 1
+                if self._line_count >= MAX_DIFF_LINES:
+                    self._end_hunk()
+                    self._lines.append('\n')
+                    self._lines.append('[ Processing stopped after %d lines. ]' % self._line_count)
+                    break
+                self._action = self._action(line)
+        finally:
+            # what has been parsed is still used when diff fails
+            self._end_hunk()
         self._success = True
         self._output.close()
 
+    def _end_hunk(self):
+        if self._hunks and self._hunks[-1].end is None:
+            self._hunks[-1].end = len(self._lines)
+
+    def _add_skipped(self):
+        count = self._block_len - MAX_DIFF_BLOCK_LINES
+        self._hunks[-1].add_skipped(len(self._lines), count)
+        self._lines.append('%s[ %d lines removed ]\n' % (self._direction, count))
+
     def read_headers(self, line):
         found = DiffParser.RANGE_RE.match(line)
         if line.startswith('---'):
@@ -78,15 +160,11 @@ class DiffParser(object):
             return self.read_headers
         elif not found:
             raise ValueError('Unable to parse diff headers: %s' % repr(line))
-        self._diff += line
-        if found.group('len1'):
-            self._remaining_hunk_lines = int(found.group('len1'))
-        else:
-            self._remaining_hunk_lines = 1
-        if found.group('len2'):
-            self._remaining_hunk_lines += int(found.group('len2'))
-        else:
-            self._remaining_hunk_lines += 1
+        self._end_hunk()
+        hunk = Hunk.from_range(found, len(self._lines))
+        self._hunks.append(hunk)
+        self._lines.append(line)
+        self._remaining_hunk_lines = hunk.len1 + hunk.len2
         self._direction = None
         return self.read_hunk
 
@@ -99,17 +177,13 @@ class DiffParser(object):
             self._remaining_hunk_lines -= 1
         elif line[0] == '\\':
             # When both files don't end with \n, do not show it as a difference
-            if self._end_nl is None:
-                end_nl1 = self._end_nl_q1.get()
-                end_nl2 = self._end_nl_q2.get()
-                self._end_nl = end_nl1 and end_nl2
             if not self._end_nl:
                 return self.read_hunk
         elif self._remaining_hunk_lines == 0:
             return self.read_headers(line)
         else:
             raise ValueError('Unable to parse diff hunk: %s' % repr(line))
-        self._diff += line
+        self._lines.append(line)
         if line[0] in ('-', '+') and line[0] == self._direction:
             self._block_len += 1
             if self._block_len >= MAX_DIFF_BLOCK_LINES:
@@ -121,107 +195,264 @@ class DiffParser(object):
 
     def skip_block(self, line):
         if not line.startswith(self._direction):
-            self._diff += '%s[ %d lines removed ]\n' % (self._direction, self._block_len - MAX_DIFF_BLOCK_LINES)
+            self._add_skipped()
             return self.read_hunk(line)
         self._block_len += 1
         self._remaining_hunk_lines -= 1
         if self._remaining_hunk_lines == 0:
-            self._diff += '%s[ %d lines removed ]\n' % (self._direction, self._block_len - MAX_DIFF_BLOCK_LINES)
-            return self.read_headers
+            self._add_skipped()
+            # a "\ No newline at end of file" line can still follow
+            return self.read_hunk
         return self.skip_block
 
 
+# Find the hunks of a unified diff that was not produced by DiffParser
+def find_hunks(lines):
+    hunks = []
+    for index, line in enumerate(lines):
+        if line.startswith('@@'):
+            found = DiffParser.RANGE_RE.match(line)
+            if not found:
+                continue
+            if hunks:
+                hunks[-1].end = index
+            hunks.append(Hunk.from_range(found, index))
+        elif not hunks or hunks[-1].end is not None:
+            continue
+        elif line[:1] not in (' ', '-', '+', '\\'):
+            hunks[-1].end = index
+        elif line[1:2] == '[':
+            found = SKIPPED_RE.match(line)
+            if found:
+                hunks[-1].add_skipped(index, int(found.group(1)))
+    if hunks and hunks[-1].end is None:
+        hunks[-1].end = len(lines)
+    return hunks
 
 
 DIFF_CHUNK = 4096
 
 
 @tool_required('diff')
-def run_diff(fd1, fd2, end_nl_q1, end_nl_q2):
+def run_diff(path1, path2, end_nl1, end_nl2):
     logger.debug('running diff')
-    cmd = ['diff', '-au7', '/dev/fd/%d' % fd1, '/dev/fd/%d' % fd2]
-    def close_fds():
-        fds = [int(fd) for fd in os.listdir('/dev/fd')
-                       if int(fd) not in (1, 2, fd1, fd2)]
-        for fd in fds:
-            try:
-                os.close(fd)
-            except OSError:
-                pass
-    p = subprocess.Popen(cmd, shell=False, bufsize=1,
-                         stdin=subprocess.PIPE,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.STDOUT,
-                         preexec_fn=close_fds)
-    p.stdin.close()
-    os.close(fd1)
-    os.close(fd2)
-    parser = DiffParser(p.stdout, end_nl_q1, end_nl_q2)
-    t_read = Thread(target=parser.parse)
-    t_read.daemon = True
-    t_read.start()
-    t_read.join()
-    p.wait()
-    if not parser.success and p.returncode not in (0, 1):
-        raise subprocess.CalledProcessError(cmd, p.returncode, output=diff)
+    cmd = ['diff', '-au7', path1, path2]
+    p = subprocess.Popen(cmd, shell=False, close_fds=True,
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    parser = DiffParser(p.stdout, end_nl1, end_nl2)
+    try:
+        parser.parse()
+    finally:
+        # diff is stopped if the parser did not read everything
+        p.stdout.close()
+        p.wait()
     if p.returncode == 0:
         return None
-    return parser.diff
+    return parser.diff, parser.hunks
+
+
+def split_lines(content):
+    # only split on '\n' like diff does
+    lines = content.split('\n')
+    last = lines.pop()
+    lines = [line + '\n' for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+# Returns None when comparing the inputs would exceed the given amount of
+# lines.
+def get_opcodes(lines1, lines2, max_lines=None):
+    len1, len2 = len(lines1), len(lines2)
+    # difflib is slow on big inputs, but usually most lines are the same
+    head = 0
+    while head < min(len1, len2) and lines1[head] == lines2[head]:
+        head += 1
+    tail = 0
+    while tail < min(len1, len2) - head and \
+          lines1[len1 - 1 - tail] == lines2[len2 - 1 - tail]:
+        tail += 1
+    middle1 = lines1[head:len1 - tail]
+    middle2 = lines2[head:len2 - tail]
+    if max_lines is not None and len(middle1) + len(middle2) > max_lines:
+        return None
+    opcodes = []
+    if head:
+        opcodes.append(('equal', 0, head, 0, head))
+    matcher = difflib.SequenceMatcher(None, middle1, middle2, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        opcodes.append((tag, head + i1, head + i2, head + j1, head + j2))
+    if tail:
+        opcodes.append(('equal', len1 - tail, len1, len2 - tail, len2))
+    return opcodes
+
+
+# Same as difflib.SequenceMatcher.get_grouped_opcodes()
+def group_opcodes(opcodes, context=DIFF_CONTEXT):
+    codes = list(opcodes)
+    if not codes:
+        return
+    if codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2
+    if codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        # hunks separated by less than twice the context are merged
+        if tag == 'equal' and i2 - i1 > 2 * context:
+            group.append((tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+
+def format_range(start, length):
+    # ranges are written like GNU diff does
+    if length == 1:
+        return '%d' % (start + 1)
+    if length == 0:
+        return '%d,0' % start
+    return '%d,%d' % (start + 1, length)
+
+
+def format_diff_lines(prefix, lines):
+    for line in lines:
+        if line.endswith('\n'):
+            yield prefix + line
+        else:
+            yield prefix + line + '\n'
+            yield '\\ No newline at end of file\n'
+
+
+# Produce the same output as `diff -u7` would. start1 and start2 are the
+# line numbers of lines1 and lines2 in their files.
+def unified_diff(lines1, lines2, opcodes, start1=0, start2=0):
+    for group in group_opcodes(opcodes):
+        i1, i2, j1, j2 = group[0][1], group[-1][2], group[0][3], group[-1][4]
+        yield '@@ -%s +%s @@\n' % (format_range(start1 + i1, i2 - i1),
+                                    format_range(start2 + j1, j2 - j1))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                for line in format_diff_lines(' ', lines1[i1:i2]):
+                    yield line
+                continue
+            if tag in ('replace', 'delete'):
+                for line in format_diff_lines('-', lines1[i1:i2]):
+                    yield line
+            if tag in ('replace', 'insert'):
+                for line in format_diff_lines('+', lines2[j1:j2]):
+                    yield line
+
+
+def run_internal_diff(lines1, lines2, opcodes, end_nl1, end_nl2):
+    logger.debug('running internal diff')
+    if lines1 == lines2:
+        return None
+    output = StringIO(''.join(unified_diff(lines1, lines2, opcodes)))
+    parser = DiffParser(output, end_nl1, end_nl2)
+    parser.parse()
+    return parser.diff, parser.hunks
+
+
+def get_window_regions(windows1, windows2, line_count1, line_count2):
+    """Return the (start1, end1, start2, end2) ranges of lines where the
+    windows differ"""
+    def get_line(windows, index, line_count):
+        if index < len(windows):
+            return windows[index][2]
+        return line_count
+    opcodes = get_opcodes([window[0] for window in windows1],
+                          [window[0] for window in windows2])
+    regions = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'equal':
+            continue
+        start1 = get_line(windows1, i1, line_count1)
+        end1 = get_line(windows1, i2, line_count1)
+        start2 = get_line(windows2, j1, line_count2)
+        end2 = get_line(windows2, j2, line_count2)
+        # regions close to each other end up in the same hunk
+        if regions and start1 - regions[-1][1] <= 2 * DIFF_CONTEXT:
+            regions[-1] = (regions[-1][0], end1, regions[-1][2], end2)
+        else:
+            regions.append((start1, end1, start2, end2))
+    return regions
 
 
-# inspired by https://stackoverflow.com/a/6874161
-class ExThread(Thread):
-    def __init__(self, *args, **kwargs):
-        super(ExThread, self).__init__(*args, **kwargs)
-        self.__status_queue = Queue()
+def shift_range(start, length, offset):
+    if length is None:
+        return '%d' % (int(start) + offset)
+    return '%d,%s' % (int(start) + offset, length)
 
-    def run(self, *args, **kwargs):
-        try:
-            super(ExThread, self).run(*args, **kwargs)
-        except Exception:
-            except_type, except_class, tb = sys.exc_info()
-            self.__status_queue.put((except_type, except_class, traceback.extract_tb(tb)))
-        self.__status_queue.put(None)
-
-    def wait_for_exc_info(self):
-        return self.__status_queue.get()
-
-    def join(self):
-        ex_info = self.wait_for_exc_info()
-        if ex_info is None:
-            return
+
+# Run GNU diff on lines that are at start1 and start2 in their files
+@tool_required('diff')
+def external_region_diff(lines1, lines2, start1, start2):
+    with NamedTemporaryFile(prefix='debbindiff') as f1:
+        with NamedTemporaryFile(prefix='debbindiff') as f2:
+            f1.writelines(lines1)
+            f1.flush()
+            f2.writelines(lines2)
+            f2.flush()
+            cmd = ['diff', '-au7', f1.name, f2.name]
+            p = subprocess.Popen(cmd, shell=False, stdout=subprocess.PIPE,
+                                 close_fds=True)
+            output = p.communicate()[0]
+    if p.returncode not in (0, 1):
+        raise subprocess.CalledProcessError(p.returncode, cmd, output=output)
+    # skip the "---" and "+++" lines
+    for line in split_lines(output)[2:]:
+        found = DiffParser.RANGE_RE.match(line)
+        if found:
+            line = '@@ -%s +%s @@\n' % (
+                shift_range(found.group('start1'), found.group('len1'), start1),
+                shift_range(found.group('start2'), found.group('len2'), start2))
+        yield line
+
+
+def windowed_unified_diff(output1, output2):
+    windows1 = output1.get_windows()
+    windows2 = output2.get_windows()
+    line_count1 = output1.line_count
+    line_count2 = output2.line_count
+    for start1, end1, start2, end2 in get_window_regions(
+            windows1, windows2, line_count1, line_count2):
+        before = min(DIFF_CONTEXT, start1, start2)
+        after = min(DIFF_CONTEXT, line_count1 - end1, line_count2 - end2)
+        start1 -= before
+        start2 -= before
+        lines1 = output1.read_lines(start1, min(end1 + after - start1, MAX_DIFF_INPUT_LINES))
+        lines2 = output2.read_lines(start2, min(end2 + after - start2, MAX_DIFF_INPUT_LINES))
+        # same choice of diff engine as diff()
+        opcodes = None
+        if _diff_backend != 'external':
+            max_lines = None
+            if _diff_backend == 'auto':
+                max_lines = MAX_INTERNAL_DIFF_LINES
+            opcodes = get_opcodes(lines1, lines2, max_lines)
+        if opcodes is None:
+            region_diff = external_region_diff(lines1, lines2, start1, start2)
         else:
-            except_type, except_class, tb = ex_info
-            logger.debug('Exception: %s' %
-                         traceback.format_exception_only(except_type, except_class)[0].strip())
-            logger.debug('Traceback:')
-            for line in traceback.format_list(tb):
-                logger.debug(line[:-1])
-            raise except_type, except_class, None
-
-
-def feed(feeder, f, end_nl_q):
-    # work-around unified diff limitation: if there's no newlines in both
-    # don't make it a difference
-    try:
-        end_nl = feeder(f)
-        end_nl_q.put(end_nl)
-    finally:
-        f.close()
+            region_diff = unified_diff(lines1, lines2, opcodes, start1, start2)
+        for line in region_diff:
+            yield line
 
 
-@contextmanager
-def fd_from_feeder(feeder, end_nl_q):
-    pipe_r, pipe_w = os.pipe()
-    outf = os.fdopen(pipe_w, 'w')
-    t = ExThread(target=feed, args=(feeder, outf, end_nl_q))
-    t.daemon = True
-    t.start()
-    yield pipe_r
-    try:
-        t.join()
-    finally:
-        outf.close()
+def run_windowed_diff(output1, output2, end_nl1, end_nl2):
+    logger.debug('running windowed diff')
+    # DiffParser stops after MAX_DIFF_LINES: the rest is not computed
+    output = ''.join(islice(windowed_unified_diff(output1, output2), MAX_DIFF_LINES))
+    if not output:
+        return None
+    parser = DiffParser(StringIO(output), end_nl1, end_nl2)
+    parser.parse()
+    return parser.diff, parser.hunks
 
 
 def make_feeder_from_unicode(content):
@@ -234,19 +465,94 @@ def make_feeder_from_unicode(content):
 
 def make_feeder_from_file(in_file, filter=lambda buf: buf.encode('utf-8')):
     def feeder(out_file):
-        line_count = 0
         end_nl = False
-        for buf in iter(in_file.readline, b''):
-            line_count += 1
+        for count, buf in enumerate(iter(in_file.readline, b''), 1):
             out_file.write(filter(buf))
-            if line_count >= MAX_DIFF_INPUT_LINES:
-                out_file.write('[ Too much input for diff ]%s\n' % (' ' * out_file.fileno()))
-                end_nl = True
-                break
             end_nl = buf[-1] == '\n'
+            if count % BUDGET_CHECK_LINES == 0:
+                budget.check()
         return end_nl
     return feeder
 
+def make_feeder_from_buffer(content, end_nl):
+    def feeder(f):
+        for offset in range(0, len(content), DIFF_CHUNK):
+            f.write(content[offset:offset + DIFF_CHUNK])
+        return end_nl
+    return feeder
+
+
+class FeederOutput(object):
+    """Keep what a feeder outputs, on disk once it gets big"""
+
+    def __init__(self):
+        self._file = cStringIO.StringIO()
+        self._size = 0
+        self._on_disk = False
+        self._line_count = None
+        self._windows = None
+        self._window_lines = None
+
+    @property
+    def line_count(self):
+        if self._line_count is None:
+            BUF_SIZE = 2 ** 20  # 1 MiB
+            self._file.seek(0)
+            self._line_count = sum(buf.count('\n') for buf in
+                                   iter(lambda: self._file.read(BUF_SIZE), b''))
+        return self._line_count
+
+    def write(self, buf):
+        self._file.write(buf)
+        if not self._on_disk:
+            self._size += len(buf)
+            if self._size > DIFF_SPOOL_SIZE:
+                f = TemporaryFile(suffix='debbindiff')
+                f.write(self._file.getvalue())
+                self._file = f
+                self._on_disk = True
+
+    def getvalue(self):
+        self._file.seek(0)
+        return self._file.read()
+
+    def close(self):
+        self._file.close()
+
+    def get_windows(self):
+        """Return the (digest, offset, first line) of the windows of lines"""
+        windows = []
+        h = hashlib.md5()
+        offset = size = line = 0
+        count = 0
+        self._file.seek(0)
+        for buf in self._file:
+            h.update(buf)
+            size += len(buf)
+            count += 1
+            if hash(buf) % DIFF_WINDOW_LINES == 0 or count == MAX_DIFF_WINDOW_LINES:
+                windows.append((h.digest(), offset, line))
+                h = hashlib.md5()
+                offset = size
+                line += count
+                count = 0
+        if count:
+            windows.append((h.digest(), offset, line))
+            line += count
+        # the total number of lines, with the last one if it has no newline
+        self._line_count = line
+        self._windows = windows
+        self._window_lines = [window[2] for window in windows]
+        return windows
+
+    def read_lines(self, start, count):
+        """Return `count` lines from line `start`"""
+        index = bisect_right(self._window_lines, start) - 1
+        _, offset, line = self._windows[index]
+        self._file.seek(offset)
+        return list(islice(self._file, start - line, start - line + count))
+
+
 def make_feeder_from_command(command):
     def feeder(out_file):
         end_nl = make_feeder_from_file(command.stdout, command.filter)(out_file)
@@ -257,24 +563,117 @@ def make_feeder_from_command(command):
     return feeder
 
 
+_diff_backend = 'auto'
+
+
+def set_diff_backend(backend):
+    global _diff_backend
+    assert backend in DIFF_BACKENDS
+    _diff_backend = backend
+
+
+def get_diff_backend():
+    return _diff_backend
+
+
 def diff(feeder1, feeder2):
+    output1 = FeederOutput()
+    output2 = FeederOutput()
     try:
-        end_nl_q1 = Queue()
-        end_nl_q2 = Queue()
-    except OSError as e:
-        if e.errno not in (13, 38):
-            raise
-        logger.critical('/dev/shm is not available or not on a tmpfs. Unable to create semaphore.')
-        sys.exit(2)
-    with fd_from_feeder(feeder1, end_nl_q1) as fd1:
-        with fd_from_feeder(feeder2, end_nl_q2) as fd2:
-            return run_diff(fd1, fd2, end_nl_q1, end_nl_q2)
+        end_nl1 = feeder1(output1)
+        end_nl2 = feeder2(output2)
+        if max(output1.line_count, output2.line_count) > MAX_DIFF_INPUT_LINES:
+            with span('windowed_diff', 'diff', lines1=output1.line_count,
+                      lines2=output2.line_count):
+                return run_windowed_diff(output1, output2, end_nl1, end_nl2)
+        content1 = output1.getvalue()
+        content2 = output2.getvalue()
+    finally:
+        output1.close()
+        output2.close()
+    if _diff_backend == 'external':
+        return external_diff(content1, content2, end_nl1, end_nl2)
+    lines1 = split_lines(content1)
+    lines2 = split_lines(content2)
+    max_lines = None
+    if _diff_backend == 'auto':
+        max_lines = MAX_INTERNAL_DIFF_LINES
+    with span('internal_diff', 'diff', lines1=len(lines1), lines2=len(lines2)):
+        opcodes = get_opcodes(lines1, lines2, max_lines)
+        if opcodes is not None:
+            return run_internal_diff(lines1, lines2, opcodes, end_nl1, end_nl2)
+    return external_diff(content1, content2, end_nl1, end_nl2)
+
+
+def external_diff(content1, content2, end_nl1, end_nl2):
+    with span('external_diff', 'diff'):
+        with NamedTemporaryFile(prefix='debbindiff') as f1:
+            with NamedTemporaryFile(prefix='debbindiff') as f2:
+                f1.write(content1)
+                f1.flush()
+                f2.write(content2)
+                f2.flush()
+                return run_diff(f1.name, f2.name, end_nl1, end_nl2)
+
+
+# When results are cached, differences written to the reports are saved to
+# a temporary file before being emptied, so the comparisons they belong to
+# can still be stored in the cache. A saved difference refers to the saved
+# differences in its details by their offset in the file.
+_snapshots = None
+
+
+def set_snapshots(enabled):
+    global _snapshots
+    if _snapshots is not None:
+        _snapshots.close()
+    _snapshots = enabled and TemporaryFile(suffix='debbindiff') or None
+
+
+def _snapshot_id(obj):
+    if isinstance(obj, Difference) and obj._snapshot is not None:
+        return obj._snapshot
+    return None
+
+
+def _save_snapshot(state):
+    data = cStringIO.StringIO()
+    pickler = pickle.Pickler(data, pickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = _snapshot_id
+    pickler.dump(state)
+    _snapshots.seek(0, os.SEEK_END)
+    offset = _snapshots.tell()
+    _snapshots.write(data.getvalue())
+    return offset
+
+
+def _snapshot_stub(offset):
+    difference = Difference.__new__(Difference)
+    difference._snapshot = offset
+    return difference
 
 
+def _load_snapshot(offset):
+    _snapshots.seek(offset)
+    unpickler = pickle.Unpickler(_snapshots)
+    unpickler.persistent_load = _snapshot_stub
+    return unpickler.load()
+
+
+# Comparing large trees creates many Difference objects, so they are kept
+# small: no __dict__, and the unified diff is stored encoded in UTF-8 along
+# with the offsets of its lines instead of as one unicode string. Lines are
+# only decoded when presenters iterate over them.
 class Difference(object):
-    def __init__(self, unified_diff, path1, path2, source=None, comment=None):
+    __slots__ = ('_comment', '_diff', '_line_offsets', '_hunks', '_source1',
+                 '_source2', '_details', '_streamed', '_snapshot')
+    # what is pickled
+    _STATE = __slots__[:-1]
+
+    def __init__(self, unified_diff, path1, path2, source=None, comment=None,
+                 hunks=None):
         self._comment = comment
-        self._unified_diff = unified_diff
+        self._set_unified_diff(unified_diff, hunks)
         # allow to override declared file paths, useful when comparing
         # tempfiles
         if source:
@@ -287,21 +686,58 @@ class Difference(object):
             self._source1 = path1
             self._source2 = path2
         self._details = []
+        self._streamed = False
+        self._snapshot = None
+
+    def __getstate__(self):
+        if self._snapshot is not None:
+            return _load_snapshot(self._snapshot)
+        return tuple(getattr(self, name) for name in Difference._STATE)
+
+    def __setstate__(self, state):
+        for name, value in zip(Difference._STATE, state):
+            setattr(self, name, value)
+        self._snapshot = None
+
+    def _set_unified_diff(self, unified_diff, hunks):
+        if not unified_diff:
+            self._diff = None
+            self._line_offsets = None
+            self._hunks = None
+            return
+        if isinstance(unified_diff, unicode):
+            unified_diff = unified_diff.encode('utf-8')
+        self._diff = unified_diff
+        # start of every line, followed by the end of the last line plus one
+        # so line i is always _diff[offsets[i]:offsets[i + 1] - 1]
+        offsets = array('I', [0])
+        offsets.extend([m.end() for m in NEWLINE_RE.finditer(unified_diff)])
+        if offsets[-1] != len(unified_diff):
+            offsets.append(len(unified_diff) + 1)
+        self._line_offsets = offsets
+        # found when first needed if the diff does not come from DiffParser
+        self._hunks = hunks
 
     @staticmethod
     def from_feeder(feeder1, feeder2, path1, path2, source=None,
                     comment=None):
         actual_comment = comment
-        unified_diff = None
+        parsed_diff = None
         try:
-            unified_diff = diff(feeder1, feeder2)
+            parsed_diff = diff(feeder1, feeder2)
+        except budget.BudgetExceeded:
+            budget.record_cut_short()
+            return Difference(None, path1, path2, source,
+                              budget.cut_short_comment())
         except RequiredToolNotFound:
             actual_comment = 'diff is not available!'
             if comment:
                 actual_comment += '\n\n' + orig_comment
-        if not unified_diff:
+        if not parsed_diff or not parsed_diff[0]:
             return None
-        return Difference(unified_diff, path1, path2, source, actual_comment)
+        unified_diff, hunks = parsed_diff
+        return Difference(unified_diff, path1, path2, source, actual_comment,
+                          hunks)
 
     @staticmethod
     def from_unicode(content1, content2, *args, **kwargs):
@@ -325,9 +761,16 @@ class Difference(object):
         command2 = cls(path2, *command_args)
         if 'source' not in kwargs:
             kwargs['source'] = ' '.join(map(lambda x: '{}' if x == command1.path else x, command1.cmdline()))
-        difference = Difference.from_feeder(make_feeder_from_command(command1),
-                                            make_feeder_from_command(command2),
-                                            path1, path2, *args, **kwargs)
+        try:
+            difference = Difference.from_feeder(make_feeder_from_command(command1),
+                                                make_feeder_from_command(command2),
+                                                path1, path2, *args, **kwargs)
+        finally:
+            # feeders stop early when the budget is exceeded
+            for command in (command1, command2):
+                if command.poll() is None:
+                    command.terminate()
+                    command.wait()
         if not difference:
             return None
         if command1.stderr_content or command2.stderr_content:
@@ -341,6 +784,16 @@ class Difference(object):
                 difference.comment += 'stderr from `%s`:\n%s\n' % (' '.join(command2.cmdline()), command2.stderr_content)
         return difference
 
+    @staticmethod
+    def from_commands(path1, path2, commands):
+        """Run independent dumps at the same time. `commands` is a list of
+        (command class, command arguments). Differences are returned in the
+        same order."""
+        differences = run_dumps([
+            partial(Difference.from_command, cls, path1, path2, command_args=command_args)
+            for cls, command_args in commands])
+        return [difference for difference in differences if difference]
+
     @property
     def comment(self):
         return self._comment
@@ -359,7 +812,38 @@ class Difference(object):
 
     @property
     def unified_diff(self):
-        return self._unified_diff
+        if self._diff is None:
+            return None
+        return self._diff.decode('utf-8')
+
+    @property
+    def has_unified_diff(self):
+        return self._diff is not None
+
+    @property
+    def line_count(self):
+        if self._diff is None:
+            return 0
+        return len(self._line_offsets) - 1
+
+    @property
+    def hunks(self):
+        if self._diff is None:
+            return []
+        if self._hunks is None:
+            self._hunks = find_hunks(self._diff.split('\n'))
+        return self._hunks
+
+    def line(self, index):
+        """Return line `index` of the unified diff, without its newline"""
+        offsets = self._line_offsets
+        return self._diff[offsets[index]:offsets[index + 1] - 1].decode('utf-8')
+
+    def unified_diff_lines(self):
+        """Iterate over the lines of the unified diff, like splitlines()"""
+        for index in xrange(self.line_count):
+            for part in self.line(index).splitlines() or [u'']:
+                yield part
 
     @property
     def details(self):
@@ -368,6 +852,22 @@ class Difference(object):
     def add_details(self, differences):
         self._details.extend(differences)
 
+    @property
+    def streamed(self):
+        return self._streamed
+
+    def mark_streamed(self):
+        if _snapshots is not None and self._snapshot is None:
+            self._snapshot = _save_snapshot(self.__getstate__())
+        # already written to the reports: only keep what is needed to
+        # know that a difference was found
+        self._streamed = True
+        self._comment = None
+        self._diff = None
+        self._line_offsets = None
+        self._hunks = None
+        self._details = []
+
 
 def get_source(path1, path2):
     if os.path.basename(path1) == os.path.basename(path2):
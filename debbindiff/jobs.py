@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+#
+# debbindiff: highlight differences between two builds of Debian packages
+#
+# Copyright © 2015 Jérémy Bobbio <lunar@debian.org>
+#
+# debbindiff is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# debbindiff is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
+
+import cPickle as pickle
+import os
+import sys
+from threading import Thread
+import traceback
+from multiprocessing import BoundedSemaphore
+from debbindiff import budget, logger
+from debbindiff.profiling import take_events, add_events
+
+
+# Semaphore shared by every process of the comparison. Each forked job
+# holds one slot while it works, so at most `jobs` processes (including
+# the main one) are busy at the same time, however deep in the container
+# recursion they were started.
+_slots = None
+
+
+def set_jobs(jobs):
+    global _slots
+    _slots = None
+    if jobs > 1:
+        try:
+            _slots = BoundedSemaphore(jobs - 1)
+        except OSError as e:
+            logger.warning('unable to create semaphore, files will be '
+                           'compared one at a time: %s', e)
+
+
+# Same for the external tools run to dump the content of a pair of files.
+# Each dump holds one slot while its tools run.
+DEFAULT_MAX_DUMPS = 4
+
+_dump_slots = None
+
+
+def set_max_dumps(count):
+    global _dump_slots
+    _dump_slots = None
+    if count > 1:
+        try:
+            _dump_slots = BoundedSemaphore(count)
+        except OSError as e:
+            logger.debug('unable to create semaphore, dumps will run one '
+                         'at a time: %s', e)
+
+
+def run_dumps(funcs):
+    """Call independent functions in threads, as many at the same time as
+    there are free dump slots. Results are returned in the order of `funcs`
+    and the first exception, in the same order, is raised again."""
+    if _dump_slots is None or len(funcs) < 2:
+        return [func() for func in funcs]
+    results = [None] * len(funcs)
+    errors = [None] * len(funcs)
+    def run(index, func):
+        try:
+            results[index] = func()
+        except BaseException:
+            errors[index] = sys.exc_info()
+        finally:
+            _dump_slots.release()
+    threads = []
+    for index, func in enumerate(funcs):
+        _dump_slots.acquire()
+        thread = Thread(target=run, args=(index, func))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    for error in errors:
+        if error:
+            raise error[0], error[1], error[2]
+    return results
+
+
+def _picklable(e):
+    try:
+        pickle.loads(pickle.dumps(e, pickle.HIGHEST_PROTOCOL))
+        return e
+    except Exception:
+        return RuntimeError(traceback.format_exc())
+
+
+class Job(object):
+    def __init__(self, func, args):
+        self._pid = None
+        self._pipe = None
+        self._result = None
+        if _slots is None or not _slots.acquire(False):
+            # no spare worker: run inline
+            self._result = func(*args)
+            return
+        try:
+            pipe_r, pipe_w = os.pipe()
+            self._pid = os.fork()
+        except OSError:
+            _slots.release()
+            raise
+        if self._pid == 0:
+            os.close(pipe_r)
+            self._run_in_child(func, args, pipe_w)
+        os.close(pipe_w)
+        self._pipe = os.fdopen(pipe_r, 'rb')
+
+    def _run_in_child(self, func, args, pipe_w):
+        try:
+            # spans recorded so far belong to the parent
+            take_events()
+            cut_short = budget.cut_short_count()
+            try:
+                outcome = (True, func(*args))
+            except BaseException as e:
+                logger.debug('job failed: %s', traceback.format_exc())
+                outcome = (False, _picklable(e))
+            outcome += (take_events(), budget.cut_short_count() - cut_short)
+            _slots.release()
+            with os.fdopen(pipe_w, 'wb') as f:
+                pickle.dump(outcome, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            # never run the cleanups of the parent
+            os._exit(0)
+
+    def done(self):
+        return self._pipe is None
+
+    def result(self):
+        if self._pipe is not None:
+            try:
+                try:
+                    success, value, events, cut_short = pickle.load(self._pipe)
+                    add_events(events)
+                    budget.add_cut_short(cut_short)
+                except EOFError:
+                    success, value = False, RuntimeError('job %d died' % self._pid)
+            finally:
+                self._pipe.close()
+                self._pipe = None
+                os.waitpid(self._pid, 0)
+            if success:
+                self._result = value
+            else:
+                raise value
+        return self._result
+
+
+class JobQueue(object):
+    """Run functions in parallel when spare workers are available.
+
+    Results are returned in submission order whatever the order in which
+    the jobs completed.
+    """
+
+    def __init__(self):
+        self._jobs = []
+
+    def submit(self, func, *args):
+        self._jobs.append(Job(func, args))
+
+    def results(self):
+        jobs, self._jobs = self._jobs, []
+        try:
+            while jobs:
+                yield jobs.pop(0).result()
+        finally:
+            # collect what is left on errors so no process gets orphaned
+            for job in jobs:
+                try:
+                    job.result()
+                except BaseException:
+                    pass
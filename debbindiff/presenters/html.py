@@ -34,7 +34,6 @@
 from __future__ import print_function
 import os.path
 import cgi
-import re
 import subprocess
 import sys
 from tempfile import NamedTemporaryFile
@@ -177,80 +176,106 @@ line1, line2 = 0, 0
 hunk_off1, hunk_size1, hunk_off2, hunk_size2 = 0, 0, 0, 0
 
 
+# replace control characters except tabs and newlines
+SANE_TABLE = dict((i, u'.') for i in range(32) if unichr(i) not in u'\t\n')
+
+# Above this amount of work, changed lines are highlighted as a whole
+# (except their common prefix and suffix)
+MAX_LINEDIFF_WORK = 20000
+
+
 def sane(x):
-    r = ""
-    for i in x:
-        j = ord(i)
-        if i not in ['\t', '\n'] and (j < 32):
-            r = r + "."
+    return unicode(x).translate(SANE_TABLE)
+
+
+def myers_diff(s, t, max_d):
+    """Shortest edit script between s and t (E. Myers, 1986)
+
+    Returns the indexes of characters deleted from s and inserted from
+    t, or None if more than max_d edits are needed.
+    """
+    n, m = len(s), len(t)
+    offset = max_d + 1
+    v = [0] * (2 * max_d + 3)
+    trace = []
+    for d in range(max_d + 1):
+        trace.append(list(v))
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and s[x] == t[y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                return myers_backtrack(trace, offset, n, m)
+    return None
+
+
+def myers_backtrack(trace, offset, x, y):
+    deleted = []
+    inserted = []
+    for d in range(len(trace) - 1, 0, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+            k = k + 1
+            x = v[offset + k]
+            y = x - k
+            inserted.append(y)
         else:
-            r = r + i
-    return r
+            k = k - 1
+            x = v[offset + k]
+            y = x - k
+            deleted.append(x)
+    return set(deleted), set(inserted)
+
+
+def highlight(s, changed):
+    r = []
+    on = False
+    for i, c in enumerate(s):
+        if (i in changed) != on:
+            r.append(on and DIFFOFF or DIFFON)
+            on = not on
+        r.append(c)
+    if on:
+        r.append(DIFFOFF)
+    return u''.join(r)
 
 
 def linediff(s, t):
     '''
-    Original line diff algorithm of diff2html. It's character based.
-    '''
-    if len(s):
-        s = unicode(reduce(lambda x, y:x+y, [ sane(c) for c in s ]))
-    if len(t):
-        t = unicode(reduce(lambda x, y:x+y, [ sane(c) for c in t ]))
-
-    m, n = len(s), len(t)
-    d = [[(0, 0) for i in range(n+1)] for i in range(m+1)]
-
-
-    d[0][0] = (0, (0, 0))
-    for i in range(m+1)[1:]:
-        d[i][0] = (i,(i-1, 0))
-    for j in range(n+1)[1:]:
-        d[0][j] = (j,(0, j-1))
-
-    for i in range(m+1)[1:]:
-        for j in range(n+1)[1:]:
-            if s[i-1] == t[j-1]:
-                cost = 0
-            else:
-                cost = 1
-            d[i][j] = min((d[i-1][j][0] + 1, (i-1, j)),
-                          (d[i][j-1][0] + 1, (i, j-1)),
-                          (d[i-1][j-1][0] + cost, (i-1, j-1)))
-
-    l = []
-    coord = (m, n)
-    while coord != (0, 0):
-        l.insert(0, coord)
-        x, y = coord
-        coord = d[x][y][1]
-
-    l1 = []
-    l2 = []
-
-    for coord in l:
-        cx, cy = coord
-        child_val = d[cx][cy][0]
-
-        father_coord = d[cx][cy][1]
-        fx, fy = father_coord
-        father_val = d[fx][fy][0]
-
-        diff = (cx-fx, cy-fy)
-
-        if diff == (0, 1):
-            l1.append("")
-            l2.append(DIFFON + t[fy] + DIFFOFF)
-        elif diff == (1, 0):
-            l1.append(DIFFON + s[fx] + DIFFOFF)
-            l2.append("")
-        elif child_val-father_val == 1:
-            l1.append(DIFFON + s[fx] + DIFFOFF)
-            l2.append(DIFFON + t[fy] + DIFFOFF)
-        else:
-            l1.append(s[fx])
-            l2.append(t[fy])
+    Character based line diff.
 
-    r1, r2 = (reduce(lambda x, y:x+y, l1), reduce(lambda x, y:x+y, l2))
+    Changed characters are enclosed between DIFFON and DIFFOFF.
+    '''
+    s = sane(s)
+    t = sane(t)
+    # common prefix and suffix never need to be looked at
+    prefix = 0
+    while prefix < min(len(s), len(t)) and s[prefix] == t[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < min(len(s), len(t)) - prefix and s[-1 - suffix] == t[-1 - suffix]:
+        suffix += 1
+    middle1 = s[prefix:len(s) - suffix]
+    middle2 = t[prefix:len(t) - suffix]
+    edits = None
+    if middle1 and middle2:
+        max_d = MAX_LINEDIFF_WORK // (len(middle1) + len(middle2))
+        edits = myers_diff(middle1, middle2, min(max_d, len(middle1) + len(middle2)))
+    if edits is None:
+        # too costly, or one side is empty: highlight everything
+        deleted = range(len(middle1))
+        inserted = range(len(middle2))
+    else:
+        deleted, inserted = edits
+    r1 = s[:prefix] + highlight(middle1, set(deleted)) + s[len(s) - suffix:]
+    r2 = t[:prefix] + highlight(middle2, set(inserted)) + t[len(t) - suffix:]
     return r1, r2
 
 
@@ -297,7 +322,9 @@ def output_hunk(print_func):
     print_func(u'<td colspan="2">Offset %d, %d lines modified</td></tr>\n'%(hunk_off2, hunk_size2))
 
 
-def output_line(print_func, s1, s2):
+# count1 and count2 are the number of lines s1 and s2 stand for: more than
+# one for "[ N lines removed ]"
+def output_line(print_func, s1, s2, count1=1, count2=1):
     global line1
     global line2
 
@@ -345,16 +372,10 @@ def output_line(print_func, s1, s2):
     finally:
         print_func(u"</tr>\n", force=True)
 
-    m = orig1 and re.match(r"^\[ (\d+) lines removed \]$", orig1)
-    if m:
-        line1 += int(m.group(1))
-    elif orig1 is not None:
-        line1 += 1
-    m = orig2 and re.match(r"^\[ (\d+) lines removed \]$", orig2)
-    if m:
-        line2 += int(m.group(1))
-    elif orig2 is not None:
-        line2 += 1
+    if orig1 is not None:
+        line1 += count1
+    if orig2 is not None:
+        line2 += count2
 
 
 def empty_buffer(print_func):
@@ -364,30 +385,69 @@ def empty_buffer(print_func):
 
     if del_cpt == 0 or add_cpt == 0:
         for l in buf:
-            output_line(print_func, l[0], l[1])
+            output_line(print_func, *l)
 
     elif del_cpt != 0 and add_cpt != 0:
         l0, l1 = [], []
         for l in buf:
             if l[0] != None:
-                l0.append(l[0])
+                l0.append((l[0], l[2]))
             if l[1] != None:
-                l1.append(l[1])
+                l1.append((l[1], l[3]))
         max_len = (len(l0) > len(l1)) and len(l0) or len(l1)
         for i in range(max_len):
             s0, s1 = "", ""
+            count0, count1 = 1, 1
             if i < len(l0):
-                s0 = l0[i]
+                s0, count0 = l0[i]
             if i < len(l1):
-                s1 = l1[i]
-            output_line(print_func, s0, s1)
+                s1, count1 = l1[i]
+            output_line(print_func, s0, s1, count0, count1)
 
     add_cpt, del_cpt = 0, 0
     buf = []
 
 
-def output_unified_diff(print_func, unified_diff):
+def output_hunk_line(print_func, l, skipped):
     global add_cpt, del_cpt
+    global hunk_size1, hunk_size2
+
+    if l[:1] == '\\':
+        if hunk_size2 == 0:
+            buf[-1] = (buf[-1][0], buf[-1][1] + '\n' + l[2:], buf[-1][2], buf[-1][3])
+        else:
+            buf[-1] = (buf[-1][0] + '\n' + l[2:], buf[-1][1], buf[-1][2], buf[-1][3])
+        return
+
+    if hunk_size1 <= 0 and hunk_size2 <= 0:
+        empty_buffer(print_func)
+        return
+
+    if l[:1] == '+':
+        count = skipped or 1
+        add_cpt += count
+        hunk_size2 -= count
+        buf.append((None, l[1:], 1, count))
+        return
+
+    if l[:1] == '-':
+        count = skipped or 1
+        del_cpt += count
+        hunk_size1 -= count
+        buf.append((l[1:], None, count, 1))
+        return
+
+    if l[:1] == ' ' and hunk_size1 and hunk_size2:
+        empty_buffer(print_func)
+        hunk_size1 -= 1
+        hunk_size2 -= 1
+        buf.append((l[1:], l[1:], 1, 1))
+        return
+
+    empty_buffer(print_func)
+
+
+def output_unified_diff(print_func, difference):
     global line1, line2
     global hunk_off1, hunk_size1, hunk_off2, hunk_size2
 
@@ -396,103 +456,65 @@ def output_unified_diff(print_func, unified_diff):
         print_func(u'<colgroup><col style="width: 3em;"/><col style="99%"/>\n')
         print_func(u'<col style="width: 3em;"/><col style="99%"/></colgroup>\n')
 
-        for l in unified_diff.splitlines():
-            m = re.match(r'^--- ([^\s]*)', l)
-            if m:
-                empty_buffer(print_func)
-                continue
-            m = re.match(r'^\+\+\+ ([^\s]*)', l)
-            if m:
-                empty_buffer(print_func)
-                continue
-
-            m = re.match(r"@@ -(\d+),?(\d*) \+(\d+),?(\d*)", l)
-            if m:
-                empty_buffer(print_func)
-                hunk_data = map(lambda x:x=="" and 1 or int(x), m.groups())
-                hunk_off1, hunk_size1, hunk_off2, hunk_size2 = hunk_data
-                line1, line2 = hunk_off1, hunk_off2
-                output_hunk(print_func)
-                continue
-
-            if re.match(r'^\[', l):
-                empty_buffer(print_func)
-                print_func(u'<td colspan="2">%s</td>\n' % l)
-
-            if re.match(r"^\\ No newline", l):
-                if hunk_size2 == 0:
-                    buf[-1] = (buf[-1][0], buf[-1][1] + '\n' + l[2:])
-                else:
-                    buf[-1] = (buf[-1][0] + '\n' + l[2:], buf[-1][1])
-                continue
-
-            if hunk_size1 <= 0 and hunk_size2 <= 0:
-                empty_buffer(print_func)
-                continue
-
-            m = re.match(r"^\+\[ (\d+) lines removed \]$", l)
-            if m:
-                add_cpt += int(m.group(1))
-                hunk_size2 -= int(m.group(1))
-                buf.append((None, l[1:]))
-                continue
-
-            if re.match(r"^\+", l):
-                add_cpt += 1
-                hunk_size2 -= 1
-                buf.append((None, l[1:]))
-                continue
-
-            m = re.match(r"^-\[ (\d+) lines removed \]$", l)
-            if m:
-                del_cpt += int(m.group(1))
-                hunk_size1 -= int(m.group(1))
-                buf.append((l[1:], None))
-                continue
-
-            if re.match(r"^-", l):
-                del_cpt += 1
-                hunk_size1 -= 1
-                buf.append((l[1:], None))
-                continue
-
-            if re.match(r"^ ", l) and hunk_size1 and hunk_size2:
-                empty_buffer(print_func)
-                hunk_size1 -= 1
-                hunk_size2 -= 1
-                buf.append((l[1:], l[1:]))
-                continue
-
+        end = 0
+        for hunk in difference.hunks:
+            empty_buffer(print_func)
+            hunk_off1, hunk_size1 = hunk.start1, hunk.len1
+            hunk_off2, hunk_size2 = hunk.start2, hunk.len2
+            line1, line2 = hunk_off1, hunk_off2
+            output_hunk(print_func)
+            skipped = hunk.skipped or {}
+            for index in xrange(hunk.first + 1, hunk.end):
+                # like splitlines(), lines also end on "\r" and friends
+                parts = difference.line(index).splitlines() or [u'']
+                output_hunk_line(print_func, parts[0], skipped.get(index))
+                for part in parts[1:]:
+                    output_hunk_line(print_func, part, None)
+            end = hunk.end
+
+        # what comes after the last hunk, like "[ Processing stopped... ]"
+        for index in xrange(end, difference.line_count):
+            l = difference.line(index)
             empty_buffer(print_func)
+            if l.startswith('['):
+                print_func(u'<td colspan="2">%s</td>\n' % l)
 
         empty_buffer(print_func)
     finally:
         print_func(u"</table>", force=True)
 
 
+def output_difference_header(difference, print_func, sources):
+    print_func(u"<div class='diffheader'>")
+    if difference.source1 == difference.source2:
+        print_func(u"<div><span class='source'>%s<span>"
+                   % escape(difference.source1))
+    else:
+        print_func(u"<div><span class='source'>%s</span> vs.</div>"
+                   % escape(difference.source1))
+        print_func(u"<div><span class='source'>%s</span>"
+                   % escape(difference.source2))
+    anchor = '/'.join(sources[1:])
+    print_func(u" <a class='anchor' href='#%s' name='%s'>&para;</a>" % (anchor, anchor))
+    print_func(u"</div>")
+    if difference.comment:
+        output_comment(difference, print_func)
+    print_func(u"</div>")
+
+
+def output_comment(difference, print_func):
+    print_func(u"<div class='comment'>%s</div>"
+               % escape(difference.comment).replace('\n', '<br />'))
+
+
 def output_difference(difference, print_func, parents):
     logger.debug('html output for %s', difference.source1)
     sources = parents + [difference.source1]
     print_func(u"<div class='difference'>")
     try:
-        print_func(u"<div class='diffheader'>")
-        if difference.source1 == difference.source2:
-            print_func(u"<div><span class='source'>%s<span>"
-                       % escape(difference.source1))
-        else:
-            print_func(u"<div><span class='source'>%s</span> vs.</div>"
-                       % escape(difference.source1))
-            print_func(u"<div><span class='source'>%s</span>"
-                       % escape(difference.source2))
-        anchor = '/'.join(sources[1:])
-        print_func(u" <a class='anchor' href='#%s' name='%s'>&para;</a>" % (anchor, anchor))
-        print_func(u"</div>")
-        if difference.comment:
-            print_func(u"<div class='comment'>%s</div>"
-                       % escape(difference.comment).replace('\n', '<br />'))
-        print_func(u"</div>")
-        if difference.unified_diff:
-            output_unified_diff(print_func, difference.unified_diff)
+        output_difference_header(difference, print_func, sources)
+        if difference.has_unified_diff:
+            output_unified_diff(print_func, difference)
         for detail in difference.details:
             output_difference(detail, print_func, sources)
     except PrintLimitReached:
@@ -513,17 +535,83 @@ def output_header(css_url, print_func):
 
 
 def output_html(differences, css_url=None, print_func=None, max_page_size=None):
-    if print_func is None:
-        print_func = print
-    if max_page_size is None:
-        max_page_size = DEFAULT_MAX_PAGE_SIZE
-    print_func = create_limited_print_func(print_func, max_page_size)
-    try:
-        output_header(css_url, print_func)
-        for difference in differences:
-            output_difference(difference, print_func, [])
-    except PrintLimitReached:
-        logger.debug('print limit reached')
-        print_func(u"<div class='error'>Max output size reached.</div>",
-                   force=True)
-    print_func(FOOTER % {'version': VERSION}, force=True)
+    presenter = HTMLPresenter(print_func, css_url, max_page_size)
+    presenter.start()
+    for difference in differences:
+        presenter.write_difference(difference, 0)
+    presenter.finish()
+
+
+def limit_reached(method):
+    def wrapper(self, *args, **kwargs):
+        if self._limit_reached:
+            return
+        try:
+            return method(self, *args, **kwargs)
+        except PrintLimitReached:
+            logger.debug('print limit reached')
+            for _ in self._open:
+                self._print_func(u"</div>", force=True)
+            self._print_func(u"<div class='error'>Max output size reached.</div>",
+                             force=True)
+            self._limit_reached = True
+    return wrapper
+
+
+# Write differences as they are streamed: see debbindiff.streaming
+class HTMLPresenter(object):
+    def __init__(self, print_func=None, css_url=None, max_page_size=None):
+        if print_func is None:
+            print_func = print
+        if max_page_size is None:
+            max_page_size = DEFAULT_MAX_PAGE_SIZE
+        self._print_func = create_limited_print_func(print_func, max_page_size)
+        self._css_url = css_url
+        self._started = False
+        self._limit_reached = False
+        # for each open difference: its sources for anchors, was the
+        # comment printed, was the diff printed
+        self._open = []
+
+    def _sources(self):
+        if self._open:
+            return self._open[-1][0]
+        return []
+
+    def start(self):
+        if not self._started:
+            self._started = True
+            output_header(self._css_url, self._print_func)
+
+    @limit_reached
+    def open_difference(self, difference, depth):
+        self.start()
+        sources = self._sources() + [difference.source1]
+        self._print_func(u"<div class='difference'>")
+        self._open.append([sources, bool(difference.comment),
+                           difference.has_unified_diff])
+        output_difference_header(difference, self._print_func, sources)
+        if difference.has_unified_diff:
+            output_unified_diff(self._print_func, difference)
+
+    @limit_reached
+    def write_difference(self, difference, depth):
+        self.start()
+        output_difference(difference, self._print_func, self._sources())
+
+    @limit_reached
+    def close_difference(self, difference, depth):
+        sources, comment_printed, diff_printed = self._open[-1]
+        if difference.comment and not comment_printed:
+            output_comment(difference, self._print_func)
+        if difference.has_unified_diff and not diff_printed:
+            output_unified_diff(self._print_func, difference)
+        for detail in difference.details:
+            if not detail.streamed:
+                output_difference(detail, self._print_func, sources)
+        self._open.pop()
+        self._print_func(u"</div>", force=True)
+
+    def finish(self):
+        if self._started:
+            self._print_func(FOOTER % {'version': VERSION}, force=True)
@@ -25,36 +25,119 @@ import locale
 from debbindiff import logger
 
 
+def print_comment(difference, print_func):
+    for line in difference.comment.split('\n'):
+        print_func(u"│┄ %s" % line)
+
+def print_unified_diff(difference, print_func):
+    for line in difference.unified_diff_lines():
+        print_func(u"│ %s" % line)
+
 def print_difference(difference, print_func):
     if difference.comment:
-        for line in difference.comment.split('\n'):
-            print_func(u"│┄ %s" % line)
-    if difference.unified_diff:
-        for line in difference.unified_diff.splitlines():
-            print_func(u"│ %s" % line)
+        print_comment(difference, print_func)
+    if difference.has_unified_diff:
+        print_unified_diff(difference, print_func)
+
+def print_header(difference, print_func):
+    if difference.source1 == difference.source2:
+        print_func(u"├── %s" % difference.source1)
+    else:
+        print_func(u"│   --- %s" % (difference.source1))
+        print_func(u"├── +++ %s" % (difference.source2))
+
+def print_top_header(difference, print_func):
+    print_func("--- %s" % (difference.source1))
+    print_func("+++ %s" % (difference.source2))
+
+def nested_print_func(print_func):
+    def new_print_func(*args, **kwargs):
+        print_func(u'│  ', *args, **kwargs)
+    return new_print_func
 
 def print_details(difference, print_func):
     if not difference.details:
         return
     for detail in difference.details:
-        if detail.source1 == detail.source2:
-            print_func(u"├── %s" % detail.source1)
-        else:
-            print_func(u"│   --- %s" % (detail.source1))
-            print_func(u"├── +++ %s" % (detail.source2))
+        print_header(detail, print_func)
         print_difference(detail, print_func)
-        def new_print_func(*args, **kwargs):
-            print_func(u'│  ', *args, **kwargs)
-        print_details(detail, new_print_func)
+        print_details(detail, nested_print_func(print_func))
     print_func(u'╵')
 
 def output_text(differences, print_func):
-    try:
-        for difference in differences:
-            print_func("--- %s" % (difference.source1))
-            print_func("+++ %s" % (difference.source2))
-            print_difference(difference, print_func)
-            print_details(difference, print_func)
-    except UnicodeEncodeError:
-        logger.critical('Console is unable to print Unicode characters. Set LC_CTYPE=C.UTF-8')
-        sys.exit(2)
+    presenter = TextPresenter(print_func)
+    for difference in differences:
+        presenter.write_difference(difference, 0)
+
+
+def unicode_required(method):
+    def wrapper(*args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        except UnicodeEncodeError:
+            logger.critical('Console is unable to print Unicode characters. Set LC_CTYPE=C.UTF-8')
+            sys.exit(2)
+    return wrapper
+
+
+# Write differences as they are streamed: see debbindiff.streaming
+class TextPresenter(object):
+    def __init__(self, print_func):
+        self._print_funcs = [print_func]
+        # for each open difference: was the comment printed, was the diff
+        # printed, how many details were printed
+        self._open = []
+
+    def _print_func(self, depth):
+        while len(self._print_funcs) <= depth:
+            self._print_funcs.append(nested_print_func(self._print_funcs[-1]))
+        return self._print_funcs[depth]
+
+    def _detail_written(self):
+        if self._open:
+            self._open[-1][2] += 1
+
+    @unicode_required
+    def open_difference(self, difference, depth):
+        print_func = self._print_func(max(depth - 1, 0))
+        if depth == 0:
+            print_top_header(difference, print_func)
+        else:
+            print_header(difference, print_func)
+        print_difference(difference, print_func)
+        self._detail_written()
+        self._open.append([bool(difference.comment),
+                           difference.has_unified_diff, 0])
+
+    @unicode_required
+    def write_difference(self, difference, depth):
+        print_func = self._print_func(max(depth - 1, 0))
+        if depth == 0:
+            print_top_header(difference, print_func)
+        else:
+            print_header(difference, print_func)
+        print_difference(difference, print_func)
+        print_details(difference, self._print_func(depth))
+        self._detail_written()
+
+    @unicode_required
+    def close_difference(self, difference, depth):
+        comment_printed, diff_printed, details_count = self._open.pop()
+        print_func = self._print_func(max(depth - 1, 0))
+        if difference.comment and not comment_printed:
+            print_comment(difference, print_func)
+        if difference.has_unified_diff and not diff_printed:
+            print_unified_diff(difference, print_func)
+        print_func = self._print_func(depth)
+        for detail in difference.details:
+            if detail.streamed:
+                continue
+            print_header(detail, print_func)
+            print_difference(detail, print_func)
+            print_details(detail, self._print_func(depth + 1))
+            details_count += 1
+        if details_count > 0:
+            print_func(u'╵')
+
+    def finish(self):
+        pass
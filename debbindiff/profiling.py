@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+#
+# debbindiff: highlight differences between two builds of Debian packages
+#
+# Copyright © 2015 Jérémy Bobbio <lunar@debian.org>
+#
+# debbindiff is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# debbindiff is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+
+from contextlib import contextmanager
+import json
+import os
+import sys
+import thread
+import time
+
+
+# Spans are recorded as "complete" events of the Chrome trace event format,
+# which can be loaded in chrome://tracing. Spans of a process or a thread
+# are nested by time, so compare_files spans follow the Difference tree.
+# Subprocesses get their own track, named after their pid.
+
+SUMMARY_SIZE = 20
+
+_events = None
+
+
+def set_profile(enabled):
+    global _events
+    if enabled:
+        _events = []
+    else:
+        _events = None
+
+
+def is_enabled():
+    return _events is not None
+
+
+def now():
+    return time.time() * 1e6  # microseconds
+
+
+class Span(object):
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.tid = None
+
+
+def add_span(span, start, end):
+    _events.append({'name': span.name,
+                    'cat': span.category,
+                    'ph': 'X',
+                    'ts': start,
+                    'dur': end - start,
+                    'pid': os.getpid(),
+                    'tid': span.tid or thread.get_ident(),
+                    'args': span.args,
+                   })
+
+
+@contextmanager
+def span(name, category, **args):
+    """Record how long the block takes. The yielded Span can be changed
+    to rename the span or to record more arguments."""
+    if _events is None:
+        yield Span(name, category, args)
+        return
+    s = Span(name, category, args)
+    start = now()
+    try:
+        yield s
+    finally:
+        add_span(s, start, now())
+
+
+# forked jobs send their spans back with their results
+
+def take_events():
+    global _events
+    if _events is None:
+        return None
+    events, _events = _events, []
+    return events
+
+
+def add_events(events):
+    if _events is not None and events:
+        _events.extend(events)
+
+
+def self_times(events):
+    """Return the duration of each event minus the one of its children"""
+    result = {}
+    tracks = {}
+    for index, event in enumerate(events):
+        tracks.setdefault((event['pid'], event['tid']), []).append(index)
+    for indexes in tracks.values():
+        indexes.sort(key=lambda i: (events[i]['ts'], -events[i]['dur']))
+        stack = []
+        for index in indexes:
+            event = events[index]
+            while stack and events[stack[-1]]['ts'] + events[stack[-1]]['dur'] <= event['ts']:
+                stack.pop()
+            result[index] = event['dur']
+            if stack:
+                result[stack[-1]] -= event['dur']
+            stack.append(index)
+    return result
+
+
+def print_summary(events, print_func, count=SUMMARY_SIZE):
+    totals = {}
+    selfs = self_times(events)
+    for index, event in enumerate(events):
+        key = (event['cat'], event['name'])
+        calls, total, self_total = totals.get(key, (0, 0, 0))
+        totals[key] = (calls + 1, total + event['dur'], self_total + selfs[index])
+    print_func('%-12s %-40s %8s %10s %10s' % ('category', 'name', 'calls', 'total (s)', 'self (s)'))
+    for (category, name), (calls, total, self_total) in \
+            sorted(totals.items(), key=lambda item: -item[1][2])[:count]:
+        print_func('%-12s %-40s %8d %10.3f %10.3f' % (
+            category, name[:40], calls, total / 1e6, self_total / 1e6))
+
+
+def write_profile(path):
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': _events, 'displayTimeUnit': 'ms'}, f)
+    print_summary(_events, lambda s: print(s, file=sys.stderr))
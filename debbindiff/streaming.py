@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+#
+# debbindiff: highlight differences between two builds of Debian packages
+#
+# Copyright © 2015 Jérémy Bobbio <lunar@debian.org>
+#
+# debbindiff is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# debbindiff is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
+
+from contextlib import contextmanager
+import os
+from debbindiff.profiling import span
+
+
+# Differences are written to the reports as soon as a subtree is known,
+# instead of once the whole comparison is done.
+#
+# Containers open the node that will hold their members before comparing
+# them. Nothing is written for an open node until one of its members is
+# emitted: the headers of every open node down to it are written then,
+# followed by the member. When the container is done, the rest of the node
+# (the details that were not emitted) is written and the node is closed.
+# Subtrees that have been written are emptied to free the memory they use.
+#
+# Some details are only known by the caller of a comparator once it has
+# returned, like the metadata of directory members. closing_details() gives
+# them to the next node the comparator opens for the compared files
+# themselves (with for_files=True): if the node has been written, they are
+# written last when it is closed. They are not added to the node, so what
+# the comparator returns is left as it is and can be cached.
+
+class _Entry(object):
+    def __init__(self, difference):
+        self.difference = difference
+        self.written = difference is None
+        # details that come before the next emitted one
+        self.pending = []
+        # see closing_details()
+        self.get_closing_details = None
+        self.next_closing_details = None
+
+
+class Stream(object):
+    def __init__(self, presenters):
+        self._presenters = presenters
+        self._pid = os.getpid()
+        # the first entry stands for the top-level list of differences
+        self._stack = [_Entry(None)]
+        self._suspended = 0
+
+    def active(self):
+        # forked jobs send their results back to the main process
+        return self._suspended == 0 and os.getpid() == self._pid
+
+    def set_pending(self, differences):
+        if self.active():
+            self._stack[-1].pending = differences
+
+    def open(self, difference, for_files=False):
+        if not self.active():
+            return None
+        entry = _Entry(difference)
+        parent = self._stack[-1]
+        if for_files:
+            entry.get_closing_details = parent.next_closing_details
+            parent.next_closing_details = None
+        self._stack.append(entry)
+        return entry
+
+    def close(self, entry, difference):
+        if entry is None:
+            return
+        assert self._stack[-1] is entry
+        self._stack.pop()
+        if entry.written:
+            depth = len(self._stack) - 1
+            if entry.get_closing_details:
+                closing_details = entry.get_closing_details()
+                if closing_details:
+                    # after the details of the node
+                    for detail in difference.details:
+                        if not detail.streamed:
+                            self._write(detail, depth + 1)
+                    for detail in closing_details:
+                        self._write(detail, depth + 1)
+            self._present('close_difference', difference, depth)
+            difference.mark_streamed()
+
+    def _present(self, method, *args):
+        for presenter in self._presenters:
+            name = '%s.%s' % (presenter.__class__.__name__, method)
+            with span(name, 'present'):
+                getattr(presenter, method)(*args)
+
+    def emit(self, difference):
+        if not self.active() or difference.streamed:
+            return
+        self._write_stack()
+        self._write(difference, len(self._stack) - 1)
+
+    def _write(self, difference, depth):
+        self._present('write_difference', difference, depth)
+        difference.mark_streamed()
+
+    def _write_pending(self, depth):
+        for difference in self._stack[depth].pending:
+            if not difference.streamed:
+                self._write(difference, depth)
+
+    def _write_stack(self):
+        for depth, entry in enumerate(self._stack):
+            if not entry.written:
+                self._write_pending(depth - 1)
+                self._present('open_difference', entry.difference, depth - 1)
+                entry.written = True
+        self._write_pending(len(self._stack) - 1)
+
+    @contextmanager
+    def closing_details(self, get_details):
+        if not self.active():
+            yield
+            return
+        entry = self._stack[-1]
+        entry.next_closing_details = get_details
+        try:
+            yield
+        finally:
+            entry.next_closing_details = None
+
+    @contextmanager
+    def suspended(self):
+        self._suspended += 1
+        try:
+            yield
+        finally:
+            self._suspended -= 1
+
+    def finish(self, differences):
+        for difference in differences:
+            self.emit(difference)
+        self._present('finish')
+
+
+class _NoStream(object):
+    def active(self):
+        return False
+
+    def set_pending(self, differences):
+        pass
+
+    def open(self, difference, for_files=False):
+        return None
+
+    def close(self, entry, difference):
+        pass
+
+    def emit(self, difference):
+        pass
+
+    @contextmanager
+    def closing_details(self, get_details):
+        yield
+
+    @contextmanager
+    def suspended(self):
+        yield
+
+
+_stream = _NoStream()
+
+
+def set_presenters(presenters):
+    global _stream
+    if presenters:
+        _stream = Stream(presenters)
+    else:
+        _stream = _NoStream()
+    return _stream
+
+
+def get_stream():
+    return _stream
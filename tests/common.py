@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+#
+# debbindiff: highlight differences between two builds of Debian packages
+#
+# Copyright © 2015 Jérémy Bobbio <lunar@debian.org>
+#
+# debbindiff is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# debbindiff is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
+
+import codecs
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import unittest
+
+
+DEBBINDIFF = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir, 'debbindiff.py')
+
+
+def run_debbindiff(*args):
+    """Run debbindiff.py and return its exit status and what it wrote on
+    stderr"""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(DEBBINDIFF)] + sys.path)
+    p = subprocess.Popen([sys.executable, DEBBINDIFF] + list(args),
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         env=env)
+    _, stderr = p.communicate()
+    return p.returncode, stderr
+
+
+def read_report(path):
+    if not os.path.exists(path):
+        return None
+    with codecs.open(path, encoding='utf-8') as f:
+        return f.read()
+
+
+def write_file(path, content):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(content)
+    # same times on both sides: only the content makes a difference
+    os.utime(path, (1420070400, 1420070400))
+    return path
+
+
+def make_tree(directory, variant):
+    """Create a small tree of text files, binaries and a compressed tar
+    archive. Trees made with different variants differ in a few files."""
+    for index in range(8):
+        write_file(os.path.join(directory, 'doc', 'file%d.txt' % index),
+                   ''.join('line %d of file %d\n' % (line, index)
+                           for line in range(50)) +
+                   ('variant %s\n' % variant if index % 3 == 0 else ''))
+    write_file(os.path.join(directory, 'bin', 'data.bin'),
+               ''.join(chr((i * 7 + (i % 50 == 0 and variant == 'b')) % 256)
+                       for i in range(4096)))
+    content = os.path.join(directory, 'content')
+    write_file(os.path.join(content, 'README'), 'readme %s\n' % variant)
+    write_file(os.path.join(content, 'same'), 'same content\n')
+    with tarfile.open(os.path.join(directory, 'archive.tar.gz'), 'w:gz') as tar:
+        for name in ('README', 'same'):
+            info = tar.gettarinfo(os.path.join(content, name), name)
+            info.mtime = 1420070400
+            info.uname = info.gname = 'root'
+            info.uid = info.gid = 0
+            with open(os.path.join(content, name), 'rb') as f:
+                tar.addfile(info, f)
+    shutil.rmtree(content)
+    os.utime(os.path.join(directory, 'archive.tar.gz'), (1420070400, 1420070400))
+    for path in (directory, os.path.join(directory, 'doc'), os.path.join(directory, 'bin')):
+        os.utime(path, (1420070400, 1420070400))
+    return directory
+
+
+class TempDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(suffix='debbindiff')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, *names):
+        return os.path.join(self.directory, *names)
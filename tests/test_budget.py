@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+#
+# debbindiff: highlight differences between two builds of Debian packages
+#
+# Copyright © 2015 Jérémy Bobbio <lunar@debian.org>
+#
+# debbindiff is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# debbindiff is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
+
+from StringIO import StringIO
+import unittest
+from debbindiff.budget import set_budget, cut_short_count
+from debbindiff.comparators.tar import compare_tar_files
+from debbindiff.comparators.utils import MemberQueue
+from debbindiff.difference import Difference, BUDGET_CHECK_LINES
+from common import TempDirTestCase, make_tree, read_report, run_debbindiff, \
+    write_file
+
+
+class BudgetExitStatusTest(TempDirTestCase):
+    def compare(self, *options):
+        text = self.path('report.txt')
+        status, stderr = run_debbindiff(*(list(options) + [
+            '--text', text, self.path('a'), self.path('b')]))
+        return status, stderr, read_report(text)
+
+    def test_same_size_files_past_deadline(self):
+        write_file(self.path('a'), 'same size, content a\n')
+        write_file(self.path('b'), 'same size, content b\n')
+        status, stderr, report = self.compare('--max-runtime', '0')
+        self.assertEqual(status, 3, stderr)
+        self.assertIn('Comparison cut short (time budget exceeded): '
+                      'sizes are the same', report)
+
+    def test_same_member_lists_over_memory(self):
+        write_file(self.path('a', 'doc', 'README'), 'readme a\n')
+        write_file(self.path('b', 'doc', 'README'), 'readme b\n')
+        status, stderr, report = self.compare('--max-memory', '1000')
+        self.assertEqual(status, 3, stderr)
+        self.assertIn('Comparison cut short (memory budget exceeded): '
+                      'member lists are the same', report)
+
+    def test_enough_budget(self):
+        make_tree(self.path('a'), 'a')
+        make_tree(self.path('b'), 'b')
+        status, stderr, report = self.compare('--max-runtime', '3600')
+        self.assertEqual(status, 1, stderr)
+        self.assertNotIn('cut short', report)
+        self.assertIn('readme a', report)
+
+    def test_identical_files_within_budget(self):
+        write_file(self.path('a'), 'same content\n')
+        write_file(self.path('b'), 'same content\n')
+        status, stderr, report = self.compare('--max-runtime', '3600')
+        self.assertEqual(status, 0, stderr)
+        self.assertIsNone(report)
+
+
+class CutShortTest(TempDirTestCase):
+    def setUp(self):
+        super(CutShortTest, self).setUp()
+        set_budget(max_runtime=0)
+
+    def tearDown(self):
+        set_budget()
+        super(CutShortTest, self).tearDown()
+
+    def test_feeder_stops(self):
+        lines = ['line %d\n' % index for index in range(2 * BUDGET_CHECK_LINES)]
+        difference = Difference.from_file(StringIO(''.join(lines)),
+                                          StringIO(''.join(reversed(lines))),
+                                          'a', 'b')
+        self.assertEqual(difference.comment,
+                         'Comparison cut short (time budget exceeded)')
+        self.assertEqual(cut_short_count(), 1)
+
+    def test_members_are_not_extracted(self):
+        make_tree(self.path('a'), 'a')
+        make_tree(self.path('b'), 'b')
+        difference = compare_tar_files(self.path('a', 'archive.tar.gz'),
+                                       self.path('b', 'archive.tar.gz'))[0]
+        self.assertEqual([(detail.source1, detail.comment)
+                          for detail in difference.details],
+                         [('README', 'Comparison cut short (time budget exceeded)')])
+        self.assertEqual(cut_short_count(), 1)
+
+    def test_member_queue(self):
+        queue = MemberQueue()
+        self.assertTrue(queue.cut_short('member'))
+        differences = queue.differences()
+        self.assertEqual(len(differences), 1)
+        self.assertEqual(differences[0].source1, 'member')
+        self.assertEqual(cut_short_count(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
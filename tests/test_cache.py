@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+#
+# debbindiff: highlight differences between two builds of Debian packages
+#
+# Copyright © 2015 Jérémy Bobbio <lunar@debian.org>
+#
+# debbindiff is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# debbindiff is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import unittest
+from debbindiff import tool_required
+from debbindiff.cache import ResultCache, call_comparator, get_available_tools, \
+    get_file_digest, hash_file, record_digest, set_cache
+from debbindiff.difference import set_diff_backend
+from common import TempDirTestCase, write_file
+
+
+def compare_lengths(path1, path2, source=None):
+    compare_lengths.calls += 1
+    return [os.path.getsize(path1) - os.path.getsize(path2)]
+compare_lengths.calls = 0
+
+
+class ResultCacheTest(TempDirTestCase):
+    def setUp(self):
+        super(ResultCacheTest, self).setUp()
+        self.cache = ResultCache(self.path('cache'))
+        self.file1 = write_file(self.path('a'), 'content a\n')
+        self.file2 = write_file(self.path('b'), 'content b\n')
+
+    def tearDown(self):
+        set_diff_backend('auto')
+        super(ResultCacheTest, self).tearDown()
+
+    def key(self, cache=None, **kwargs):
+        return (cache or self.cache).key(compare_lengths, self.file1, self.file2,
+                                         None, kwargs)
+
+    def test_miss_then_hit(self):
+        key = self.key()
+        self.assertIsNone(self.cache.get(key))
+        self.cache.put(key, ['result'])
+        self.assertEqual(self.cache.get(key), ['result'])
+
+    def test_key_depends_on_content(self):
+        key = self.key()
+        write_file(self.file2, 'content c\n')
+        self.assertNotEqual(self.key(), key)
+
+    def test_key_depends_on_options(self):
+        key = self.key()
+        self.assertNotEqual(self.key(depth=1), key)
+        set_diff_backend('external')
+        self.assertNotEqual(self.key(), key)
+
+    def test_key_depends_on_tools(self):
+        key = self.key()
+        tool_required.all.add('sh')
+        try:
+            self.assertIn('sh', get_available_tools())
+            self.assertNotEqual(self.key(ResultCache(self.path('cache'))), key)
+        finally:
+            tool_required.all.discard('sh')
+        tool_required.all.add('debbindiff-missing-tool')
+        try:
+            self.assertNotIn('debbindiff-missing-tool', get_available_tools())
+        finally:
+            tool_required.all.discard('debbindiff-missing-tool')
+
+    def test_corrupt_entry(self):
+        key = self.key()
+        self.cache.put(key, ['result'])
+        path = self.cache._path(key)
+        with open(path, 'wb') as f:
+            f.write('not a pickle')
+        self.assertIsNone(self.cache.get(key))
+        self.assertFalse(os.path.exists(path))
+
+    def test_least_recently_used_are_evicted(self):
+        keys = [self.key(index=index) for index in range(4)]
+        for index, key in enumerate(keys[:3]):
+            self.cache.put(key, ['x' * 1000])
+            os.utime(self.cache._path(key), (1420070400 + index, 1420070400 + index))
+        entry_size = os.path.getsize(self.cache._path(keys[0]))
+        self.cache._max_size = entry_size * 7 / 2
+        # the first one becomes the most recently used
+        self.assertIsNotNone(self.cache.get(keys[0]))
+        self.cache.put(keys[3], ['x' * 1000])
+        self.assertIsNone(self.cache.get(keys[1]))
+        for key in (keys[0], keys[2], keys[3]):
+            self.assertIsNotNone(self.cache.get(key))
+
+
+class CallComparatorTest(TempDirTestCase):
+    def setUp(self):
+        super(CallComparatorTest, self).setUp()
+        set_cache(self.path('cache'))
+        compare_lengths.calls = 0
+
+    def tearDown(self):
+        set_cache(None)
+        super(CallComparatorTest, self).tearDown()
+
+    def test_results_are_reused(self):
+        file1 = write_file(self.path('a'), 'content\n')
+        file2 = write_file(self.path('b'), 'longer content\n')
+        self.assertEqual(call_comparator(compare_lengths, file1, file2), [-7])
+        self.assertEqual(call_comparator(compare_lengths, file1, file2), [-7])
+        self.assertEqual(compare_lengths.calls, 1)
+        write_file(file2, 'other\n')
+        self.assertEqual(call_comparator(compare_lengths, file1, file2), [2])
+        self.assertEqual(compare_lengths.calls, 2)
+
+    def test_recorded_digests_are_reused(self):
+        path = write_file(self.path('a'), 'content\n')
+        record_digest(path, (8, 'recorded'))
+        self.assertEqual(get_file_digest(path), 'recorded')
+        write_file(path, 'changed content\n')
+        self.assertEqual(get_file_digest(path), hash_file(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
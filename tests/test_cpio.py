@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+#
+# debbindiff: highlight differences between two builds of Debian packages
+#
+# Copyright © 2015 Jérémy Bobbio <lunar@debian.org>
+#
+# debbindiff is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# debbindiff is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
+
+import gzip
+import os
+import stat
+import subprocess
+import unittest
+from distutils.spawn import find_executable
+from debbindiff.comparators.cpio import CpioError, UnsupportedCpioFormat, \
+    compare_cpio_files, read_cpio_members
+from common import TempDirTestCase, write_file
+
+
+MTIME = 1420070400
+
+# name, mode, content
+MEMBERS = [
+    ('.', stat.S_IFDIR | 0755, ''),
+    ('etc', stat.S_IFDIR | 0755, ''),
+    ('etc/fstab', stat.S_IFREG | 0644, 'proc /proc proc defaults 0 0\n'),
+    ('etc/mtab', stat.S_IFLNK | 0777, '/proc/mounts'),
+    ('init', stat.S_IFREG | 0755, '#!/bin/sh\nexec /sbin/init\n'),
+    ]
+
+
+def pad(data, alignment):
+    return data + '\0' * ((alignment - len(data) % alignment) % alignment)
+
+
+def newc_member(ino, name, mode, content):
+    header = '070701' + ''.join('%08X' % value for value in [
+        ino, mode, 0, 0, 1, MTIME, len(content), 0, 0, 0, 0, len(name) + 1, 0])
+    return pad(header + name + '\0', 4) + pad(content, 4)
+
+
+def odc_member(ino, name, mode, content):
+    header = '070707' + '%06o%06o%06o%06o%06o%06o%06o%011o%06o%011o' % (
+        0, ino, mode, 0, 0, 1, 0, MTIME, len(name) + 1, len(content))
+    return header + name + '\0' + content
+
+
+def make_cpio(make_member, members):
+    archive = ''.join(make_member(ino, name, mode, content)
+                      for ino, (name, mode, content) in enumerate(members, 1))
+    archive += make_member(0, 'TRAILER!!!', 0, '')
+    return pad(archive, 512)
+
+
+def variant(members, content):
+    return [(name, mode, content if name == 'init' else data)
+            for name, mode, data in members]
+
+
+class CpioTest(TempDirTestCase):
+    def compare(self, archive1, archive2):
+        path1 = write_file(self.path('a', 'initrd'), archive1)
+        path2 = write_file(self.path('b', 'initrd'), archive2)
+        return compare_cpio_files(path1, path2)[0]
+
+    def check_format(self, make_member):
+        archive = make_cpio(make_member, MEMBERS)
+        path = write_file(self.path('archive.cpio'), archive)
+        with open(path, 'rb') as f:
+            members = read_cpio_members(f)
+        self.assertEqual([member.name for member in members],
+                         [name for name, _, _ in MEMBERS])
+        self.assertEqual(members[3].link_name, '/proc/mounts')
+        difference = self.compare(archive, make_cpio(make_member, variant(
+            MEMBERS, '#!/bin/sh\nexec /bin/init\n')))
+        details = dict((detail.source1, detail) for detail in difference.details)
+        self.assertEqual(sorted(details), ['file list', 'init'])
+        self.assertIn(u'+exec /bin/init', details['init'].unified_diff)
+
+    def test_newc(self):
+        self.check_format(newc_member)
+
+    def test_odc(self):
+        self.check_format(odc_member)
+
+    def test_compressed(self):
+        archives = []
+        for index, content in enumerate(['#!/bin/sh\n', '#!/bin/bash\n']):
+            path = self.path('%d.gz' % index)
+            with gzip.GzipFile(path, 'wb', mtime=MTIME) as f:
+                f.write(make_cpio(newc_member, variant(MEMBERS, content)))
+            with open(path, 'rb') as f:
+                archives.append(f.read())
+        difference = self.compare(*archives)
+        self.assertEqual(sorted(detail.source1 for detail in difference.details),
+                         ['file list', 'init'])
+
+    def test_truncated(self):
+        archive = make_cpio(newc_member, MEMBERS)
+        truncated = archive[:archive.index('#!/bin/sh') + 4]
+        with open(write_file(self.path('truncated'), truncated), 'rb') as f:
+            self.assertRaises(CpioError, read_cpio_members, f)
+        difference = self.compare(archive, truncated)
+        self.assertEqual(len(difference.details), 1)
+        comment = difference.details[0].comment
+        self.assertIn('Unable to read the content of the archives', comment)
+        self.assertIn('truncated member', comment)
+        self.assertNotIn('No differences found inside', comment)
+
+    def test_binary_format_is_not_read(self):
+        path = write_file(self.path('binary.cpio'), '\xc7\x71' + '\0' * 100)
+        with open(path, 'rb') as f:
+            self.assertRaises(UnsupportedCpioFormat, read_cpio_members, f)
+
+    @unittest.skipUnless(find_executable('cpio'), 'cpio is required')
+    def test_binary_format(self):
+        archives = []
+        for name in ('a', 'b'):
+            root = self.path('tree-%s' % name)
+            write_file(os.path.join(root, 'init'), 'init %s\n' % name)
+            p = subprocess.Popen(['cpio', '--quiet', '-o', '-H', 'bin'], cwd=root,
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            archives.append(p.communicate('init\n')[0])
+        difference = self.compare(*archives)
+        self.assertIn('init', [detail.source1 for detail in difference.details])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+#
+# debbindiff: highlight differences between two builds of Debian packages
+#
+# Copyright © 2015 Jérémy Bobbio <lunar@debian.org>
+#
+# debbindiff is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# debbindiff is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import subprocess
+import unittest
+from distutils.spawn import find_executable
+from debbindiff import difference
+from debbindiff.difference import FeederOutput, diff, \
+    make_feeder_from_buffer, set_diff_backend, split_lines
+from common import TempDirTestCase, write_file
+
+
+def make_lines(count, tag='line'):
+    # unique lines: GNU diff and difflib have no choice to make
+    return ['%s %d\n' % (tag, index) for index in range(count)]
+
+
+def edit_lines(lines, positions, rng):
+    lines = list(lines)
+    # from the end so earlier positions are still right
+    for position in sorted(positions, reverse=True):
+        kind = rng.choice(['change', 'insert', 'delete'])
+        length = rng.randint(1, 3)
+        new = ['%d %s\n' % (position, kind) * rng.randint(1, 2)
+               for _ in range(length)]
+        if kind == 'change':
+            lines[position:position + length] = new
+        elif kind == 'insert':
+            lines[position:position] = new
+        else:
+            del lines[position:position + length]
+    return lines
+
+
+def run_diff(content1, content2, end_nl1=True, end_nl2=True):
+    return diff(make_feeder_from_buffer(content1, end_nl1),
+                make_feeder_from_buffer(content2, end_nl2))
+
+
+@unittest.skipUnless(find_executable('diff'), 'diff is required')
+class DiffTestCase(TempDirTestCase):
+    def setUp(self):
+        super(DiffTestCase, self).setUp()
+        self.saved = dict((name, getattr(difference, name)) for name in
+                          ('_diff_backend', 'MAX_DIFF_INPUT_LINES',
+                           'MAX_INTERNAL_DIFF_LINES', 'DIFF_WINDOW_LINES',
+                           'MAX_DIFF_WINDOW_LINES', 'DIFF_SPOOL_SIZE', 'run_diff'))
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(difference, name, value)
+        super(DiffTestCase, self).tearDown()
+
+    def gnu_diff(self, content1, content2):
+        path1 = write_file(self.path('gnu', '1'), content1)
+        path2 = write_file(self.path('gnu', '2'), content2)
+        p = subprocess.Popen(['diff', '-au7', path1, path2], stdout=subprocess.PIPE)
+        output = p.communicate()[0]
+        # without the "---" and "+++" lines
+        return ''.join(split_lines(output)[2:])
+
+    def backend_diff(self, backend, content1, content2, *end_nl):
+        set_diff_backend(backend)
+        return run_diff(content1, content2, *end_nl)
+
+
+class BackendTest(DiffTestCase):
+    def test_backends_agree(self):
+        rng = random.Random(0)
+        for _ in range(30):
+            lines = make_lines(rng.randint(1, 300))
+            positions = rng.sample(range(len(lines)), min(len(lines), rng.randint(1, 6)))
+            content1 = ''.join(lines)
+            content2 = ''.join(edit_lines(lines, positions, rng))
+            expected = self.gnu_diff(content1, content2)
+            for backend in ('internal', 'external'):
+                unified_diff, hunks = self.backend_diff(backend, content1, content2)
+                self.assertEqual(unified_diff, expected, backend)
+                self.assertEqual(len(hunks), expected.count('\n@@ ') + 1)
+
+    def test_identical(self):
+        content = ''.join(make_lines(20))
+        for backend in ('internal', 'external'):
+            self.assertIsNone(self.backend_diff(backend, content, content))
+
+    def test_missing_final_newline(self):
+        lines = make_lines(20)
+        for content1, content2, end_nl in [
+                (''.join(lines), ''.join(lines)[:-1], (True, False)),
+                (''.join(lines)[:-1], 'other\n' + ''.join(lines)[:-1], (False, False)),
+                # long enough for the block to be cut
+                (''.join(lines), ''.join(make_lines(80, 'other'))[:-1], (True, False))]:
+            results = [self.backend_diff(backend, content1, content2, *end_nl)
+                       for backend in ('internal', 'external')]
+            self.assertEqual(results[0][0], results[1][0])
+            self.assertEqual([hunk.__getstate__() for hunk in results[0][1]],
+                             [hunk.__getstate__() for hunk in results[1][1]])
+
+    def test_auto_uses_external_for_long_inputs(self):
+        calls = []
+        def recording_run_diff(*args):
+            calls.append(args)
+            return self.saved['run_diff'](*args)
+        difference.run_diff = recording_run_diff
+        difference.MAX_INTERNAL_DIFF_LINES = 10
+        lines = make_lines(100)
+        content1 = ''.join(lines)
+        content2 = ''.join(edit_lines(lines, [10, 50, 90], random.Random(1)))
+        unified_diff, _ = self.backend_diff('auto', content1, content2)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(unified_diff, self.gnu_diff(content1, content2))
+
+
+class WindowedDiffTest(DiffTestCase):
+    def setUp(self):
+        super(WindowedDiffTest, self).setUp()
+        difference.MAX_DIFF_INPUT_LINES = 500
+        difference.DIFF_WINDOW_LINES = 16
+        difference.MAX_DIFF_WINDOW_LINES = 64
+
+    def get_window_lines(self, content):
+        output = FeederOutput()
+        output.write(content)
+        lines = [window[2] for window in output.get_windows()]
+        output.close()
+        return lines
+
+    def test_changes_near_window_boundaries(self):
+        rng = random.Random(2)
+        lines = make_lines(3000)
+        boundaries = self.get_window_lines(''.join(lines))[1:]
+        self.assertGreater(len(boundaries), 20)
+        for count in range(5):
+            positions = set()
+            for boundary in rng.sample(boundaries, 6):
+                positions.add(boundary + rng.choice([-1, 0, 1]))
+            content1 = ''.join(lines)
+            content2 = ''.join(edit_lines(lines, positions, rng))
+            expected = self.gnu_diff(content1, content2)
+            for backend in ('internal', 'external'):
+                unified_diff, _ = self.backend_diff(backend, content1, content2)
+                self.assertEqual(unified_diff, expected, backend)
+
+    def test_changes_in_neighbouring_windows(self):
+        lines = make_lines(3000)
+        boundaries = self.get_window_lines(''.join(lines))[1:]
+        # far apart windows, then windows close enough to share a hunk
+        positions = [boundaries[2], boundaries[10] - 1, boundaries[10] + 3,
+                     boundaries[11] + 1, len(lines) - 1]
+        content1 = ''.join(lines)
+        content2 = ''.join(edit_lines(lines, positions, random.Random(3)))
+        unified_diff, _ = run_diff(content1, content2)
+        self.assertEqual(unified_diff, self.gnu_diff(content1, content2))
+
+
+class FeederOutputTest(DiffTestCase):
+    def test_spooling(self):
+        difference.DIFF_SPOOL_SIZE = 4096
+        lines = make_lines(2000)
+        content = ''.join(lines)
+        output = FeederOutput()
+        make_feeder_from_buffer(content, True)(output)
+        self.assertTrue(output._on_disk)
+        self.assertEqual(output.line_count, len(lines))
+        self.assertEqual(output.getvalue(), content)
+        output.get_windows()
+        self.assertEqual(output.read_lines(1234, 10), lines[1234:1244])
+        output.close()
+
+    def test_spooled_diff(self):
+        lines = make_lines(3000)
+        content1 = ''.join(lines)
+        content2 = ''.join(edit_lines(lines, [5, 1500, 2990], random.Random(4)))
+        in_memory = run_diff(content1, content2)
+        difference.DIFF_SPOOL_SIZE = 4096
+        self.assertEqual(run_diff(content1, content2)[0], in_memory[0])
+        # and when the inputs are cut into windows
+        difference.MAX_DIFF_INPUT_LINES = 500
+        self.assertEqual(run_diff(content1, content2)[0], in_memory[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+#
+# debbindiff: highlight differences between two builds of Debian packages
+#
+# Copyright © 2015 Jérémy Bobbio <lunar@debian.org>
+#
+# debbindiff is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# debbindiff is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
+
+import ctypes
+import errno
+import os
+import re
+import struct
+import subprocess
+import unittest
+from distutils.spawn import find_executable
+from debbindiff.comparators.directory import get_libc, get_stat, getfacl, \
+    lgetxattr, ACL_USER_OBJ, ACL_USER, ACL_GROUP_OBJ, ACL_MASK, ACL_OTHER
+from common import TempDirTestCase, write_file
+
+
+# what debbindiff leaves out of the output of stat(1)
+STAT_FILTERS = [(re.compile(r'^  File: .*$', re.MULTILINE), ''),
+                (re.compile(r'^Device: \S+\tInode: \d+ +', re.MULTILINE), '')]
+
+
+def lsetxattr(path, name, value):
+    libc = get_libc()
+    libc.lsetxattr.argtypes = [ctypes.c_char_p, ctypes.c_char_p,
+                               ctypes.c_char_p, ctypes.c_size_t, ctypes.c_int]
+    if libc.lsetxattr(path, name, value, len(value), 0) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+
+
+class GetStatTest(TempDirTestCase):
+    def stat(self, path):
+        output = subprocess.check_output(['stat', path], env={'LC_ALL': 'C'})
+        for regexp, replacement in STAT_FILTERS:
+            output = regexp.sub(replacement, output)
+        return output.decode('utf-8')
+
+    @unittest.skipUnless(find_executable('stat'), 'stat is required')
+    def test_same_as_stat(self):
+        paths = [write_file(self.path('file'), 'content\n'),
+                 write_file(self.path('empty'), ''),
+                 self.directory]
+        os.symlink('file', self.path('link'))
+        paths.append(self.path('link'))
+        if os.path.exists('/dev/null'):
+            paths.append('/dev/null')
+        for path in paths:
+            self.assertEqual(get_stat(path), self.stat(path))
+
+
+class XattrTest(TempDirTestCase):
+    def setUp(self):
+        super(XattrTest, self).setUp()
+        self.file = write_file(self.path('file'), 'content\n')
+
+    def set_xattr(self, name, value):
+        try:
+            lsetxattr(self.file, name, value)
+        except OSError as e:
+            if e.errno in (errno.ENOTSUP, errno.EPERM, errno.EACCES):
+                self.skipTest('unable to set %s: %s' % (name, e))
+            raise
+
+    def test_lgetxattr(self):
+        self.set_xattr('user.debbindiff', 'value\0with a NUL')
+        self.assertEqual(lgetxattr(self.file, 'user.debbindiff'), 'value\0with a NUL')
+        self.assertIsNone(lgetxattr(self.file, 'user.missing'))
+
+    def test_lgetxattr_missing_file(self):
+        with self.assertRaises(OSError) as cm:
+            lgetxattr(self.path('missing'), 'user.debbindiff')
+        self.assertEqual(cm.exception.errno, errno.ENOENT)
+
+    def test_getfacl(self):
+        os.chmod(self.file, 0640)
+        self.assertEqual(getfacl(self.file), 'user::rw-\ngroup::r--\nother::---\n\n')
+        entries = [(ACL_USER_OBJ, 6, 0xffffffff), (ACL_USER, 4, 0),
+                   (ACL_GROUP_OBJ, 6, 0xffffffff), (ACL_MASK, 4, 0xffffffff),
+                   (ACL_OTHER, 0, 0xffffffff)]
+        self.set_xattr('system.posix_acl_access', struct.pack('<I', 2) +
+                       ''.join(struct.pack('<HHI', *entry) for entry in entries))
+        self.assertEqual(getfacl(self.file),
+                         'user::rw-\nuser:root:r--\ngroup::rw-\t#effective:r--\n'
+                         'mask::r--\nother::---\n\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
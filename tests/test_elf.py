@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+#
+# debbindiff: highlight differences between two builds of Debian packages
+#
+# Copyright © 2015 Jérémy Bobbio <lunar@debian.org>
+#
+# debbindiff is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# debbindiff is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
+
+import os.path
+import re
+import shutil
+import subprocess
+import tempfile
+import unittest
+from distutils.spawn import find_executable
+from debbindiff.comparators.elf import DEBUG_DUMP_KINDS, \
+    get_debug_dump_kind, get_elf_sections, _compare_elf_data
+
+
+SOURCE = '''#include <stdio.h>
+#define ANSWER 42
+struct pair { int a; int b; };
+static int twice(int x) { int y = x * 2; if (x > 2) { printf("%d\\n", y); return y; } return x; }
+int answer(int x) { struct pair p; p.a = twice(x); p.b = twice(x + 1); return p.a + p.b + ANSWER; }
+'''
+
+# between them, these give every section of DEBUG_DUMP_KINDS that gcc
+# writes in relocatable objects
+GCC_OPTIONS = [
+    ['-gdwarf-4', '-O2'],
+    ['-gdwarf-4', '-O2', '-fdebug-types-section', '-gpubnames'],
+    ['-gdwarf-4', '-g3'],
+    ['-gdwarf-5', '-O2'],
+    ['-gdwarf-5', '-g3'],
+    ['-gdwarf-5', '-O2', '-gsplit-dwarf'],
+    ]
+
+STRING_DUMP_RE = re.compile(r'^\s*\[\s*[0-9a-f]+\]\s+(.*)$')
+
+
+def readelf(*args):
+    return subprocess.check_output(['readelf'] + list(args),
+                                   stderr=subprocess.STDOUT)
+
+
+def compile_source(directory, options, name='test.o'):
+    source = os.path.join(directory, 'test.c')
+    with open(source, 'w') as f:
+        f.write(SOURCE)
+    path = os.path.join(directory, name)
+    # relative names so the build directory is the only thing that changes
+    subprocess.check_call(['gcc', '-c'] + options + ['test.c', '-o', name],
+                          cwd=directory)
+    return path
+
+
+def get_section_strings(path, name):
+    output = readelf('--string-dump=%s' % name, path)
+    return [match.group(1) for match in map(STRING_DUMP_RE.match, output.splitlines())
+            if match]
+
+
+@unittest.skipUnless(find_executable('gcc') and find_executable('readelf'),
+                     'gcc and readelf are required')
+class DebugDumpKindsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(suffix='debbindiff')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_kinds_are_known_to_readelf(self):
+        path = compile_source(self.directory, ['-g'])
+        for kind in sorted(set(DEBUG_DUMP_KINDS.values())):
+            output = readelf('--debug-dump=%s' % kind, path)
+            self.assertNotIn('Unrecognized debug option', output, kind)
+
+    def test_kinds_show_their_sections(self):
+        seen = set()
+        for index, options in enumerate(GCC_OPTIONS):
+            path = compile_source(self.directory, options, 'test%d.o' % index)
+            for name in get_elf_sections(path):
+                kind = get_debug_dump_kind(name)
+                if kind is None:
+                    continue
+                seen.add(name)
+                output = readelf('--debug-dump=%s' % kind, path)
+                if name in output:
+                    continue
+                # string tables are only shown where they are used
+                for string in get_section_strings(path, name):
+                    self.assertIn(string, output, '%s not shown by --debug-dump=%s'
+                                                  % (name, kind))
+        self.assertIn('.debug_line_str', seen)
+
+    def test_build_directory_change_is_shown(self):
+        directories = [os.path.join(self.directory, name) for name in ('one', 'other')]
+        paths = []
+        for directory in directories:
+            os.mkdir(directory)
+            paths.append(compile_source(directory, ['-gdwarf-5']))
+        lines = [line for difference in _compare_elf_data(*paths)
+                      for line in difference.unified_diff_lines()]
+        self.assertTrue(any(line.startswith('-') and directories[0] in line
+                            for line in lines))
+        self.assertTrue(any(line.startswith('+') and directories[1] in line
+                            for line in lines))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+#
+# debbindiff: highlight differences between two builds of Debian packages
+#
+# Copyright © 2015 Jérémy Bobbio <lunar@debian.org>
+#
+# debbindiff is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# debbindiff is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
+
+from StringIO import StringIO
+import struct
+import unittest
+from debbindiff.comparators.iso9660 import ISO9660Reader, ISO9660Error, \
+    SECTOR_SIZE, FLAG_DIRECTORY, FLAG_MULTI_EXTENT, NM_CONTINUE, \
+    compare_iso9660_contents
+from common import TempDirTestCase, write_file
+
+
+def both16(value):
+    return struct.pack('<H', value) + struct.pack('>H', value)
+
+
+def both32(value):
+    return struct.pack('<I', value) + struct.pack('>I', value)
+
+
+def susp(signature, data):
+    return signature + chr(4 + len(data)) + '\1' + data
+
+
+def nm(name, flags=0):
+    return susp('NM', chr(flags) + name)
+
+
+def record(identifier, extent, size, flags=0, system_use=''):
+    data = '\0' + both32(extent) + both32(size) + '\0' * 7 + chr(flags) + \
+        '\0\0' + both16(1) + chr(len(identifier)) + identifier
+    if len(identifier) % 2 == 0:
+        data += '\0'
+    data += system_use
+    if len(data) % 2 == 0:
+        data += '\0'
+    return chr(len(data) + 1) + data
+
+
+def directory(extent, parent, records, system_use=''):
+    """Return the sector of a directory, with its '.' and '..' records"""
+    data = record('\0', extent, SECTOR_SIZE, FLAG_DIRECTORY, system_use) + \
+        record('\1', parent, SECTOR_SIZE, FLAG_DIRECTORY) + ''.join(records)
+    assert len(data) <= SECTOR_SIZE
+    return data
+
+
+def make_image(sectors, root_extent):
+    """Build an image from a dict of sector contents, by sector number"""
+    pvd = '\1CD001\1'.ljust(128, '\0') + both16(SECTOR_SIZE)
+    pvd = pvd.ljust(156, '\0') + record('\0', root_extent, SECTOR_SIZE, FLAG_DIRECTORY)
+    sectors = dict(sectors)
+    sectors[16] = pvd
+    sectors[17] = '\xffCD001\1'
+    image = ''
+    for number in range(max(sectors) + 1):
+        image += sectors.get(number, '').ljust(SECTOR_SIZE, '\0')
+    return image
+
+
+def make_rock_ridge_image():
+    sp = susp('SP', '\xbe\xef\0')
+    continuation = nm('continued') + nm('.txt')
+    ce = susp('CE', both32(23) + both32(100) + both32(len(continuation)))
+    sectors = {
+        18: directory(18, 18, [
+            record('NORMAL.TXT;1', 30, 5, system_use=nm('normal.txt')),
+            record('LONG.TXT;1', 31, 4, system_use=nm('long-', NM_CONTINUE) + nm('name.txt')),
+            record('MULTI;1', 32, SECTOR_SIZE, FLAG_MULTI_EXTENT, nm('multi')),
+            record('MULTI;1', 33, 10, system_use=nm('multi')),
+            record('CE.TXT;1', 34, 3, system_use=ce),
+            record('RELOC', 0, 0, system_use=nm('reloc') + susp('CL', both32(20))),
+            record('RR_MOVED', 19, SECTOR_SIZE, FLAG_DIRECTORY, nm('rr_moved')),
+            ], sp),
+        19: directory(19, 18, [
+            record('RELOC', 20, SECTOR_SIZE, FLAG_DIRECTORY, nm('reloc') + susp('RE', '')),
+            ]),
+        20: directory(20, 18, [
+            record('INSIDE.TXT;1', 35, 6, system_use=nm('inside.txt')),
+            ]),
+        23: '\0' * 100 + continuation,
+        30: 'hello',
+        31: 'long',
+        32: 'm' * SECTOR_SIZE,
+        33: 'more data!',
+        34: 'ce!',
+        35: 'inside',
+        }
+    return make_image(sectors, 18)
+
+
+def make_plain_image():
+    sectors = {
+        18: directory(18, 18, [
+            record('README.TXT;1', 30, 7),
+            record('NOEXT.;1', 31, 5),
+            record('SUB', 19, SECTOR_SIZE, FLAG_DIRECTORY),
+            ]),
+        19: directory(19, 18, [
+            record('FILE.BIN;1', 32, 4),
+            ]),
+        30: 'readme\n',
+        31: 'noext',
+        32: 'file',
+        }
+    return make_image(sectors, 18)
+
+
+def read_content(image, extents):
+    return ''.join(image[offset:offset + size] for offset, size in extents)
+
+
+class ISO9660ReaderTest(unittest.TestCase):
+    def get_files(self, image):
+        files = ISO9660Reader(StringIO(image)).get_files()
+        return dict((name, read_content(image, extents))
+                    for name, extents in files.items())
+
+    def test_rock_ridge(self):
+        self.assertEqual(self.get_files(make_rock_ridge_image()), {
+            '/normal.txt': 'hello',
+            # NM entries continued in the next one
+            '/long-name.txt': 'long',
+            # a file in two extents
+            '/multi': 'm' * SECTOR_SIZE + 'more data!',
+            # NM entries in a continuation area
+            '/continued.txt': 'ce!',
+            # a directory moved to rr_moved, listed at its CL entry
+            '/reloc/inside.txt': 'inside',
+            })
+
+    def test_without_rock_ridge(self):
+        self.assertEqual(self.get_files(make_plain_image()), {
+            '/README.TXT': 'readme\n',
+            '/NOEXT': 'noext',
+            '/SUB/FILE.BIN': 'file',
+            })
+
+    def test_not_an_image(self):
+        self.assertRaises(ISO9660Error, ISO9660Reader, StringIO('\0' * 40000))
+
+
+class ISO9660ContentsTest(TempDirTestCase):
+    def test_changed_files(self):
+        image = make_plain_image()
+        path1 = write_file(self.path('a.iso'), image)
+        path2 = write_file(self.path('b.iso'), image.replace('readme\n', 'README\n'))
+        differences = compare_iso9660_contents(path1, path2, [])
+        self.assertEqual([difference.source1 for difference in differences],
+                         ['/README.TXT'])
+
+    def test_unreadable_image(self):
+        image = make_plain_image()
+        path1 = write_file(self.path('a.iso'), image)
+        # the directory of SUB is past the end
+        path2 = write_file(self.path('b.iso'), image[:19 * SECTOR_SIZE])
+        differences = compare_iso9660_contents(path1, path2, [])
+        self.assertEqual(len(differences), 1)
+        self.assertEqual(differences[0].comment,
+                         'Files in the images have not been compared: '
+                         'unable to read the files of %s: truncated image' % path2)
+
+
+if __name__ == '__main__':
+    unittest.main()
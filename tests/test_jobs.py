@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+#
+# debbindiff: highlight differences between two builds of Debian packages
+#
+# Copyright © 2015 Jérémy Bobbio <lunar@debian.org>
+#
+# debbindiff is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# debbindiff is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import debbindiff.jobs
+from debbindiff.jobs import set_jobs, JobQueue
+from common import TempDirTestCase, make_tree, read_report, run_debbindiff
+
+
+def without_title(html):
+    # the title holds the names of the compared files
+    return [line for line in html.splitlines() if '<title>' not in line]
+
+
+class JobsOutputTest(TempDirTestCase):
+    def compare(self, name, *options):
+        text = self.path('%s.txt' % name)
+        html = self.path('%s.html' % name)
+        status, stderr = run_debbindiff(*(list(options) + [
+            '--text', text, '--html', html, self.path('a'), self.path('b')]))
+        self.assertEqual(status, 1, stderr)
+        return read_report(text), read_report(html)
+
+    def test_parallel_output_matches_serial_output(self):
+        make_tree(self.path('a'), 'a')
+        make_tree(self.path('b'), 'b')
+        text, html = self.compare('serial')
+        self.assertIn('variant a', text)
+        self.assertIn('readme a', text)
+        for jobs in (2, 4):
+            parallel_text, parallel_html = self.compare('jobs%d' % jobs, '--jobs', str(jobs))
+            self.assertEqual(text, parallel_text)
+            self.assertEqual(without_title(html), without_title(parallel_html))
+
+
+def fail_semaphore(value):
+    raise OSError(38, 'Function not implemented')
+
+
+class SetJobsTest(unittest.TestCase):
+    def tearDown(self):
+        debbindiff.jobs.BoundedSemaphore = self._semaphore
+        set_jobs(1)
+
+    def setUp(self):
+        self._semaphore = debbindiff.jobs.BoundedSemaphore
+
+    def test_no_semaphore_runs_jobs_inline(self):
+        debbindiff.jobs.BoundedSemaphore = fail_semaphore
+        set_jobs(4)
+        queue = JobQueue()
+        for value in range(3):
+            queue.submit(lambda x: x * 2, value)
+        self.assertEqual(list(queue.results()), [0, 2, 4])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+#
+# debbindiff: highlight differences between two builds of Debian packages
+#
+# Copyright © 2015 Jérémy Bobbio <lunar@debian.org>
+#
+# debbindiff is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# debbindiff is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
+
+from StringIO import StringIO
+import os.path
+import struct
+import subprocess
+import unittest
+import zlib
+from distutils.spawn import find_executable
+from debbindiff.comparators import squashfs
+from debbindiff.comparators.squashfs import SquashfsReader, SUPERBLOCK_FORMAT, \
+    BLOCK_UNCOMPRESSED, METADATA_UNCOMPRESSED, NO_FRAGMENT, \
+    compare_squashfs_files, get_squashfs_files, get_unchanged_files
+from common import TempDirTestCase, write_file
+
+
+BLOCK_SIZE = 4096
+METADATA_SIZE = 8192
+
+
+def compress(data, enabled):
+    if enabled:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            return compressed, False
+    return data, True
+
+
+class MetadataWriter(object):
+    def __init__(self, compressed):
+        self._compressed = compressed
+        self._blocks = []
+        self._size = 0
+        self._buffer = ''
+
+    def position(self):
+        """Return the (block, offset) where the next byte goes"""
+        return self._size, len(self._buffer)
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= METADATA_SIZE:
+            self._flush(self._buffer[:METADATA_SIZE])
+            self._buffer = self._buffer[METADATA_SIZE:]
+
+    def _flush(self, data):
+        data, uncompressed = compress(data, self._compressed)
+        block = struct.pack('<H', len(data) | (uncompressed and METADATA_UNCOMPRESSED)) + data
+        self._blocks.append(block)
+        self._size += len(block)
+
+    def getvalue(self):
+        if self._buffer:
+            self._flush(self._buffer)
+            self._buffer = ''
+        return ''.join(self._blocks)
+
+
+def make_squashfs(files, compressed=False, extended=(), no_fragment=()):
+    """Build a squashfs image holding files, a dict of contents by name.
+    Files and directories named in `extended` get extended inodes."""
+    data = []
+    offset = [struct.calcsize(SUPERBLOCK_FORMAT)]
+    def write_data(content):
+        content, uncompressed = compress(content, compressed)
+        data.append(content)
+        offset[0] += len(content)
+        return len(content) | (uncompressed and BLOCK_UNCOMPRESSED)
+    fragments = []
+    fragment = ['']
+    def flush_fragment():
+        if fragment[0]:
+            start = offset[0]
+            fragments.append((start, write_data(fragment[0])))
+            fragment[0] = ''
+    locations = {}
+    for name in sorted(files):
+        content = files[name]
+        start = offset[0]
+        count = len(content) // BLOCK_SIZE
+        if name in no_fragment and len(content) % BLOCK_SIZE:
+            count += 1
+        blocks = [write_data(content[i * BLOCK_SIZE:(i + 1) * BLOCK_SIZE])
+                  for i in range(count)]
+        tail = content[count * BLOCK_SIZE:]
+        if tail:
+            if len(fragment[0]) + len(tail) > BLOCK_SIZE:
+                flush_fragment()
+            locations[name] = (start, blocks, len(fragments), len(fragment[0]))
+            fragment[0] += tail
+        else:
+            locations[name] = (start, blocks, NO_FRAGMENT, 0)
+    flush_fragment()
+
+    inodes = MetadataWriter(compressed)
+    directories = MetadataWriter(compressed)
+    inode_numbers = [0]
+    def write_inode(inode_type, content):
+        inode_numbers[0] += 1
+        block, offset = inodes.position()
+        inodes.write(struct.pack('<HHHHII', inode_type, 0644, 0, 0, 0,
+                                 inode_numbers[0]) + content)
+        return (block << 16) | offset, inode_numbers[0]
+    def write_directory(path):
+        prefix = path and path + '/'
+        children = sorted(set(name[len(prefix):].split('/')[0]
+                              for name in files if name.startswith(prefix)))
+        entries = []
+        for child in children:
+            child_path = prefix + child
+            if child_path in files:
+                start, blocks, fragment_index, fragment_offset = locations[child_path]
+                size = len(files[child_path])
+                block_list = struct.pack('<%dI' % len(blocks), *blocks)
+                if child_path in extended:
+                    reference, number = write_inode(9, struct.pack(
+                        '<QQQIIII', start, size, 0, 1, fragment_index,
+                        fragment_offset, 0xffffffff) + block_list)
+                else:
+                    reference, number = write_inode(2, struct.pack(
+                        '<IIII', start, fragment_index, fragment_offset,
+                        size) + block_list)
+                entries.append((child, reference, number, 2))
+            else:
+                reference, number = write_directory(child_path)
+                entries.append((child, reference, number, 1))
+        block, offset = directories.position()
+        # entries are grouped by the metadata block holding their inode
+        groups = []
+        for entry in entries:
+            if not groups or len(groups[-1]) == 256 or \
+               groups[-1][0][1] >> 16 != entry[1] >> 16:
+                groups.append([])
+            groups[-1].append(entry)
+        listing = ''
+        for group in groups:
+            start, base = group[0][1] >> 16, group[0][2]
+            listing += struct.pack('<III', len(group) - 1, start, base)
+            for name, reference, number, entry_type in group:
+                listing += struct.pack('<HhHH', reference & 0xffff, number - base,
+                                       entry_type, len(name) - 1) + name
+        directories.write(listing)
+        if path in extended:
+            return write_inode(8, struct.pack('<IIIIHHI', 2, len(listing) + 3,
+                                              block, 0, 0, offset, 0xffffffff))
+        return write_inode(1, struct.pack('<IIHHI', block, 2, len(listing) + 3,
+                                          offset, 0))
+    root, _ = write_directory('')
+
+    inode_table = offset[0]
+    inode_data = inodes.getvalue()
+    directory_table = inode_table + len(inode_data)
+    directory_data = directories.getvalue()
+    fragment_metadata = MetadataWriter(compressed)
+    for start, size in fragments:
+        fragment_metadata.write(struct.pack('<QII', start, size, 0))
+    fragment_data = fragment_metadata.getvalue()
+    # one pointer for each metadata block of fragment entries
+    pointers = []
+    position = directory_table + len(directory_data)
+    remaining = fragment_data
+    while remaining:
+        pointers.append(position)
+        length = struct.unpack('<H', remaining[:2])[0] & ~METADATA_UNCOMPRESSED
+        position += 2 + length
+        remaining = remaining[2 + length:]
+    fragment_table = directory_table + len(directory_data) + len(fragment_data)
+    image = ''.join(data) + inode_data + directory_data + fragment_data + \
+        ''.join(struct.pack('<Q', pointer) for pointer in pointers)
+    superblock = struct.pack(
+        SUPERBLOCK_FORMAT, 0x73717368, inode_numbers[0], 0, BLOCK_SIZE,
+        len(fragments), 1, 12, 0, 1, 4, 0, root,
+        struct.calcsize(SUPERBLOCK_FORMAT) + len(image), 0xffffffffffffffff,
+        0xffffffffffffffff, inode_table, directory_table, fragment_table,
+        0xffffffffffffffff)
+    return superblock + image
+
+
+def make_files(variant):
+    files = {}
+    # enough files for the tables to span several metadata blocks
+    for index in range(400):
+        files['doc/file%03d.txt' % index] = 'file %d\n' % index
+    files['doc/file007.txt'] = 'file 7, variant %s\n' % variant
+    files['big'] = ''.join(chr(i % 251) for i in range(3 * BLOCK_SIZE + 100))
+    files['big-changed'] = files['big'][:-1] + variant
+    files['extended'] = 'extended inode\n' * 500
+    files['unfragmented'] = 'no fragment\n' * 400
+    files['sub/dir/deep'] = 'deep\n'
+    return files
+
+
+class SquashfsReaderTest(TempDirTestCase):
+    def read_files(self, image):
+        reader = SquashfsReader(StringIO(image))
+        return reader, reader.get_files()
+
+    def check_files(self, compressed):
+        files = make_files('a')
+        image = make_squashfs(files, compressed, extended=('extended', 'sub'),
+                              no_fragment=('unfragmented', 'big-changed'))
+        reader, locations = self.read_files(image)
+        self.assertEqual(sorted(locations), sorted(files))
+        start, size, blocks, fragment, _ = locations['unfragmented']
+        self.assertEqual((size, len(blocks), fragment), (4800, 2, NO_FRAGMENT))
+        self.assertEqual(locations['extended'][1], len(files['extended']))
+        self.assertEqual(len(locations['big'][2]), 3)
+
+    def test_uncompressed(self):
+        self.check_files(False)
+
+    def test_compressed(self):
+        self.check_files(True)
+
+    def test_digests(self):
+        for compressed in (False, True):
+            files1 = make_files('a')
+            files2 = make_files('b')
+            reader1, locations1 = self.read_files(make_squashfs(files1, compressed))
+            reader2, locations2 = self.read_files(make_squashfs(files2, compressed))
+            changed = set(name for name in files1
+                          if reader1.get_digest(locations1[name]) !=
+                             reader2.get_digest(locations2[name]))
+            # even the files sharing the fragment of file007.txt are unchanged
+            self.assertEqual(changed, set(['doc/file007.txt', 'big-changed']))
+
+    def test_unchanged_files(self):
+        path1 = write_file(self.path('a.squashfs'), make_squashfs(make_files('a')))
+        path2 = write_file(self.path('b.squashfs'), make_squashfs(make_files('b')))
+        unchanged = get_unchanged_files(path1, path2, ['big', 'big-changed', 'missing'])
+        self.assertEqual(unchanged, set(['big']))
+        # not a squashfs image: everything is extracted
+        path3 = write_file(self.path('c.squashfs'), 'not squashfs\n' * 100)
+        self.assertEqual(get_unchanged_files(path1, path3, ['big']), set())
+
+
+@unittest.skipUnless(find_executable('mksquashfs') and find_executable('unsquashfs'),
+                     'mksquashfs and unsquashfs are required')
+class SquashfsComparisonTest(TempDirTestCase):
+    def make_image(self, variant):
+        root = self.path(variant)
+        for name, content in make_files(variant).items():
+            write_file(os.path.join(root, name), content)
+        image = self.path('%s.squashfs' % variant)
+        subprocess.check_call(['mksquashfs', root, image, '-noappend',
+                               '-all-root', '-no-progress'],
+                              stdout=open(os.devnull, 'w'))
+        return image
+
+    def test_reader_matches_listing(self):
+        image = self.make_image('a')
+        with open(image, 'rb') as f:
+            locations = SquashfsReader(f).get_files()
+        self.assertEqual(sorted(locations), sorted(get_squashfs_files(image)))
+
+    def test_only_changed_files_are_extracted(self):
+        image1 = self.make_image('a')
+        image2 = self.make_image('b')
+        extracted = []
+        extract_squashfs = squashfs.extract_squashfs
+        def recording_extract_squashfs(path, destdir, names):
+            extracted.extend(names)
+            return extract_squashfs(path, destdir, names)
+        squashfs.extract_squashfs = recording_extract_squashfs
+        try:
+            differences = compare_squashfs_files(image1, image2)
+        finally:
+            squashfs.extract_squashfs = extract_squashfs
+        self.assertNotIn('big', extracted)
+        self.assertIn('doc/file007.txt', extracted)
+        sources = [difference.source1 for difference in differences]
+        self.assertIn('doc/file007.txt', sources)
+        self.assertIn('big-changed', sources)
+
+    def test_extraction_failure_is_reported(self):
+        image1 = self.make_image('a')
+        image2 = self.make_image('b')
+        def failing_extract_squashfs(path, destdir, names):
+            raise subprocess.CalledProcessError(1, ['unsquashfs'], output='broken')
+        extract_squashfs = squashfs.extract_squashfs
+        squashfs.extract_squashfs = failing_extract_squashfs
+        try:
+            differences = compare_squashfs_files(image1, image2)
+        finally:
+            squashfs.extract_squashfs = extract_squashfs
+        comments = [difference.comment for difference in differences]
+        self.assertIn('unsquashfs exited with error code 1:\nbroken', comments)
+        self.assertIn('Unable to extract from %s and %s' % (image1, image2), comments)
+
+
+if __name__ == '__main__':
+    unittest.main()
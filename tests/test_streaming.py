@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+#
+# debbindiff: highlight differences between two builds of Debian packages
+#
+# Copyright © 2015 Jérémy Bobbio <lunar@debian.org>
+#
+# debbindiff is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# debbindiff is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with debbindiff.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import subprocess
+import unittest
+from debbindiff.comparators import compare_files
+from debbindiff.comparators.utils import binary_fallback
+from debbindiff.difference import Difference
+from debbindiff.presenters.text import TextPresenter
+from debbindiff.streaming import get_stream, set_presenters
+from common import TempDirTestCase, make_tree, write_file
+
+
+@binary_fallback
+def compare_then_fail(path1, path2, source=None):
+    get_stream().emit(Difference.from_unicode(u'one\n', u'two\n', path1, path2,
+                                              source='member'))
+    raise subprocess.CalledProcessError(1, ['false'], 'failed\n')
+
+
+class StreamingTest(TempDirTestCase):
+    def setUp(self):
+        super(StreamingTest, self).setUp()
+        self.lines = []
+
+    def tearDown(self):
+        set_presenters([])
+        super(StreamingTest, self).tearDown()
+
+    def print_func(self, *args):
+        self.lines.append(u' '.join(args))
+
+    def streamed_report(self, path1, path2):
+        stream = set_presenters([TextPresenter(self.print_func)])
+        differences = compare_files(path1, path2)
+        # members have been written while the comparison was running
+        self.assertNotEqual(self.lines, [])
+        stream.finish(differences)
+        lines, self.lines = self.lines, []
+        return lines
+
+    def test_directory_members_are_streamed(self):
+        make_tree(self.path('a'), 'a')
+        make_tree(self.path('b'), 'b')
+        os.chmod(self.path('b', 'archive.tar.gz'), 0600)
+        lines = self.streamed_report(self.path('a'), self.path('b'))
+        start = lines.index(u'├── archive.tar.gz')
+        end = start + 1
+        while not lines[end].startswith(u'├──'):
+            end += 1
+        archive = u'\n'.join(lines[start:end])
+        # metadata comes last in the archive
+        self.assertIn(u'readme a', archive)
+        self.assertEqual(archive.count(u'stat {}'), 1)
+        self.assertLess(archive.index(u'readme a'), archive.index(u'stat {}'))
+        self.assertIn(u'-rw-------', archive)
+
+    def test_partial_output_before_fallback(self):
+        path1 = write_file(self.path('a'), 'content a\n')
+        path2 = write_file(self.path('b'), 'content b\n')
+        stream = set_presenters([TextPresenter(self.print_func)])
+        differences = compare_then_fail(path1, path2, source='container')
+        stream.finish(differences)
+        text = u'\n'.join(self.lines)
+        self.assertEqual(text.count(u'--- container'), 1)
+        self.assertLess(text.index(u'member'), text.index(u'stopped early'))
+        self.assertIn(u'Command `false` exited with 1', text)
+        self.assertEqual(differences[0].source1, 'container')
+
+
+if __name__ == '__main__':
+    unittest.main()